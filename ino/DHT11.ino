@@ -44,7 +44,7 @@ void loop()
     }
   }
   if (!token.equals("")){
-    String postParams = "token=" + token + "&temp=" + String(temp) + "&humidity=" + String(humidity);
+    String postParams = "token=" + token + "&id=" + String(id) + "&temp=" + String(temp) + "&humidity=" + String(humidity);
     http.begin(readingsURL); 
     http.addHeader("Content-Type", "application/x-www-form-urlencoded");
     if (http.POST(postParams) == 403){
@@ -0,0 +1,219 @@
+"""
+End-to-end latency benchmark for the Alexa intents.
+
+Sends Alexa-shaped requests for every intent to the /alexa endpoint of the app,
+with the lights served by the bulb simulator, and reports p50/p95/p99 latency and
+the number of bulb commands per intent for 1, 10 and 50 bulbs.
+
+Results are saved to benchmark_results/<commit>.json. Pass --compare with an
+earlier results file to print the change against it.
+
+    python benchmark.py --iterations 20
+    python benchmark.py --compare benchmark_results/1a2b3c4.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from os import environ, makedirs
+from os.path import abspath, dirname, join
+
+app_dir = join(dirname(abspath(__file__)), 'iot_app')
+results_dir = join(dirname(abspath(__file__)), 'benchmark_results')
+
+sys.path.insert(0, app_dir)
+
+from simulator import BulbSimulator  # noqa: E402
+
+BULB_COUNTS = [1, 10, 50]
+
+INTENTS = [
+    ('ClimateIntent', {'Property': 'humidity'}),
+    ('DiscoLightsIntent', {'Room': 'everywhere'}),
+    ('StopFlowIntent', {'Room': 'everywhere'}),
+    ('FadeIntent', {'Room': 'everywhere', 'Duration': 'PT10M'}),
+    ('StopFadeIntent', {'Room': 'everywhere'}),
+]
+
+CONFIG = """
+POST_TOKEN = 'benchmark'
+CLIENTS = ['benchmark']
+ASK_VERIFY_REQUESTS = False
+SENSOR_LOG_PATH = None
+LIGHTS_SNAPSHOT_PATH = None
+"""
+
+
+def get_payload(intent, slots):
+    return {
+        'version': '1.0',
+        'session': {
+            'new': True,
+            'sessionId': 'amzn1.echo-api.session.{}'.format(uuid.uuid4()),
+            'application': {'applicationId': 'amzn1.ask.skill.benchmark'},
+            'attributes': {},
+            'user': {'userId': 'amzn1.ask.account.benchmark'},
+        },
+        'context': {
+            'System': {
+                'application': {'applicationId': 'amzn1.ask.skill.benchmark'},
+                'user': {'userId': 'amzn1.ask.account.benchmark'},
+                'device': {'supportedInterfaces': {}},
+            },
+        },
+        'request': {
+            'type': 'IntentRequest',
+            'requestId': 'amzn1.echo-api.request.{}'.format(uuid.uuid4()),
+            'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'locale': 'en-GB',
+            'intent': {
+                'name': intent,
+                'slots': {name: {'name': name, 'value': value} for name, value in slots.items()},
+            },
+        },
+    }
+
+
+def get_headers():
+    #  not verified with ASK_VERIFY_REQUESTS off, sent so requests look like Alexa's
+    return {
+        'SignatureCertChainUrl': 'https://s3.amazonaws.com/echo.api/echo-api-cert.pem',
+        'Signature': 'benchmark',
+    }
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = max(0, int(round(percent / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def wait_for_light_jobs(timeout=30):
+    """Light intents reply before their bulb commands finish, wait for those so their commands are counted."""
+    import lights
+
+    deadline = time.monotonic() + timeout
+    while any(job.status in (lights.JobStatus.PENDING, lights.JobStatus.RUNNING)
+              for job in lights.get_job_queue().get_jobs()):
+        if time.monotonic() > deadline:
+            raise RuntimeError('Light jobs still running after {} seconds'.format(timeout))
+        time.sleep(0.005)
+
+
+def run_scenario(client, simulator, iterations):
+    results = {}
+
+    for intent, slots in INTENTS:
+        latencies = []
+        rpcs = []
+
+        for _ in range(iterations):
+            rpc_count = simulator.get_rpc_count()
+            start = time.perf_counter()
+            response = client.post('/alexa', data=json.dumps(get_payload(intent, slots)),
+                                   content_type='application/json', headers=get_headers())
+            latencies.append((time.perf_counter() - start) * 1000)
+            wait_for_light_jobs()
+            rpcs.append(simulator.get_rpc_count() - rpc_count)
+
+            if response.status_code != 200:
+                raise RuntimeError('{0} failed with status {1}'.format(intent, response.status_code))
+
+        results[intent] = {
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'rpcs': round(sum(rpcs) / len(rpcs), 2),
+        }
+
+    return results
+
+
+def run(iterations, quota, latency):
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as config:
+        config.write(CONFIG)
+    environ['IOT_APP_CONFIG'] = config.name
+
+    import lights
+
+    #  real bulbs allow 60 commands a minute, which would make the benchmark measure the quota
+    governor = lights.get_rate_governor()
+    governor.requests_per_minute = quota
+    governor.burst = quota // 6
+
+    results = {}
+    app = None
+
+    for count in BULB_COUNTS:
+        names = ['lounge', 'bedroom'] + ['bulb{}'.format(i) for i in range(2, count)]
+        with BulbSimulator(count, names=names[:count], requests_per_minute=quota, latency=latency) as simulator:
+            if app is None:
+                from app import app  # discovers the simulated bulbs on import
+                app.test_client().post('/iot', data={'token': 'benchmark', 'temp': '21', 'humidity': '40'})
+            lights.get_registry().refresh()
+
+            print('Running {0} iterations with {1} bulb(s)'.format(iterations, count))
+            results[str(count)] = run_scenario(app.test_client(), simulator, iterations)
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=app_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(results, baseline=None):
+    print('{:>6} {:<18} {:>10} {:>10} {:>10} {:>8}'.format('bulbs', 'intent', 'p50 ms', 'p95 ms', 'p99 ms', 'rpcs'))
+
+    for count, intents in results.items():
+        for intent, stats in intents.items():
+            line = '{:>6} {:<18} {:>10} {:>10} {:>10} {:>8}'.format(
+                count, intent, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['rpcs'])
+
+            previous = (baseline or {}).get(count, {}).get(intent)
+            if previous:
+                change = (stats['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0
+                line += '   p95 {:+.1f}%, rpcs {:+}'.format(change, round(stats['rpcs'] - previous['rpcs'], 2))
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Alexa intent latency against simulated bulbs.')
+    parser.add_argument('--iterations', type=int, default=20, help='requests per intent and bulb count')
+    parser.add_argument('--quota', type=int, default=6000, help='commands per minute allowed per bulb')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds each simulated bulb takes to reply')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.quota, args.latency)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+
+    commit = get_commit()
+    makedirs(results_dir, exist_ok=True)
+    output = join(results_dir, '{}.json'.format(commit))
+    with open(output, 'w') as results_file:
+        json.dump({
+            'commit': commit,
+            'date': datetime.utcnow().isoformat(),
+            'iterations': args.iterations,
+            'quota': args.quota,
+            'latency': args.latency,
+            'results': results,
+        }, results_file, indent=2)
+    print('Saved results to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
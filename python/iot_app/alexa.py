@@ -2,9 +2,14 @@ from flask import render_template
 from flask_ask import question, statement
 from web_assets import *
 from lights import *
+from sensors import get_reading_store
 from isodate import parse_duration
 
-IOT_ENV = {"temp": None, "humidity": None}
+INTENT_BUDGET = 5  # seconds, Alexa gives up on a skill after 8
+
+STATS_PERIODS = {'hour': 'hour', 'day': 'day', 'today': 'day', 'week': 'week'}
+STATS_NAMES = {'average': 'average', 'mean': 'average', 'minimum': 'lowest', 'lowest': 'lowest',
+               'maximum': 'highest', 'highest': 'highest', 'trend': 'trend'}
 
 
 def welcome():
@@ -13,48 +18,93 @@ def welcome():
     return question(question_text).standard_card(card_title, question_text, pi_img)
 
 
-def climate_info(prop, warmth):
+def climate_info(prop, warmth, room=None):
     card_title = render_template('card_title_pi')
+    room = None if room == 'all' or room == 'everywhere' else room
+    store = get_reading_store()
+    temp = store.get_latest('temp', room=room)
+    humidity = store.get_latest('humidity', room=room)
+
+    if temp is humidity is None:
+        answer = render_template('no_readings_in_room').format(room) if room else render_template('no_readings')
+        return statement(answer).standard_card(card_title, answer, pi_img)
 
     if warmth is prop is None:
-        answer = render_template('temp_and_humidity').format(IOT_ENV['temp'], IOT_ENV['humidity'])
+        answer = render_template('temp_and_humidity').format(_format_reading(temp), _format_reading(humidity))
         return statement(answer).standard_card(card_title, answer, pi_img)
 
     if warmth is not None:
-        answer = render_template('temp').format(IOT_ENV["temp"])
+        answer = render_template('temp').format(_format_reading(temp))
         return statement(answer).standard_card(card_title, answer, temp_img)
 
     if prop == 'humidity':
         card_img = humidity_img
-        answer = render_template('humidity').format(IOT_ENV["humidity"])
+        answer = render_template('humidity').format(_format_reading(humidity))
     else:
         card_img = temp_img
-        answer = render_template('temp').format(IOT_ENV["temp"])
+        answer = render_template('temp').format(_format_reading(temp))
 
     return statement(answer).standard_card(card_title, answer, card_img)
 
 
+def climate_stats(prop, statistic, period, room=None):
+    card_title = render_template('card_title_pi')
+    room = None if room == 'all' or room == 'everywhere' else room
+    metric = 'humidity' if prop == 'humidity' else 'temp'
+    period = STATS_PERIODS.get(period, 'day')
+    statistic = STATS_NAMES.get(statistic, 'average')
+    summary = get_reading_store().get_summary(metric, period, room=room)
+
+    if summary is None:
+        answer = render_template('no_readings_in_room').format(room) if room else render_template('no_readings')
+        return statement(answer).standard_card(card_title, answer, pi_img)
+
+    if statistic == 'trend':
+        direction = 'steady' if abs(summary.trend) < 0.1 else 'rising' if summary.trend > 0 else 'falling'
+        answer = render_template('stats_trend_' + direction).format(
+            metric=render_template('metric_' + metric), change=_format_reading(abs(summary.trend)), period=period)
+    else:
+        value = {'average': summary.mean, 'lowest': summary.minimum, 'highest': summary.maximum}[statistic]
+        answer = render_template('stats_value').format(
+            statistic=statistic, metric=render_template('metric_' + metric), period=period,
+            value=render_template('unit_' + metric).format(_format_reading(value)))
+
+    return statement(answer).standard_card(card_title, answer, humidity_img if metric == 'humidity' else temp_img)
+
+
+def _format_reading(value):
+    return 'unknown' if value is None else '{:g}'.format(round(value, 1))
+
+
+def _light_action():
+    return LightAction(LightManager(registry=get_registry()), render_template('card_title_lights'), light_img,
+                       jobs=get_job_queue(), deadline=Deadline(INTENT_BUDGET))
+
+
 def start_disco(room):
-    return LightAction(LightManager(), render_template('card_title_lights'), light_img).start_disco(room)
+    return _light_action().start_disco(room)
 
 
 def stop_flow(room):
-    return LightAction(LightManager(), render_template('card_title_lights'), light_img).stop_flow(room)
+    return _light_action().stop_flow(room)
 
 
 def start_fade(room, duration, off):
-    return LightAction(LightManager(), render_template('card_title_lights'), light_img).start_fade(room, duration, off)
+    return _light_action().start_fade(room, duration, off)
 
 
 def stop_fade(room):
-    return LightAction(LightManager(), render_template('card_title_lights'), light_img).stop_fade(room)
+    return _light_action().stop_fade(room)
 
 
 class LightAction:
-    def __init__(self, light_manager: LightManager, card_title: str, card_img: str):
+    def __init__(self, light_manager: LightManager, card_title: str, card_img: str, jobs: JobQueue = None,
+                 deadline: Deadline = None):
         self.light_manager = light_manager
         self.card_title = card_title
         self.card_img = card_img
+        self.jobs = jobs
+        self.deadline = deadline
 
     def start_disco(self, room):
         fail_stmt = self.__validate(room)
@@ -62,16 +112,16 @@ class LightAction:
             return fail_stmt
 
         if room is None:
-            self.light_manager.start_disco()
-            return self.__stmt_disco_ok()
+            failure = self.__run(self.light_manager.start_disco)
+            return failure or self.__stmt_disco_ok()
         else:
             if room == 'all' or room == 'everywhere':
-                self.light_manager.start_disco(*self.light_manager.get_all_lights())
-                return self.__stmt_disco_ok()
+                failure = self.__run(self.light_manager.start_disco, *self.light_manager.get_all_lights())
+                return failure or self.__stmt_disco_ok()
             else:
                 light = self.light_manager.get_light_by_name(room)
-                self.light_manager.start_disco(light)
-                return self.__stmt_disco_ok()
+                failure = self.__run(self.light_manager.start_disco, light)
+                return failure or self.__stmt_disco_ok()
 
     def stop_flow(self, room):
         fail_stmt = self.__validate(room)
@@ -79,12 +129,12 @@ class LightAction:
             return fail_stmt
 
         if room is None or room == 'all' or room == 'everywhere':
-            self.light_manager.stop_flow(*self.light_manager.get_all_lights())
-            return self.__stmt_stopped_lights()
+            failure = self.__run(self.light_manager.stop_flow, *self.light_manager.get_all_lights())
+            return failure or self.__stmt_stopped_lights()
         else:
             light = self.light_manager.get_light_by_name(room)
-            self.light_manager.stop_flow(light)
-            return self.__stmt_stopped_lights()
+            failure = self.__run(self.light_manager.stop_flow, light)
+            return failure or self.__stmt_stopped_lights()
 
     def start_fade(self, room, duration, off):
         fail_stmt = self.__validate(room)
@@ -99,34 +149,84 @@ class LightAction:
             duration = 120  # default, in seconds
 
         if room is None:
-            self.light_manager.fade(duration, turn_off)
+            failure = self.__run(self.light_manager.fade, duration, turn_off)
             room = self.light_manager.get_default_room().lower()
-            return self.__stmt_fade_ok(room, duration)
+            return failure or self.__stmt_fade_ok(room, duration)
         else:
             if room == 'all' or room == 'everywhere':
-                self.light_manager.fade(duration, turn_off, 5, *self.light_manager.get_all_lights())
-                return self.__stmt_fade_ok(room, duration)
+                failure = self.__run(self.light_manager.fade, duration, turn_off, 5,
+                                     *self.light_manager.get_all_lights())
+                return failure or self.__stmt_fade_ok(room, duration)
             else:
                 light = self.light_manager.get_light_by_name(room)
-                self.light_manager.fade(duration, turn_off, 5, light)
-                return self.__stmt_fade_ok(room, duration)
+                failure = self.__run(self.light_manager.fade, duration, turn_off, 5, light)
+                return failure or self.__stmt_fade_ok(room, duration)
 
     def stop_fade(self, room):
-        fail_stmt = self.__validate(room)
+        #  fades are cancelled here even on a light that has stopped responding
+        fail_stmt = self.__validate(room, available=False)
         if fail_stmt is not None:
             return fail_stmt
 
         if room is None:
-            self.light_manager.stop_fade()
+            failure = self.__run(self.light_manager.stop_fade)
             room = self.light_manager.get_default_room().lower()
-            return self.__stmt_fade_stopped(room)
+            return failure or self.__stmt_fade_stopped(room)
         if room == 'all' or room == 'everywhere':
-            self.light_manager.stop_fade(*self.light_manager.get_all_lights())
-            return self.__stmt_fade_stopped(room)
+            failure = self.__run(self.light_manager.stop_fade, *self.light_manager.get_all_lights())
+            return failure or self.__stmt_fade_stopped(room)
         else:
             light = self.light_manager.get_light_by_name(room)
-            self.light_manager.stop_fade(light)
-            return self.__stmt_fade_stopped(room)
+            failure = self.__run(self.light_manager.stop_fade, light)
+            return failure or self.__stmt_fade_stopped(room)
+
+    def __run(self, command, *args):
+        """
+        Runs the command, as a background job when there is a job queue, and returns a statement
+        for lights that failed or have not answered by the deadline, or None if all went well.
+        Queued jobs are not given the deadline: it only bounds how long the reply waits, while
+        the job runs to the end so that its status tells how it went.
+        """
+        if self.jobs is None:
+            kwargs = {'deadline': self.deadline} if self.deadline is not None else {}
+            return self.__stmt_results(command(*args, **kwargs))
+
+        job = self.jobs.submit(command.__name__, command, *args)
+        if self.deadline is None:
+            return None
+        if job.wait(self.deadline.remaining()):
+            return self.__stmt_results(job.results)
+        return self.__stmt_in_progress()
+
+    def __stmt_results(self, results):
+        pending = [result.bulb for result in results if isinstance(result.error, DeadlineExceeded)]
+        skipped = [result.bulb for result in results if isinstance(result.error, BulbUnavailable)]
+        failed = [result.bulb for result in results if result.error is not None
+                  and not isinstance(result.error, (DeadlineExceeded, BulbUnavailable))]
+
+        if pending and len(pending) + len(failed) + len(skipped) == len(results):
+            #  no light has confirmed yet
+            return self.__stmt_in_progress()
+        if not failed and not skipped:
+            return None
+
+        if len(failed) + len(skipped) == len(results):
+            text = render_template('lights_failed')
+        else:
+            sentences = []
+            if failed:
+                sentences.append(render_template('lights_partial').format(self.__names(failed)))
+            if skipped:
+                sentences.append(render_template('lights_skipped').format(self.__names(skipped)))
+            text = ' '.join(sentences)
+        return statement(text).standard_card(self.card_title, text, self.card_img)
+
+    def __stmt_in_progress(self):
+        text = render_template('lights_in_progress')
+        return statement(text).standard_card(self.card_title, text, self.card_img)
+
+    def __names(self, bulbs):
+        return ' and '.join(self.light_manager.get_light_name(bulb) for bulb in bulbs)
 
     def __card_disco_ok(self):
         return self.card_title, render_template('disco_lights_card'), self.card_img
@@ -167,7 +267,12 @@ class LightAction:
     def __stmt_fade_stopped(self, room):
         return statement('OK').standard_card(*self.__card_fade_stopped(room))
 
-    def __validate(self, room):
+    def __stmt_not_responding(self, light_name):
+        text = render_template('light_not_responding').format(light_name)
+        return statement(text).standard_card(self.card_title, text, self.card_img)
+
+    def __validate(self, room, available=True):
+        """Checks there is a light for the room, and unless available is False, that it is responding."""
         if len(self.light_manager.get_all_lights()) == 0:
             return self.__stmt_no_lights()
 
@@ -176,15 +281,18 @@ class LightAction:
 
         if room is None:
             light = self.light_manager.get_light_by_name(self.light_manager.get_default_room())
-            if light is not None:
-                return None
-            return self.__stmt_no_such_light(self.light_manager.get_default_room())
+            if light is None:
+                return self.__stmt_no_such_light(self.light_manager.get_default_room())
+            if available and not self.light_manager.is_available(light):
+                return self.__stmt_not_responding(self.light_manager.get_default_room().lower())
+            return None
         else:
             light = self.light_manager.get_light_by_name(room)
-            if light is not None:
-                return None
-            else:
+            if light is None:
                 return self.__stmt_no_such_light(room)
+            if available and not self.light_manager.is_available(light):
+                return self.__stmt_not_responding(room)
+            return None
 
 
 def get_duration_str(duration: int) -> str:
@@ -1,27 +1,85 @@
+import atexit
+import hashlib
+import json
 import logging
+import time
+from os import environ, makedirs
 from os.path import dirname, join, abspath
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 from flask_ask import Ask
-from alexa import  welcome, climate_info, start_disco, stop_flow, start_fade, stop_fade
-from alexa import IOT_ENV # temporary solution
+from alexa import  welcome, climate_info, climate_stats, start_disco, stop_flow, start_fade, stop_fade
+from lights import get_job_queue, get_registry
+from sensors import DEFAULT_DEVICE, METRICS, ReadingLog, SharedReadings, UdpIngest, check_timestamp, get_reading_store
+
+STREAM_KEEPALIVE = 15
+DEFAULT_HISTORY_POINTS = 500
+DEFAULT_HISTORY_RANGE = 24 * 60 * 60  # seconds
 
 app_dir = dirname(__file__)
 logs_dir = join(app_dir, 'logs')
+data_dir = join(app_dir, 'data')
 
 
 app = Flask(__name__, instance_relative_config=True)
-app.config.from_pyfile(abspath(join(app_dir, 'instance/config.py')))
+app.config.from_pyfile(environ.get('IOT_APP_CONFIG', abspath(join(app_dir, 'instance/config.py'))))
 ask = Ask(app, '/alexa')
 
+# discover bulbs once at startup, or load the last known ones, and then follow their advertisements;
+# intents reuse the same handles
+lights_snapshot_path = app.config.get('LIGHTS_SNAPSHOT_PATH', join(data_dir, 'lights.json'))
+if lights_snapshot_path is not None:
+    makedirs(dirname(abspath(lights_snapshot_path)), exist_ok=True)
+get_registry(app.config.get('LIGHTS_REFRESH_INTERVAL'), lights_snapshot_path)
+store = get_reading_store(app.config.get('SENSOR_HISTORY_CAPACITY'))
+for client in app.config['CLIENTS']:
+    store.register(client, app.config.get('CLIENT_ROOMS', {}).get(client))
+
+# restore readings from before the last restart, then keep logging new ones
+sensor_log_path = app.config.get('SENSOR_LOG_PATH', join(data_dir, 'readings.db'))
+if sensor_log_path is not None:
+    makedirs(dirname(abspath(sensor_log_path)), exist_ok=True)
+    sensor_log = ReadingLog(sensor_log_path)
+    logging.info('Restored {} sensor readings'.format(sensor_log.restore(store)))
+    store.subscribe(sensor_log.append)
+    atexit.register(sensor_log.close)
+    sensor_log.start()
+
+# with several worker processes, readings recorded by one are replayed into the others
+shared_readings = None
+if app.config.get('SHARED_READINGS_PATH') is not None:
+    shared_readings = SharedReadings(app.config['SHARED_READINGS_PATH'])
+    if sensor_log_path is not None:
+        shared_readings.skip()  # already restored from the log
+    else:
+        shared_readings.sync(store)
+    store.subscribe(shared_readings.append)
+    shared_readings.follow(store)
+
+# readings can also be sent as UDP datagrams, see sensors.UdpIngest
+if app.config.get('UDP_INGEST_PORT') is not None:
+    UdpIngest(store, app.config['POST_TOKEN'], port=app.config['UDP_INGEST_PORT']).start()
+
+
+@app.before_request
+def sync_shared_readings():
+    if shared_readings is not None:
+        shared_readings.sync(store)
+
 
 @ask.launch
 def launch():
     return welcome()
 
 
-@ask.intent('ClimateIntent', mapping={'prop': 'Property', 'warmth': 'Warmth'})
-def climate(prop, warmth):
-    return climate_info(prop, warmth)
+@ask.intent('ClimateIntent', mapping={'prop': 'Property', 'warmth': 'Warmth', 'room': 'Room'})
+def climate(prop, warmth, room):
+    return climate_info(prop, warmth, room)
+
+
+@ask.intent('ClimateStatsIntent',
+            mapping={'prop': 'Property', 'statistic': 'Statistic', 'period': 'Period', 'room': 'Room'})
+def climate_statistics(prop, statistic, period, room):
+    return climate_stats(prop, statistic, period, room)
 
 
 @ask.intent('DiscoLightsIntent', mapping={'room': 'Room'})
@@ -44,6 +102,26 @@ def stop_fade_lights(room):
     return stop_fade(room)
 
 
+@app.route('/lights/jobs', methods=['GET'])
+def list_light_jobs():
+    return jsonify(jobs=[job.to_dict() for job in get_job_queue().get_jobs()])
+
+
+@app.route('/lights/jobs/<int:job_id>', methods=['GET'])
+def read_light_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return 'invalid_job', 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/lights/scan', methods=['POST'])
+def scan_lights():
+    registry = get_registry()
+    registry.refresh()
+    return jsonify(lights=[{'ip': bulb.ip, 'name': registry.get_name(bulb)} for bulb in registry.get_all_lights()])
+
+
 @app.route('/register', methods=['POST'])
 def register_client():
     if request.form.get("id") in app.config['CLIENTS']:
@@ -54,12 +132,98 @@ def register_client():
 @app.route('/read', methods=['GET'])
 def read_environment():
     key = request.args.get('key')
-    if key is not None:
-        try:
-            return str(IOT_ENV[key])
-        except KeyError:
-            return 'invalid_key'
-    return str(IOT_ENV)
+    device = request.args.get('device')
+    room = request.args.get('room')
+
+    if device is not None and store.get_device(device) is None:
+        return 'invalid_device'
+    if key is not None and key not in METRICS:
+        return 'invalid_key'
+
+    # dashboards poll this, unchanged readings only cost a 304; the tag hashes the body
+    # rather than using store.version, which counts differently in every worker
+    response = jsonify(_get_readings(key, device, room))
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/read/stream', methods=['GET'])
+def stream_environment():
+    key = request.args.get('key')
+    device = request.args.get('device')
+    room = request.args.get('room')
+
+    if device is not None and store.get_device(device) is None:
+        return 'invalid_device'
+    if key is not None and key not in METRICS:
+        return 'invalid_key'
+
+    last_event = request.headers.get('Last-Event-ID')
+
+    # event ids hash the readings, so a client reconnecting to another worker
+    # is only sent readings that differ from the ones it has
+    def events():
+        event_id = last_event
+        version = None
+        while True:
+            if version is not None:
+                current = store.wait_for_change(version, STREAM_KEEPALIVE)
+                if current == version:
+                    yield ': keepalive\n\n'
+                    continue
+            version = store.version
+            data = json.dumps(_get_readings(key, device, room), sort_keys=True)
+            readings_id = hashlib.sha1(data.encode('utf8')).hexdigest()
+            if readings_id != event_id:
+                event_id = readings_id
+                yield 'id: {0}\ndata: {1}\n\n'.format(event_id, data)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def _get_readings(key, device, room):
+    readings = {metric: store.get_latest(metric, device, room) for metric in METRICS}
+    return {key: readings[key]} if key is not None else readings
+
+
+@app.route('/history', methods=['GET'])
+def read_history():
+    key = request.args.get('key')
+    device = request.args.get('device', DEFAULT_DEVICE)
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    resolution = request.args.get('resolution', type=float)
+    points = request.args.get('points', type=int)
+    raw = request.args.get('raw') in ('1', 'true')
+
+    # unless asked for raw readings or a resolution, a number of points for the range picks the tier,
+    # so responses stay small for long ranges
+    if not raw and resolution is None:
+        if start is None:
+            start = (end or time.time()) - DEFAULT_HISTORY_RANGE
+        resolution = ((end or time.time()) - start) / (points or DEFAULT_HISTORY_POINTS)
+
+    try:
+        if raw:
+            return jsonify(key=key, device=device, readings=store.get_history(device, key, start, end))
+        resolution, rollups = store.get_rollups(device, key, resolution, start, end)
+        return jsonify(key=key, device=device, resolution=resolution, rollups=rollups)
+    except KeyError:
+        return 'invalid_key'
+
+
+@app.route('/stats', methods=['GET'])
+def read_stats():
+    key = request.args.get('key')
+    if key not in METRICS:
+        return 'invalid_key'
+
+    try:
+        summary = store.get_summary(key, request.args.get('period', 'day'),
+                                    request.args.get('device'), request.args.get('room'))
+    except KeyError:
+        return 'invalid_key'
+    return jsonify(key=key, summary=summary._asdict() if summary is not None else None)
 
 
 @app.route('/iot', methods=['POST'])
@@ -69,14 +233,16 @@ def iot_handler():
     if token != app.config['POST_TOKEN']:
         return '403', 403
 
+    device = request.form.get('id', DEFAULT_DEVICE)
     temp = request.form.get('temp')
     humidity = request.form.get('humidity')
 
-    if temp is not None:
-        IOT_ENV['temp'] = temp
-
-    if humidity is not None:
-        IOT_ENV['humidity'] = humidity
+    for key, value in (('temp', temp), ('humidity', humidity)):
+        if value is not None:
+            try:
+                store.record(device, key, value)
+            except ValueError:
+                logging.warning('Not recording invalid {0} reading {1} from {2}'.format(key, value, device))
 
     if temp is humidity is None:
         return 'invalid_message'
@@ -84,11 +250,55 @@ def iot_handler():
     return "200"
 
 
+@app.route('/iot/batch', methods=['POST'])
+def iot_batch_handler():
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get('readings'), list):
+        return 'invalid_message', 400
+
+    if body.get('token') != app.config['POST_TOKEN']:
+        return '403', 403
+
+    readings = []
+    for item in body['readings']:
+        try:
+            readings.append((_parse_reading(item), None))
+        except ValueError as err:
+            readings.append((None, str(err)))
+    errors = iter(store.record_many([reading for reading, _ in readings if reading is not None]))
+
+    results = []
+    for reading, error in readings:
+        error = error if reading is None else next(errors)
+        results.append({'status': 'ok'} if error is None else {'status': 'error', 'error': error})
+
+    return jsonify(accepted=sum(result['status'] == 'ok' for result in results), results=results)
+
+
+def _parse_reading(item):
+    """Returns (device id, {metric: value}, timestamp) for a batch item. Raises ValueError if it is malformed."""
+    if not isinstance(item, dict):
+        raise ValueError('invalid reading')
+    values = {metric: item[metric] for metric in METRICS if item.get(metric) is not None}
+    timestamp = item.get('timestamp')
+    #  bool is an int too, but true is no time
+    valid_timestamp = timestamp is None or isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool)
+    if not values or not valid_timestamp:
+        raise ValueError('invalid reading')
+    error = check_timestamp(timestamp) if timestamp is not None else None
+    if error is not None:
+        raise ValueError(error)
+    device = item.get('id')
+    return str(device) if device is not None else DEFAULT_DEVICE, values, timestamp
+
+
 @app.route('/')
 def homepage():
     return '200'
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0')
+    # threaded so that open event streams don't hold up other requests
+    app.run(host='0.0.0.0', threaded=True)
 
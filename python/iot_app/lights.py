@@ -1,26 +1,919 @@
 from yeelight import Bulb, Flow, discover_bulbs, BulbException
+from yeelight import HSVTransition, RGBTransition, TemperatureTransition
 from yeelight.transitions import *
 import threading
 import logging
+import heapq
+import functools
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import struct
+import time
 from os.path import join, dirname
-from collections import Counter
+from urllib.parse import urlparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 
 logs_dir = join(dirname(__file__), 'logs')
 logging.basicConfig(filename=join(logs_dir, 'lights.log'), format='%(asctime)s %(message)s', level=logging.INFO)
 
 
+DEFAULT_REFRESH_INTERVAL = 300  # seconds
+ADVERTISEMENT_MAX_AGE = 3600  # seconds, bulbs advertise the same in Cache-Control
+SSDP_ADDRESS = ('239.255.255.250', 1982)
+
+
 def _initialize_lights():
     logging.info('Initializing lights')
     lights = []
 
     for instance in discover_bulbs():
-        lights.append(Bulb(instance['ip']))
+        lights.append(DiscoveredBulb(instance['ip'], instance['port'], instance.get('capabilities')))
 
     logging.info('Found {} lights'.format(len(lights)))
     return lights
 
 
+class RateLimitExceeded(BulbException):
+    pass
+
+
+class TokenBucket:
+    """Token bucket of capacity tokens refilled at rate tokens per second, one token per bulb command."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        with self.__lock:
+            self.__refill()
+            if self.__tokens >= tokens:
+                self.__tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """Waits until tokens are available. Returns False if that would take longer than timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return True
+                wait = (tokens - self.__tokens) / self.rate
+
+            if deadline is not None:
+                if time.monotonic() + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def remaining(self):
+        with self.__lock:
+            self.__refill()
+            return int(self.__tokens)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+
+class RateGovernor:
+    """A token bucket per bulb, so that every command counts against the same per-minute quota."""
+
+    def __init__(self, requests_per_minute=60, burst=10, wait_timeout=5):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.wait_timeout = wait_timeout
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    def get_sustained_rate(self):
+        """Commands per minute a bulb can be sent indefinitely."""
+        return self.requests_per_minute - self.burst
+
+    def acquire(self, ip, tokens=1):
+        if not self.get_bucket(ip).acquire(tokens, self.wait_timeout):
+            logging.warning('Rate limit exceeded for light {}'.format(ip))
+            raise RateLimitExceeded('Rate limit exceeded for light {}'.format(ip))
+
+    def remaining(self, ip):
+        return self.get_bucket(ip).remaining()
+
+    def get_bucket(self, ip):
+        with self.__lock:
+            bucket = self.__buckets.get(ip)
+            if bucket is None:
+                #  a full bucket plus a minute of refill is never more than requests_per_minute
+                rate = (self.requests_per_minute - self.burst) / 60
+                bucket = self.__buckets[ip] = TokenBucket(self.burst, rate)
+            return bucket
+
+
+_rate_governor = RateGovernor()
+
+
+def get_rate_governor():
+    return _rate_governor
+
+
+class DiscoveredBulb(Bulb):
+    """Bulb handle that keeps its discovery data and sends commands one at a time through the rate governor."""
+
+    def __init__(self, ip, port=55443, discovery_data=None, governor=None, **kwargs):
+        super().__init__(ip, port, **kwargs)
+        self.ip = ip
+        self.port = port
+        self.discovery_data = discovery_data or {}
+        self.governor = governor or get_rate_governor()
+        self.__command_lock = threading.RLock()
+
+    def send_command(self, method, params=None):
+        #  commands sent in music mode are not rate limited by the bulb
+        if not self.music_mode:
+            self.governor.acquire(self.ip)
+
+        #  fades, intents and the state listener share one connection to the bulb
+        with self.__command_lock:
+            return super().send_command(method, params)
+
+    def start_music(self, port=0, **kwargs):
+        #  music mode swaps the connection the other commands are using
+        with self.__command_lock:
+            return super().start_music(port, **kwargs)
+
+    def stop_music(self, **kwargs):
+        with self.__command_lock:
+            return super().stop_music(**kwargs)
+
+
+class MusicModeTransport:
+    """Holds bulbs in music mode, which has no quota, until idle_timeout seconds after the last holder lets go."""
+
+    def __init__(self, idle_timeout=30, port=0):
+        self.idle_timeout = idle_timeout
+        self.port = port
+        self.__holders = {}
+        self.__timers = {}
+        self.__starting = {}
+        self.__lock = threading.Lock()
+
+    def acquire(self, bulb):
+        """Puts bulb into music mode. Returns False if it cannot be used, in which case send as usual."""
+        if not _supports_music(bulb):
+            return False
+
+        waited = False
+        while True:
+            with self.__lock:
+                timer = self.__timers.pop(bulb.ip, None)
+                if timer is not None:
+                    timer.cancel()
+
+                starting = self.__starting.get(bulb.ip)
+                if starting is None:
+                    if bulb.music_mode:
+                        self.__holders[bulb.ip] = self.__holders.get(bulb.ip, 0) + 1
+                        return True
+                    if waited:
+                        #  the caller that was switching it over failed
+                        return False
+                    starting = self.__starting[bulb.ip] = threading.Event()
+                    break
+
+            #  someone else is switching the bulb over, take it once they are done
+            starting.wait()
+            waited = True
+
+        #  switching waits seconds for the bulb to connect back, other bulbs must not wait for that
+        try:
+            bulb.start_music(self.port)
+            logging.info('Light {} switched to music mode'.format(bulb.ip))
+            started = True
+        except (BulbException, OSError) as err:
+            logging.error('Could not start music mode on light {0}: {1}'.format(bulb.ip, err))
+            started = False
+
+        with self.__lock:
+            del self.__starting[bulb.ip]
+            if started:
+                self.__holders[bulb.ip] = self.__holders.get(bulb.ip, 0) + 1
+        starting.set()
+        return started
+
+    def release(self, bulb):
+        with self.__lock:
+            holders = self.__holders.get(bulb.ip, 0) - 1
+            if holders > 0:
+                self.__holders[bulb.ip] = holders
+                return
+
+            self.__holders.pop(bulb.ip, None)
+            timer = self.__timers[bulb.ip] = threading.Timer(self.idle_timeout, self.__expire, [bulb])
+            timer.daemon = True
+            timer.start()
+
+    def close(self, bulb):
+        with self.__lock:
+            self.__holders.pop(bulb.ip, None)
+            timer = self.__timers.pop(bulb.ip, None)
+            if timer is not None:
+                timer.cancel()
+
+        self.__stop_music(bulb)
+
+    def __expire(self, bulb):
+        with self.__lock:
+            if bulb.ip in self.__holders or self.__timers.get(bulb.ip) is None:
+                return
+            del self.__timers[bulb.ip]
+
+        self.__stop_music(bulb)
+
+    def __stop_music(self, bulb):
+        if not bulb.music_mode:
+            return
+        try:
+            bulb.stop_music()
+            logging.info('Light {} left music mode'.format(bulb.ip))
+        except (BulbException, OSError) as err:
+            logging.error('Could not stop music mode on light {0}: {1}'.format(bulb.ip, err))
+
+
+def _supports_music(bulb):
+    return 'set_music' in getattr(bulb, 'discovery_data', {}).get('support', '').split()
+
+
+_music_transport = MusicModeTransport()
+
+
+def get_music_transport():
+    return _music_transport
+
+
+_STATE_PROPS = ['power', 'bright', 'ct', 'rgb', 'hue', 'sat', 'color_mode', 'name']
+
+
+class BulbStateCache:
+    """Latest properties of each watched bulb, kept up to date from the notifications the bulb pushes."""
+
+    RECONNECT_DELAY = 5  # seconds
+    MAX_RECONNECT_DELAY = 60
+
+    def __init__(self):
+        self.__states = {}
+        self.__live = set()
+        self.__watchers = {}
+        self.__subscribers = {}
+        self.__lock = threading.Lock()
+
+    def watch(self, bulb):
+        with self.__lock:
+            if bulb.ip in self.__watchers:
+                return
+            stopped = self.__watchers[bulb.ip] = threading.Event()
+
+        thread = threading.Thread(
+            target=self.__listen, args=(bulb, stopped), name='bulb-state-{}'.format(bulb.ip), daemon=True)
+        thread.start()
+
+    def unwatch(self, bulb):
+        with self.__lock:
+            stopped = self.__watchers.pop(bulb.ip, None)
+            self.__live.discard(bulb.ip)
+            self.__states.pop(bulb.ip, None)
+
+        if stopped is not None:
+            stopped.set()
+
+    def is_live(self, bulb):
+        with self.__lock:
+            return getattr(bulb, 'ip', None) in self.__live
+
+    def get_properties(self, bulb, keys):
+        """Returns the cached values of keys, or None if they are not known to be current."""
+        with self.__lock:
+            if getattr(bulb, 'ip', None) not in self.__live:
+                return None
+
+            state = self.__states.get(bulb.ip, {})
+            if any(key not in state for key in keys):
+                return None
+            return {key: state[key] for key in keys}
+
+    def update(self, bulb, props):
+        with self.__lock:
+            self.__states.setdefault(bulb.ip, {}).update({key: str(value) for key, value in props.items()})
+            subscribers = list(self.__subscribers.get(bulb.ip, []))
+
+        for callback in subscribers:
+            try:
+                callback(bulb, props)
+            except Exception as err:
+                logging.error('Light state subscriber failed: {}'.format(err))
+
+    def subscribe(self, bulb, callback):
+        with self.__lock:
+            self.__subscribers.setdefault(bulb.ip, []).append(callback)
+
+    def unsubscribe(self, bulb, callback):
+        with self.__lock:
+            subscribers = self.__subscribers.get(bulb.ip, [])
+            if callback in subscribers:
+                subscribers.remove(callback)
+
+    def __set_live(self, bulb, live):
+        with self.__lock:
+            if live and bulb.ip in self.__watchers:
+                self.__live.add(bulb.ip)
+            else:
+                self.__live.discard(bulb.ip)
+
+    def __listen(self, bulb, stopped):
+        delay = self.RECONNECT_DELAY
+
+        while not stopped.is_set():
+            try:
+                with socket.create_connection((bulb.ip, bulb.port), timeout=5) as connection:
+                    #  notifications missed while disconnected are lost, start from a fresh snapshot
+                    self.update(bulb, bulb.get_properties(_STATE_PROPS))
+                    self.__set_live(bulb, True)
+                    delay = self.RECONNECT_DELAY
+                    self.__read_notifications(bulb, connection, stopped)
+            except (OSError, BulbException) as err:
+                logging.warning('Lost state updates from light {0}: {1}'.format(bulb.ip, err))
+
+            self.__set_live(bulb, False)
+            stopped.wait(delay)
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def __read_notifications(self, bulb, connection, stopped):
+        connection.settimeout(1)
+        buffer = b''
+
+        while not stopped.is_set():
+            try:
+                data = connection.recv(16 * 1024)
+            except socket.timeout:
+                continue
+
+            if not data:
+                logging.warning('Light {} closed the state connection'.format(bulb.ip))
+                return
+
+            *lines, buffer = (buffer + data).split(b'\r\n')
+            for line in lines:
+                try:
+                    message = json.loads(line.decode('utf8'))
+                except ValueError:
+                    continue
+                if message.get('method') == 'props':
+                    self.update(bulb, message.get('params', {}))
+
+
+def _read_properties(bulb, keys, state_cache=None):
+    props = state_cache.get_properties(bulb, keys) if state_cache is not None else None
+    if props is None:
+        #  yeelight returns every property it last saw, not only the ones asked for
+        props = bulb.get_properties(keys)
+        props = {key: props.get(key) for key in keys}
+    return props
+
+
+class BulbUnavailable(BulbException):
+    """The command was not sent, the bulb has stopped responding and is waiting to be probed."""
+
+
+class BulbHealth:
+    """Circuit breaker per bulb, opened after failure_threshold unreachable commands and closed by a probe."""
+
+    FAILURE_THRESHOLD = 2
+    BASE_BACKOFF = 5  # seconds
+    MAX_BACKOFF = 300
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, base_backoff=BASE_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.__failures = {}
+        self.__open = {}
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__thread = None
+
+    def is_available(self, bulb):
+        with self.__lock:
+            return getattr(bulb, 'ip', None) not in self.__open
+
+    def get_unavailable(self):
+        with self.__lock:
+            return [bulb for bulb, _, _ in self.__open.values()]
+
+    def get_retry_delay(self, bulb):
+        """Seconds until the bulb is next probed, 0 if it is available."""
+        with self.__lock:
+            circuit = self.__open.get(getattr(bulb, 'ip', None))
+            return max(0.0, circuit[1] - time.monotonic()) if circuit is not None else 0.0
+
+    def record(self, bulb, error=None):
+        """Counts the outcome of a command sent to the bulb, ignoring errors that say nothing of its reachability."""
+        if error is None or _is_error_response(error):
+            self.__close(bulb)
+        elif _is_unreachable(error):
+            self.__fail(bulb)
+
+    def __close(self, bulb):
+        with self.__lock:
+            self.__failures.pop(bulb.ip, None)
+            circuit = self.__open.pop(bulb.ip, None)
+
+        if circuit is not None:
+            logging.info('Light {} is responding again'.format(bulb.ip))
+
+    def __fail(self, bulb):
+        with self.__lock:
+            failures = self.__failures[bulb.ip] = self.__failures.get(bulb.ip, 0) + 1
+            if bulb.ip in self.__open or failures < self.failure_threshold:
+                return
+            self.__trip(bulb, 1)
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__probe_periodically, name='bulb-health', daemon=True)
+                self.__thread.start()
+
+    def __trip(self, bulb, attempt):
+        delay = _get_backoff(attempt, self.base_backoff, self.max_backoff)
+        self.__open[bulb.ip] = (bulb, time.monotonic() + delay, attempt)
+        self.__changed.notify()
+        logging.warning('Light {0} is not responding, skipping it for {1:.0f} seconds'.format(bulb.ip, delay))
+
+    def __next_due(self):
+        with self.__changed:
+            while True:
+                if self.__open:
+                    bulb, due, attempt = min(self.__open.values(), key=lambda circuit: circuit[1])
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        return bulb, attempt
+                    self.__changed.wait(delay)
+                else:
+                    self.__changed.wait()
+
+    def __probe_periodically(self):
+        while True:
+            bulb, attempt = self.__next_due()
+            try:
+                bulb.get_properties(['power'])
+            except Exception as err:
+                #  there is only one probe thread, it has to outlive anything a bulb throws
+                if isinstance(err, (BulbException, OSError)):
+                    logging.info('Probe of light {0} failed: {1}'.format(bulb.ip, err))
+                else:
+                    logging.exception('Probe of light {} failed unexpectedly'.format(bulb.ip))
+                with self.__lock:
+                    if bulb.ip in self.__open:
+                        self.__trip(bulb, attempt + 1)
+                continue
+            self.__close(bulb)
+
+
+def _is_error_response(error):
+    #  the bulb's own error responses carry its {'code': ..., 'message': ...} reply
+    return isinstance(error, BulbException) and bool(error.args) and isinstance(error.args[0], dict)
+
+
+def _is_unreachable(error):
+    if isinstance(error, (BulbUnavailable, RateLimitExceeded, DeadlineExceeded)):
+        return False
+    return isinstance(error, (BulbException, OSError)) and not _is_error_response(error)
+
+
+RETRY_BACKOFF = 2  # seconds
+MAX_RETRY_BACKOFF = 60
+
+
+def _get_backoff(attempt, base=RETRY_BACKOFF, cap=MAX_RETRY_BACKOFF):
+    """Exponential backoff with jitter, between half and all of base * 2 ** (attempt - 1) but no more than cap."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class BulbRegistry:
+    """Process-wide inventory of bulbs, indexed by IP and name, kept up to date by scans and advertisements."""
+
+    def __init__(self, refresh_interval=DEFAULT_REFRESH_INTERVAL, listen=False, snapshot_path=None):
+        self.__refresh_interval = refresh_interval
+        self.__snapshot_path = snapshot_path
+        self.__lights = {}
+        self.__names = {}
+        self.__reported_names = {}
+        self.__seen = {}
+        self.__state_cache = BulbStateCache()
+        self.__health = BulbHealth()
+        self.__listener = AdvertisementListener(self) if listen else None
+        self.__lock = threading.Lock()
+        self.__snapshot_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__listener is not None:
+            #  listen first, so nothing advertised during the scan is missed
+            self.__listener.start()
+
+        if self.__load_snapshot():
+            threading.Thread(target=self.__validate_snapshot, name='bulb-registry-scan', daemon=True).start()
+        else:
+            self.refresh()
+
+        if self.__refresh_interval and self.__thread is None:
+            self.__thread = threading.Thread(target=self.__refresh_periodically, name='bulb-registry', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__listener is not None:
+            self.__listener.stop()
+
+    def refresh(self):
+        """Runs a full discovery scan, which blocks for its whole timeout, and drops known bulbs it did not find."""
+        found = set()
+        for bulb in _initialize_lights():
+            found.add(self.update(bulb, ADVERTISEMENT_MAX_AGE).ip)
+
+        for bulb in self.get_all_lights():
+            if bulb.ip not in found:
+                self.remove(bulb)
+
+    def update(self, bulb, max_age=None):
+        """
+        Adds a discovered bulb, or refreshes the one known at its IP, or by its id if it has
+        moved to a new IP. A handle for another port or another bulb at the same IP is replaced.
+        Returns the handle kept for it. Unless max_age is None the bulb is dropped by expire once
+        max_age seconds pass without it being seen again.
+        """
+        discovery_data = getattr(bulb, 'discovery_data', None) or {}
+        bulb_id = discovery_data.get('id')
+
+        with self.__lock:
+            handle = self.__lights.get(bulb.ip)
+            replaced = None
+            if handle is not None and (getattr(handle, 'port', None) != getattr(bulb, 'port', None)
+                                       or bulb_id is not None and _get_id(handle) not in (None, bulb_id)):
+                replaced, handle = handle, None
+            moved = None
+            if handle is None and bulb_id is not None:
+                moved = next((known for known in self.__lights.values()
+                              if _get_id(known) == bulb_id and known is not replaced), None)
+
+        if replaced is not None:
+            self.remove(replaced)
+
+        with self.__lock:
+            self.__seen[bulb.ip] = (time.monotonic(), max_age)
+
+        if handle is not None:
+            #  bulbs advertise every few minutes, the snapshot is only written when it would change
+            known = getattr(handle, 'discovery_data', None) or {}
+            changed = discovery_data and any(discovery_data.get(key) != known.get(key)
+                                             for key in _SNAPSHOT_DATA if key != 'name')
+            if discovery_data:
+                handle.discovery_data = discovery_data
+            name = discovery_data.get('name')
+            if name and name.lower() != self.get_name(handle):
+                self.update_name(handle, name)
+            if changed:
+                self.__save_snapshot()
+            return handle
+
+        if moved is not None:
+            logging.info('Light {0} moved to {1}'.format(moved.ip, bulb.ip))
+            self.remove(moved)
+
+        #  an unresponsive bulb keeps its name rather than holding up discovery
+        name = _get_discovered_name(bulb) if self.__health.is_available(bulb) else None
+        with self.__lock:
+            self.__lights[bulb.ip] = bulb
+            if name:
+                self.__names[name.upper()] = bulb.ip
+            self.__reported_names[bulb.ip] = _get_reported_name(bulb)
+
+        logging.info('Found light {0} ({1})'.format(bulb.ip, name))
+        self.__watch(bulb)
+        self.__save_snapshot()
+        return bulb
+
+    def __watch(self, bulb):
+        if getattr(bulb, 'port', None) is not None:
+            self.__state_cache.subscribe(bulb, self.__on_state_change)
+            self.__state_cache.watch(bulb)
+
+    def remove(self, bulb):
+        with self.__lock:
+            if self.__lights.get(bulb.ip) is not bulb:
+                return
+            del self.__lights[bulb.ip]
+            for key, ip in list(self.__names.items()):
+                if ip == bulb.ip:
+                    del self.__names[key]
+            self.__reported_names.pop(bulb.ip, None)
+            self.__seen.pop(bulb.ip, None)
+
+        logging.info('Lost light {}'.format(bulb.ip))
+        self.__state_cache.unwatch(bulb)
+        self.__state_cache.unsubscribe(bulb, self.__on_state_change)
+        self.__save_snapshot()
+
+    def expire(self):
+        """
+        Drops bulbs that have not been seen for longer than their max-age. A bulb with a live
+        state connection is still there, whether or not it keeps advertising.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            expired = [self.__lights[ip] for ip, (seen, max_age) in self.__seen.items()
+                       if max_age is not None and now - seen > max_age and ip in self.__lights]
+
+        for bulb in expired:
+            if not self.__state_cache.is_live(bulb):
+                self.remove(bulb)
+
+    def __load_snapshot(self):
+        """Adds the bulbs from the saved snapshot, if there is one. Returns whether any were added."""
+        if self.__snapshot_path is None:
+            return False
+        try:
+            entries = _read_snapshot(self.__snapshot_path)
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logging.error('Could not read light snapshot {0}: {1}'.format(self.__snapshot_path, err))
+            return False
+
+        #  last seen times are saved as wall clock times, but compared on the monotonic clock
+        now = time.monotonic()
+        offset = now - time.time()
+        bulbs = []
+        with self.__lock:
+            for entry in entries:
+                discovery_data = {key: entry[key] for key in _SNAPSHOT_DATA if entry.get(key)}
+                bulb = DiscoveredBulb(entry['ip'], entry['port'], discovery_data)
+                self.__lights[bulb.ip] = bulb
+                if entry.get('name'):
+                    self.__names[entry['name'].upper()] = bulb.ip
+                #  a bulb gets a full max-age from now to show up, however old the snapshot
+                seen = min(entry['last_seen'] + offset, now) if entry.get('last_seen') is not None else now
+                self.__seen[bulb.ip] = (seen, now - seen + ADVERTISEMENT_MAX_AGE)
+                bulbs.append(bulb)
+
+        logging.info('Loaded {} lights from snapshot'.format(len(bulbs)))
+        for bulb in bulbs:
+            self.__watch(bulb)
+        return len(bulbs) > 0
+
+    def __validate_snapshot(self):
+        #  only adds and updates bulbs, a scan at boot often misses bulbs before the network settles;
+        #  bulbs that are really gone expire or trip their circuit
+        try:
+            for bulb in _initialize_lights():
+                self.update(bulb, ADVERTISEMENT_MAX_AGE)
+        except Exception as err:
+            logging.error('Checking light snapshot failed: {}'.format(err))
+
+    def __save_snapshot(self):
+        if self.__snapshot_path is None:
+            return
+
+        offset = time.time() - time.monotonic()
+        with self.__snapshot_lock:
+            with self.__lock:
+                names = {ip: key.lower() for key, ip in self.__names.items()}
+                entries = []
+                for ip, bulb in self.__lights.items():
+                    discovery_data = getattr(bulb, 'discovery_data', None) or {}
+                    seen = self.__seen.get(ip)
+                    entry = {'ip': ip, 'port': getattr(bulb, 'port', None), 'name': names.get(ip),
+                             'last_seen': seen[0] + offset if seen is not None else None}
+                    entry.update({key: discovery_data.get(key) for key in _SNAPSHOT_DATA if key != 'name'})
+                    entries.append(entry)
+
+            try:
+                _write_snapshot(self.__snapshot_path, entries)
+            except OSError as err:
+                logging.error('Could not save light snapshot {0}: {1}'.format(self.__snapshot_path, err))
+
+    def get_state_cache(self):
+        return self.__state_cache
+
+    def get_health(self):
+        return self.__health
+
+    def get_all_lights(self):
+        with self.__lock:
+            return list(self.__lights.values())
+
+    def get_light_by_name(self, name):
+        key = name.upper()
+
+        with self.__lock:
+            ip = self.__names.get(key)
+            if ip is None:
+                return None
+
+            bulb = self.__lights.get(ip)
+            if bulb is None:
+                logging.info('Evicting stale light name: {}'.format(name))
+                del self.__names[key]
+                return None
+
+        #  the bulb may have reported a new name since it was indexed
+        reported_name = _get_reported_name(bulb)
+        if reported_name is not None and reported_name != self.__reported_names.get(ip):
+            self.update_name(bulb, reported_name)
+            if reported_name.upper() != key:
+                logging.info('Evicting stale light name: {}'.format(name))
+                return None
+
+        return bulb
+
+    def get_name(self, bulb):
+        with self.__lock:
+            for key, ip in self.__names.items():
+                if ip == bulb.ip:
+                    return key.lower()
+        return None
+
+    def update_name(self, bulb, name):
+        with self.__lock:
+            for key, ip in list(self.__names.items()):
+                if ip == bulb.ip:
+                    del self.__names[key]
+            if name:
+                self.__names[name.upper()] = bulb.ip
+            self.__reported_names[bulb.ip] = _get_reported_name(bulb)
+        self.__save_snapshot()
+
+    def __on_state_change(self, bulb, props):
+        if 'name' in props:
+            logging.info('Light {0} renamed to {1}'.format(bulb.ip, props['name']))
+            self.update_name(bulb, props['name'])
+
+    def __refresh_periodically(self):
+        while not self.__stopped.wait(self.__refresh_interval):
+            try:
+                self.refresh()
+            except Exception as err:
+                #  keep the last known inventory, discovery is retried next interval
+                logging.error('Refreshing lights failed: {}'.format(err))
+
+
+def _get_discovered_name(bulb):
+    discovery_data = getattr(bulb, 'discovery_data', {})
+    if 'name' in discovery_data:
+        return discovery_data['name']
+
+    #  not every bulb advertises its name, ask for it once when indexing
+    try:
+        return bulb.get_properties(['name']).get('name')
+    except BulbException as err:
+        logging.error('Could not read name of light {0}: {1}'.format(bulb.ip, err))
+        return None
+
+
+def _get_reported_name(bulb):
+    #  yeelight keeps the properties it last saw, including pushed name changes
+    return getattr(bulb, 'last_properties', {}).get('name')
+
+
+_SNAPSHOT_DATA = ('id', 'model', 'name', 'support')
+
+
+def _read_snapshot(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as snapshot:
+        return [entry for entry in json.load(snapshot)['lights'] if entry.get('port') is not None]
+
+
+def _write_snapshot(path, entries):
+    """Replaces the snapshot in one rename, so a crash never leaves half of it behind."""
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as snapshot:
+        json.dump({'lights': entries}, snapshot, separators=(',', ':'))
+    os.replace(temporary, path)
+
+
+def _get_id(bulb):
+    return (getattr(bulb, 'discovery_data', None) or {}).get('id')
+
+
+def _parse_advertisement(data):
+    """
+    Returns (bulb, max_age) for a NOTIFY advertisement of a Yeelight bulb, None for anything else.
+    Headers are read as yeelight's discover_bulbs reads search responses.
+    """
+    try:
+        lines = data.decode('utf8').split('\r\n')
+    except UnicodeDecodeError:
+        return None
+    if not lines[0].startswith('NOTIFY'):
+        return None
+
+    headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+    location = urlparse(headers.get('Location', ''))
+    if location.scheme != 'yeelight' or not location.hostname or headers.get('NTS', 'ssdp:alive') != 'ssdp:alive':
+        return None
+
+    max_age = ADVERTISEMENT_MAX_AGE
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name == 'max-age' and value.isdigit():
+            max_age = int(value)
+
+    capabilities = {key: value for key, value in headers.items() if key.islower()}
+    return DiscoveredBulb(location.hostname, location.port or 55443, capabilities), max_age
+
+
+class AdvertisementListener:
+    """Feeds the NOTIFY advertisements bulbs multicast into a registry and expires bulbs that go silent."""
+
+    EXPIRE_INTERVAL = 5  # seconds
+
+    def __init__(self, registry, interface='0.0.0.0'):
+        self.registry = registry
+        self.interface = interface
+        self.__socket = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', SSDP_ADDRESS[1]))
+        membership = struct.pack('4s4s', socket.inet_aton(SSDP_ADDRESS[0]), socket.inet_aton(self.interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.settimeout(self.EXPIRE_INTERVAL)
+
+        self.__socket = sock
+        threading.Thread(target=self.__listen, args=(sock,), name='bulb-advertisements', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __listen(self, sock):
+        last_expired = time.monotonic()
+
+        while True:
+            try:
+                data, _ = sock.recvfrom(65507)
+            except socket.timeout:
+                data = None
+            except OSError:
+                return
+
+            advertisement = _parse_advertisement(data) if data else None
+            try:
+                if advertisement is not None:
+                    self.registry.update(*advertisement)
+                if time.monotonic() - last_expired >= self.EXPIRE_INTERVAL:
+                    last_expired = time.monotonic()
+                    self.registry.expire()
+            except Exception as err:
+                #  one bad advertisement must not stop the listener
+                logging.error('Handling light advertisement failed: {}'.format(err))
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(refresh_interval=None, snapshot_path=None):
+    """
+    Returns the process-wide registry, discovering bulbs on first use, or loading them from the
+    snapshot at snapshot_path if there is one, and then following their advertisements. Full
+    scans are repeated every refresh_interval seconds if given, else on demand.
+    """
+    global _registry
+
+    with _registry_lock:
+        if _registry is None:
+            _registry = BulbRegistry(refresh_interval, listen=True, snapshot_path=snapshot_path)
+            _registry.start()
+        return _registry
+
+
 class Room:
     BEDROOM = 'BEDROOM'
     LOUNGE = 'LOUNGE'
@@ -36,19 +929,25 @@ class NotificationLevel:
 
 class LightManager:
 
-    def __init__(self, default_room=Room.LOUNGE):
-        self.__lights = _initialize_lights()
+    def __init__(self, default_room=Room.LOUNGE, registry=None, scheduler=None, transport=None):
+        if registry is None:
+            registry = BulbRegistry(refresh_interval=None)
+            registry.start()
+
+        self.__registry = registry
+        self.__scheduler = scheduler or get_fade_scheduler()
+        self.__transport = transport or get_music_transport()
         self.__default_room = default_room
         self.__default = self.get_light_by_name(default_room)
 
     def get_light_by_name(self, name):
-        for light in self.__lights:
-            if light.get_properties(['name']).get('name').upper() == name.upper():
-                return light
+        return self.__registry.get_light_by_name(name)
 
-        return None
+    def is_available(self, bulb):
+        """False while the bulb is skipped for not responding."""
+        return self.__registry.get_health().is_available(bulb)
 
-    def start_disco(self, *bulbs):
+    def start_disco(self, *bulbs, music=False, deadline=None):
         logging.info('Starting disco')
 
         flow = Flow(count=0, transitions=disco())
@@ -56,10 +955,10 @@ class LightManager:
         if len(bulbs) == 0:
             bulbs = [self.__default]
 
-        for bulb in bulbs:
-            bulb.start_flow(flow)
+        self.__cancel_fades(bulbs)
+        return self.__fan_out(lambda bulb: self.__start_flow(bulb, flow, music), bulbs, deadline)
 
-    def notify(self, level=NotificationLevel.INFO, *bulbs):
+    def notify(self, level=NotificationLevel.INFO, *bulbs, music=False, deadline=None):
         logging.info('Flashing notification ({})'.format(level))
 
         red, green, blue = level
@@ -68,64 +967,122 @@ class LightManager:
         if len(bulbs) == 0:
             bulbs = [self.__default]
 
-        for bulb in bulbs:
-            bulb.start_flow(flow)
+        self.__cancel_fades(bulbs)
+        return self.__fan_out(lambda bulb: self.__start_flow(bulb, flow, music), bulbs, deadline)
+
+    def __start_flow(self, bulb, flow, music):
+        if not (music and self.__transport.acquire(bulb)):
+            return bulb.start_flow(flow)
+
+        try:
+            return bulb.start_flow(flow)
+        finally:
+            self.__transport.release(bulb)
 
-    def stop_flow(self, *bulbs):
+    def stop_flow(self, *bulbs, deadline=None):
         logging.info('Stopping flow')
 
         if len(bulbs) == 0:
             bulbs = [self.__default]
 
+        self.__cancel_fades(bulbs)
+        return self.__fan_out(lambda bulb: bulb.stop_flow(), bulbs, deadline)
+
+    def __cancel_fades(self, bulbs):
+        #  a new or stopped flow ends any fade on the bulb, which must not be stopped again later
         for bulb in bulbs:
-            bulb.stop_flow()
+            for fade in self.__scheduler.cancel_bulb(bulb):
+                logging.info('Cancelled fade {}'.format(fade.id))
+                fade.detach()
 
     def set_default(self, name):
         # TODO default room should be stored in database, not in an instance variable
         light = self.get_light_by_name(name)
         if light is not None:
             self.__default_room = name
-            self.__default = self.get_light_by_name(name)
+            self.__default = light
             logging.info('Set new default light to {}'.format(name))
         else:
             logging.warning('Default not set. No such light: '.format(name))
 
     def get_all_lights(self):
-        return self.__lights
+        return self.__registry.get_all_lights()
+
+    def get_light_name(self, bulb):
+        return self.__registry.get_name(bulb) or bulb.ip
 
     def get_default_room(self):
         return self.__default_room
 
-    def stop_fade(self, *bulbs):
+    def stop_fade(self, *bulbs, deadline=None):
         logging.info('Aborting fade on user request')
-        
+
         if len(bulbs) == 0:
             bulbs = [self.__default]
-        
-        #  fade effect is aborted if any change is made on the bulb
 
-        for bulb in bulbs: 
-            current_brightness = int(bulb.get_properties(['bright'])['bright']) 
-            bulb.set_brightness(current_brightness + 1)
+        #  cancelling is local, so it happens for bulbs that are not responding too;
+        #  only fades the bulb runs itself need a command to stop
+        native_fades = {}
+        for bulb in bulbs:
+            for fade in self.__scheduler.cancel_bulb(bulb):
+                logging.info('Cancelled fade {}'.format(fade.id))
+                if isinstance(fade, NativeFade):
+                    native_fades.setdefault(id(bulb), []).append(fade)
+                else:
+                    fade.stop()
 
-    def fade(self, duration, turn_off=False, retries=5, *bulbs):
-        logging.info('Fade started. Duration = {0}, turn_off={1}'.format(duration, turn_off))
+        def stop(bulb):
+            for fade in native_fades[id(bulb)]:
+                fade.stop()
 
-        max_requests_per_minute = 60
-        bulb_calls_per_step = 2
-        error_margin = 2
-        max_steps_per_minute = (max_requests_per_minute / bulb_calls_per_step) - error_margin
+        stopping = [bulb for bulb in bulbs if id(bulb) in native_fades]
+        results = {id(result.bulb): result for result in self.__fan_out(stop, stopping, deadline)}
+        return [results.get(id(bulb), BulbResult(bulb, None, None)) for bulb in bulbs]
 
-        min_interval = 1 #  second
-        max_steps = _get_max_steps(duration, max_steps_per_minute)
+    def fade(self, duration, turn_off=False, retries=5, *bulbs, native=True, music=False, deadline=None):
+        """
+        Dims bulbs down to the lowest brightness over duration seconds.
+
+        Bulbs that support colour flows run the whole fade themselves from a single
+        command. Other bulbs, or any bulb when native is False, are dimmed step by
+        step from the fade scheduler. With music set, stepped fades go through music
+        mode where the bulb allows it, and step one brightness level at a time.
+        """
+        logging.info('Fade started. Duration = {0}, turn_off={1}'.format(duration, turn_off))
+
+        min_interval = 1  # second
+        state_cache = self.__registry.get_state_cache()
+        health = self.__registry.get_health()
 
         if len(bulbs) == 0:
             bulbs = [self.__default]
 
-        for bulb in bulbs:
-            current_props = bulb.get_properties(_get_required_props())
+        def start(bulb):
+            if native and _supports_flow(bulb):
+                fade = NativeFade(bulb, duration, turn_off, state_cache)
+                if fade.start():
+                    fade.attach(self.__scheduler)
+                    self.__scheduler.add(fade, duration)
+                    return fade
+                return None
+
+            current_props = _read_properties(bulb, _get_required_props(), state_cache)
             initial_brightness = int(current_props['bright'])
 
+            if music and self.__transport.acquire(bulb):
+                #  no quota in music mode, the step size is only limited by the brightness levels
+                interval = max(MIN_MUSIC_INTERVAL, duration / initial_brightness)
+                step = initial_brightness * interval / duration
+
+                fade = Fade(bulb, interval, step, initial_brightness, current_props, turn_off, retries,
+                            state_cache=state_cache, transport=self.__transport, health=health)
+                fade.attach(self.__scheduler)
+                self.__scheduler.add(fade)
+                return fade
+
+            max_steps_per_minute = _get_max_steps_per_minute(_get_calls_per_step(bulb, state_cache))
+            max_steps = _get_max_steps(duration, max_steps_per_minute)
+
             if duration <= max_steps_per_minute:
                 interval = min_interval
                 step = initial_brightness / duration
@@ -135,64 +1092,666 @@ class LightManager:
 
             logging.info('Interval set to {}'.format(interval))
 
-            _fade(bulb, interval, step, initial_brightness, current_props, turn_off, retries)
+            fade = Fade(bulb, interval, step, initial_brightness, current_props, turn_off, retries,
+                        state_cache=state_cache, health=health)
+            fade.attach(self.__scheduler)
+            self.__scheduler.add(fade)
+            return fade
+
+        return self.__fan_out(start, bulbs, deadline)
+
+    def get_active_fades(self):
+        return self.__scheduler.get_fades()
+
+    def __fan_out(self, action, bulbs, deadline):
+        return _fan_out(action, bulbs, deadline=deadline, health=self.__registry.get_health())
+
+
+class Fade:
+    """A fade stepped from the scheduler, cancelled when the bulb reports a change it did not make."""
+
+    def __init__(self, bulb, interval, step, brightness, props, turn_off, retries, state_cache=None, transport=None,
+                 health=None):
+        self.id = next(_fade_ids)
+        self.bulb = bulb
+        self.interval = interval
+        self.step = step
+        self.brightness = brightness
+        self.props = props
+        self.turn_off = turn_off
+        self.retries = retries
+        self.state_cache = state_cache
+        self.transport = transport
+        self.health = health
+        self.__attempts = 0
+        self.due = None
+        self.__pending_brightness = None
+        self.__scheduler = None
+
+    def attach(self, scheduler):
+        """Lets the fade cancel itself in scheduler when someone else changes the bulb."""
+        self.__scheduler = scheduler
+        if self.state_cache is not None:
+            self.state_cache.subscribe(self.bulb, self.__on_state_change)
+
+    def detach(self):
+        if self.state_cache is not None:
+            self.state_cache.unsubscribe(self.bulb, self.__on_state_change)
+        if self.transport is not None:
+            self.transport.release(self.bulb)
+            self.transport = None
+
+    def run_step(self):
+        """Runs one fade step. Returns the delay until the next step, or None when the fade is over."""
+        delay = self.__run_step()
+        if delay is None:
+            self.detach()
+        return delay
 
+    def stop(self):
+        #  cancelling the scheduled steps is enough
+        self.detach()
 
-def _fade(bulb, interval, step, brightness, props, turn_off, retries, retry_delay=15):
-        error_msg = 'Error occurred in __fade: {}'
-        
-        # if another request was made, abort task 
+    def __run_step(self):
+        error_msg = 'Error occurred in fade step: {}'
+
+        music_mode = getattr(self.bulb, 'music_mode', False)
+
+        remaining = _get_remaining_budget(self.bulb)
+        if not music_mode and remaining is not None \
+                and remaining < _get_calls_per_step(self.bulb, self.state_cache):
+            #  leave the budget to other requests, try again next interval
+            logging.info('Not enough budget for fade step. Postponing.')
+            return self.interval
+
+        if self.health is not None and not self.health.is_available(self.bulb):
+            logging.info('Light is not responding. Postponing fade step.')
+            return self.__retry()
+
+        # if another request was made, abort task
         try:
-            current_bulb_props = bulb.get_properties(_get_required_props())
-            current = [str(x) for x in current_bulb_props.values()]
-            previous = [str(x) for x in props.values()] 
-
-            #  brightness may come as str or int
-            #  hence the below is necessary   
-            if Counter(current) != Counter(previous) or round(brightness) != int(current_bulb_props['bright']):
-                logging.info('Another request was made. Aborting fade.')
-                return
+            if music_mode and not (self.state_cache is not None and self.state_cache.is_live(self.bulb)):
+                #  a bulb in music mode does not answer, only pushed notifications can tell
+                current_bulb_props = None
+            else:
+                current_bulb_props = _read_properties(self.bulb, _get_required_props(), self.state_cache)
+
+            if current_bulb_props is not None:
+                #  compare the same keys whether they came from the cache or the bulb
+                keys = _get_required_props()
+                current = [str(current_bulb_props.get(key)) for key in keys]
+                previous = [str(self.props.get(key)) for key in keys]
+
+                #  brightness may come as str or int
+                #  hence the below is necessary
+                if current != previous \
+                        or round(self.brightness) != int(current_bulb_props['bright']):
+                    logging.info('Another request was made. Aborting fade.')
+                    return None
         except BulbException as err:
             #  BulbException is fine - connection could be temporarily down
             logging.error(error_msg.format(err))
-            if retries > 0:
-                logging.info('Retrying. Attempts left: {}'.format(retries))
-                threading.Timer(
-                    retry_delay, _fade, [bulb, interval, step, brightness, props, turn_off, retries-1]).start()
-                return
+            self.__record(err)
+            if self.retries > 0:
+                return self.__retry()
 
-        power = props['power']
-
-        if power == 'off':
-            return
-        if brightness <= 1:
+        if self.props['power'] == 'off':
+            return None
+        if self.brightness <= 1:
             logging.info('Finished fading')
-            if turn_off:
-                bulb.turn_off()
-            return
+            if self.turn_off:
+                self.detach()
+                self.bulb.turn_off()
+            return None
 
-        new_brightness = max(1, brightness - step)
-        updated_brightness = False
+        #  the bulb only takes whole levels, so track the level it will report back
+        new_brightness = max(1, round(self.brightness - self.step))
+        self.__pending_brightness = new_brightness
         try:
-            bulb.set_brightness(new_brightness)
-            updated_brightness = True
-            props['bright'] = str(round(new_brightness))
-            
-            logging.info('Fade step. New brightness: {}'.format(new_brightness))
-            threading.Timer(interval, _fade, [bulb, interval, step, new_brightness, props, turn_off, retries]).start()
+            self.bulb.set_brightness(new_brightness)
         except BulbException as err:
             logging.error(error_msg.format(err))
+            self.__record(err)
+            return self.__retry()
+        finally:
+            self.__pending_brightness = None
+
+        self.__record(None)
+        self.__attempts = 0
+        self.brightness = new_brightness
+        self.props['bright'] = str(new_brightness)
+        logging.info('Fade step. New brightness: {}'.format(new_brightness))
+        return self.interval
+
+    def __retry(self):
+        """Returns the delay before retrying a failed step, or None once out of retries."""
+        if self.retries <= 0:
+            return None
+        logging.info('Retrying. Attempts left: {}'.format(self.retries))
+        self.retries -= 1
+        self.__attempts += 1
+
+        if self.health is not None and not self.health.is_available(self.bulb):
+            #  no use trying before the bulb has answered a probe
+            return max(self.interval, self.health.get_retry_delay(self.bulb))
+        return _get_backoff(self.__attempts)
+
+    def __record(self, error):
+        if self.health is not None:
+            self.health.record(self.bulb, error)
+
+    def __on_state_change(self, bulb, props):
+        if not self.__is_foreign_change(props):
+            return
+
+        logging.info('Another request was made. Aborting fade.')
+        self.detach()
+        if self.__scheduler is not None:
+            self.__scheduler.cancel(self.id)
+
+    def __is_foreign_change(self, props):
+        for key, value in props.items():
+            if key not in self.props:
+                continue
+            if key == 'bright':
+                if int(value) not in (round(self.brightness), self.__pending_brightness):
+                    return True
+            elif str(value) != str(self.props[key]):
+                return True
+        return False
+
+
+class NativeFade:
+    """A fade the bulb runs itself as a colour flow, kept in the scheduler until it is due to end."""
+
+    MAX_TRANSITION_DURATION = 30 * 60  # seconds
+
+    def __init__(self, bulb, duration, turn_off, state_cache=None):
+        self.id = next(_fade_ids)
+        self.bulb = bulb
+        self.duration = duration
+        self.turn_off = turn_off
+        self.state_cache = state_cache
+        self.due = None
+        self.__scheduler = None
+        self.__flow_ended = False
+
+    def attach(self, scheduler):
+        """Lets the fade cancel itself in scheduler when the bulb reports its flow has ended early."""
+        self.__scheduler = scheduler
+        if self.state_cache is not None:
+            self.state_cache.subscribe(self.bulb, self.__on_state_change)
+
+    def detach(self):
+        if self.state_cache is not None:
+            self.state_cache.unsubscribe(self.bulb, self.__on_state_change)
+
+    def start(self):
+        keys = _get_required_props() + ['color_mode', 'hue', 'sat']
+        props = _read_properties(self.bulb, keys, self.state_cache)
+        if props['power'] == 'off':
+            return False
+
+        self.bulb.start_flow(_get_fade_flow(props, self.duration, self.turn_off, self.MAX_TRANSITION_DURATION))
+        return True
+
+    def run_step(self):
+        logging.info('Finished fading')
+        self.detach()
+        return None
+
+    def stop(self):
+        self.detach()
+        #  once the flow has ended, stopping it again would stop whatever the bulb runs now
+        if not self.__flow_ended:
+            self.bulb.stop_flow()
+
+    def __on_state_change(self, bulb, props):
+        if str(props.get('flowing')) != '0' and props.get('power') != 'off':
+            return
+
+        logging.info('Light stopped the fade flow. Dropping fade.')
+        self.__flow_ended = True
+        if self.__scheduler is not None:
+            self.__scheduler.cancel(self.id)
+
+
+def _get_fade_flow(props, duration, turn_off, max_transition_duration):
+    brightness = int(props['bright'])
+    chunks = max(1, math.ceil(duration / max_transition_duration))
+    chunk_duration = int(duration * 1000 / chunks)
+
+    transitions = []
+    for chunk in range(1, chunks + 1):
+        chunk_brightness = max(1, round(brightness - (brightness - 1) * chunk / chunks))
+        transitions.append(_get_transition(props, chunk_duration, chunk_brightness))
+
+    action = Flow.actions.off if turn_off else Flow.actions.stay
+    return Flow(count=1, action=action, transitions=transitions)
+
+
+def _get_transition(props, duration, brightness):
+    color_mode = str(props.get('color_mode'))
+
+    if color_mode == '1':
+        rgb = int(props['rgb'])
+        return RGBTransition((rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF, duration, brightness)
+    if color_mode == '3':
+        return HSVTransition(int(props['hue']), int(props['sat']), duration, brightness)
+    return TemperatureTransition(int(props['ct']), duration, brightness)
+
+
+def _supports_flow(bulb):
+    return 'start_cf' in getattr(bulb, 'discovery_data', {}).get('support', '').split()
+
+
+_fade_ids = itertools.count(1)
+
 
-            if retries > 0:
-                logging.info('Retrying. Attempts left: {}'.format(retries))
-                if updated_brightness:
-                    props['bright'] = str(round(new_brightness))
-                    threading.Timer(
-                        retry_delay, _fade, [bulb, interval, step, new_brightness, props, turn_off, retries-1]).start()
+class FadeScheduler:
+    """Runs the steps of every active fade from a single thread, ordered by due time in a heap."""
+
+    def __init__(self):
+        self.__queue = []
+        self.__fades = {}
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def start(self):
+        with self.__condition:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='fade-scheduler', daemon=True)
+                self.__thread.start()
+
+    def add(self, fade, delay=0):
+        with self.__condition:
+            self.__fades[fade.id] = fade
+            self.__push(fade, delay)
+        return fade.id
+
+    def get_fades(self):
+        with self.__condition:
+            return list(self.__fades.values())
+
+    def cancel(self, fade_id):
+        """Removes the fade and stops it, as stop_fade does. Returns False if there was no such fade."""
+        with self.__condition:
+            fade = self.__fades.pop(fade_id, None)
+        if fade is None:
+            return False
+
+        #  stopping a native fade talks to the bulb, so it is done outside the lock
+        try:
+            fade.stop()
+        except (BulbException, OSError) as err:
+            logging.error('Could not stop fade {0} on light {1}: {2}'.format(fade_id, fade.bulb.ip, err))
+        return True
+
+    def cancel_bulb(self, bulb):
+        with self.__condition:
+            cancelled = [fade for fade in self.__fades.values() if fade.bulb is bulb]
+            for fade in cancelled:
+                del self.__fades[fade.id]
+        return cancelled
+
+    def reschedule(self, fade_id, delay):
+        with self.__condition:
+            fade = self.__fades.get(fade_id)
+            if fade is None:
+                return False
+            self.__push(fade, delay)
+            return True
+
+    def __push(self, fade, delay):
+        fade.due = time.monotonic() + delay
+        heapq.heappush(self.__queue, (fade.due, fade.id))
+        self.__condition.notify()
+
+    def __next_due(self):
+        with self.__condition:
+            while True:
+                if not self.__queue:
+                    self.__condition.wait()
+                    continue
+
+                due, fade_id = self.__queue[0]
+                fade = self.__fades.get(fade_id)
+                #  cancelled or rescheduled fades leave their old entries behind
+                if fade is None or fade.due != due:
+                    heapq.heappop(self.__queue)
+                    continue
+
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                    continue
+
+                heapq.heappop(self.__queue)
+                return fade
+
+    def __run(self):
+        while True:
+            fade = self.__next_due()
+            due = fade.due
+
+            try:
+                delay = fade.run_step()
+            except Exception as err:
+                logging.error('Fade {0} failed: {1}'.format(fade.id, err))
+                delay = None
+
+            with self.__condition:
+                if self.__fades.get(fade.id) is not fade or fade.due != due:
+                    #  cancelled or rescheduled while the step was running
+                    continue
+                if delay is None:
+                    del self.__fades[fade.id]
                 else:
-                    threading.Timer(
-                        retry_delay, _fade,
-                        [bulb, interval, step, brightness, props, turn_off, retries - 1]).start()
+                    self.__push(fade, delay)
+
+
+_fade_scheduler = None
+_fade_scheduler_lock = threading.Lock()
+
+
+def get_fade_scheduler():
+    """Returns the process-wide fade scheduler, starting it on first use."""
+    global _fade_scheduler
+
+    with _fade_scheduler_lock:
+        if _fade_scheduler is None:
+            _fade_scheduler = FadeScheduler()
+            _fade_scheduler.start()
+        return _fade_scheduler
+
+
+BULB_TIMEOUT = 6  # seconds, just over the bulb socket timeout
+MIN_MUSIC_INTERVAL = 0.1  # seconds
+MAX_BULB_WORKERS = 8
+
+BulbResult = namedtuple('BulbResult', ['bulb', 'value', 'error'])
+
+
+class DeadlineExceeded(TimeoutError):
+    """The command was still running when the caller's deadline passed, and carries on in the background."""
+
+
+class Deadline:
+    """Point in time by which a request has to be answered, handed down to the calls made for it."""
+
+    def __init__(self, budget):
+        self.expires = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0
+
+
+_bulb_executor = ThreadPoolExecutor(max_workers=MAX_BULB_WORKERS, thread_name_prefix='bulb')
+
+
+def _fan_out(action, bulbs, timeout=BULB_TIMEOUT, deadline=None, health=None):
+    """
+    Runs action(bulb) for every bulb concurrently, giving each call timeout seconds from when it starts.
+
+    Returns a BulbResult per bulb, in the order given. Bulb errors and timeouts are
+    reported in the result; any other exception is a bug and is raised. When the
+    deadline cuts the wait short, unfinished calls, started or still queued, are not
+    cancelled but left to finish in the background, and reported as DeadlineExceeded.
+    With a BulbHealth, bulbs that have stopped responding are skipped and reported as
+    BulbUnavailable, and the outcome of every call is recorded.
+    """
+    started = {}
+
+    def run(index, bulb):
+        started[index] = time.monotonic()
+        return action(bulb)
+
+    futures = [_bulb_executor.submit(run, index, bulb) if health is None or health.is_available(bulb) else None
+               for index, bulb in enumerate(bulbs)]
+
+    #  with more bulbs than workers some calls wait for a worker, which does not count against their timeout
+    pending = {index for index, future in enumerate(futures) if future is not None}
+    timed_out = set()
+    while pending:
+        now = time.monotonic()
+        pending = {index for index in pending if not futures[index].done()}
+        expired = {index for index in pending if index in started and now - started[index] >= timeout}
+        timed_out |= expired
+        pending -= expired
+        if not pending or (deadline is not None and deadline.expired()):
+            break
+
+        wait_time = min([started[index] + timeout - now for index in pending if index in started], default=timeout)
+        if deadline is not None:
+            wait_time = min(wait_time, deadline.remaining())
+        wait([futures[index] for index in pending], wait_time, return_when=FIRST_COMPLETED)
+
+    results = []
+    for index, bulb in enumerate(bulbs):
+        future = futures[index]
+        if future is None:
+            results.append(BulbResult(bulb, None, BulbUnavailable('Not responding, skipped')))
+        elif index in timed_out:
+            results.append(BulbResult(bulb, None, TimeoutError('No response in {} seconds'.format(timeout))))
+        elif index in pending:
+            future.add_done_callback(functools.partial(_log_late_result, bulb, health))
+            results.append(BulbResult(bulb, None, DeadlineExceeded('Still running at the deadline')))
+        else:
+            try:
+                results.append(BulbResult(bulb, future.result(), None))
+            except (BulbException, OSError) as err:
+                results.append(BulbResult(bulb, None, err))
+
+    for index, result in enumerate(results):
+        #  only calls that were sent say anything about the bulb, late ones are recorded when they finish
+        if health is not None and futures[index] is not None and index not in pending:
+            health.record(result.bulb, result.error)
+        if result.error is not None:
+            logging.error('Light {0} failed: {1}'.format(result.bulb, result.error))
+
+    return results
+
+
+def _log_late_result(bulb, health, future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if health is not None:
+        health.record(bulb, error)
+    if error is not None:
+        logging.error('Light {0} failed after the deadline: {1}'.format(bulb, error))
+
+
+class JobStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class LightJob:
+    """A light command running in the background, with the BulbResults once it has finished."""
+
+    def __init__(self, job_id, name, action):
+        self.id = job_id
+        self.name = name
+        self.action = action
+        self.status = JobStatus.PENDING
+        self.submitted = time.time()
+        self.finished = None
+        self.results = []
+        self.error = None
+        self.__done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Returns True once the job has finished, False if it is still running after timeout seconds."""
+        return self.__done.wait(timeout)
+
+    def finish(self):
+        self.finished = time.time()
+        self.__done.set()
+
+    def get_failures(self):
+        """Results of bulbs that failed, not counting those still running when the deadline passed."""
+        return [result for result in self.results
+                if result.error is not None and not isinstance(result.error, DeadlineExceeded)]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'error': self.error,
+            'results': [{'bulb': getattr(result.bulb, 'ip', str(result.bulb)),
+                         'error': str(result.error) if result.error is not None else None}
+                        for result in self.results],
+        }
+
+
+class JobQueue:
+    """Runs light commands in the background, in submission order for each bulb, and keeps the recent jobs."""
+
+    def __init__(self, history=50, on_failure=None, workers=4):
+        self.history = history
+        self.on_failure = on_failure
+        self.__jobs = OrderedDict()
+        self.__ids = itertools.count(1)
+        self.__last = {}
+        self.__blocked = {}
+        self.__successors = {}
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='light-job')
+
+    def submit(self, name, action, *args, **kwargs):
+        """Schedules action(*args, **kwargs), which returns BulbResults, and returns its LightJob."""
+        #  jobs are ordered by the bulbs among their arguments
+        ips = {arg.ip for arg in args if hasattr(arg, 'ip')}
+
+        with self.__lock:
+            job = LightJob(next(self.__ids), name, lambda: action(*args, **kwargs))
+            self.__jobs[job.id] = job
+            while len(self.__jobs) > self.history:
+                self.__jobs.popitem(last=False)
+
+            if ips:
+                previous = {self.__last.get(ip) for ip in ips} | {self.__last.get(None)}
+                self.__last.update((ip, job) for ip in ips)
+            else:
+                #  a job given no bulbs acts on the default light, which may be any of them
+                previous = set(self.__last.values())
+                self.__last = {None: job}
+            previous.discard(None)
+
+            for earlier in previous:
+                self.__successors.setdefault(earlier.id, []).append(job)
+            if previous:
+                self.__blocked[job.id] = len(previous)
+
+        if not previous:
+            self.__executor.submit(self.__run, job)
+        return job
+
+    def get(self, job_id):
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.__lock:
+            return list(self.__jobs.values())
+
+    def __run(self, job):
+        job.status = JobStatus.RUNNING
+        try:
+            job.results = list(job.action() or [])
+        except Exception as err:
+            job.error = str(err)
+
+        failed = job.error is not None or bool(job.get_failures())
+        job.status = JobStatus.FAILED if failed else JobStatus.DONE
+        job.finish()
+        self.__release(job)
+        if not failed:
+            return
+
+        logging.error('Light job {0} ({1}) failed: {2}'.format(
+            job.id, job.name, job.error or ', '.join(str(result.error) for result in job.get_failures())))
+        if self.on_failure is not None:
+            #  reporting talks to the lights too, it must not hold up the next job
+            self.__executor.submit(self.__report, job)
+
+    def __release(self, job):
+        """Starts the jobs that were only waiting for job."""
+        ready = []
+        with self.__lock:
+            for ip, last in list(self.__last.items()):
+                if last is job:
+                    del self.__last[ip]
+            for successor in self.__successors.pop(job.id, []):
+                self.__blocked[successor.id] -= 1
+                if self.__blocked[successor.id] == 0:
+                    del self.__blocked[successor.id]
+                    ready.append(successor)
+
+        for successor in ready:
+            self.__executor.submit(self.__run, successor)
+
+    def __report(self, job):
+        try:
+            self.on_failure(job)
+        except Exception as err:
+            logging.error('Could not report failure of light job {0}: {1}'.format(job.id, err))
+
+
+#  after any other command a warning flow would replace the flow or fade just started on the lights that responded
+_FLASHED_JOBS = ('stop_flow', 'stop_fade')
+
+
+def _flash_failure(job):
+    """Flashes a warning on the lights that did respond when stopping a flow or fade partly failed."""
+    if job.name not in _FLASHED_JOBS:
+        return
+
+    responsive = [result.bulb for result in job.results if result.error is None]
+    if responsive:
+        LightManager(registry=get_registry()).notify(NotificationLevel.WARNING, *responsive)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Returns the process-wide light job queue, which logs failed jobs and flashes a warning after failed stops."""
+    global _job_queue
+
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(on_failure=_flash_failure)
+        return _job_queue
+
+
+def _get_remaining_budget(bulb):
+    governor = getattr(bulb, 'governor', None)
+    if governor is None:
+        return None
+    return governor.remaining(bulb.ip)
+
+
+def _get_calls_per_step(bulb, state_cache):
+    #  a live state cache saves reading the bulb state before every step
+    if state_cache is not None and state_cache.is_live(bulb):
+        return 1
+    return 2
+
+
+def _get_max_steps_per_minute(bulb_calls_per_step):
+    error_margin = 2
+    return (get_rate_governor().get_sustained_rate() / bulb_calls_per_step) - error_margin
 
 
 def _get_max_steps(duration, max_steps_per_minute):
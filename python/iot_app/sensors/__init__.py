@@ -0,0 +1,19 @@
+"""
+Sensor readings posted by the IoT boards.
+
+Keeps the latest readings of every board, indexed by room, and a bounded history
+of every metric, delta-of-delta and XOR compressed, so that trends can be queried without
+memory growing with uptime, rolled up into 1 minute, 1 hour and 1 day tiers
+for long ranges. Rolling min, max, mean and trend over the last hour,
+day and week are maintained as readings arrive. Readings arrive over HTTP or,
+optionally, as UDP datagrams in a compact line protocol, and can be logged to
+disk to survive restarts or shared through memory between worker processes.
+"""
+
+from .compression import Chunk, CompressedSeries
+from .history import ROLLUP_TIERS, RollupBuffer, SensorHistory
+from .store import DEFAULT_DEVICE, METRICS, Device, ReadingStore, check_timestamp, get_reading_store
+from .log import ReadingLog
+from .shared import SharedReadings
+from .stats import WINDOWS, RollingStats, RollingWindow, Summary
+from .udp import UdpIngest, parse_datagram
@@ -0,0 +1,171 @@
+import struct
+from bisect import bisect_right
+
+# readings per chunk, an hour at the boards' 5 second posting interval
+CHUNK_SIZE = 720
+
+_FLOAT = struct.Struct('>d')
+_BITS = struct.Struct('>Q')
+
+
+class Chunk:
+    """
+    Readings encoded into a byte string: the first timestamp (in milliseconds) and value
+    in full, then per reading the zigzag varint delta-of-delta of the timestamp and
+    the XOR of the value's bits with the previous value's.
+
+    An unchanged value costs one byte and a reading with a few hundred milliseconds
+    of jitter two bytes of timestamp, against 16 bytes for a pair of doubles.
+    """
+
+    def __init__(self, timestamp, value):
+        self.first = self.last = timestamp
+        self.count = 1
+        self.data = bytearray(_BITS.pack(timestamp))
+        self.data += _FLOAT.pack(value)
+        self.__delta = 0
+        self.__bits = _BITS.unpack(_FLOAT.pack(value))[0]
+        self.__value = value
+
+    @property
+    def latest(self):
+        return self.last / 1000, self.__value
+
+    def append(self, timestamp, value):
+        delta = timestamp - self.last
+        _write_varint(self.data, _zigzag(delta - self.__delta))
+        bits = _BITS.unpack(_FLOAT.pack(value))[0]
+        _write_xor(self.data, bits ^ self.__bits)
+        self.last = timestamp
+        self.count += 1
+        self.__delta = delta
+        self.__bits = bits
+        self.__value = value
+
+    def __iter__(self):
+        """Decodes the readings one at a time as (timestamp in seconds, value)."""
+        data = self.data
+        timestamp = _BITS.unpack_from(data, 0)[0]
+        bits = _BITS.unpack_from(data, 8)[0]
+        yield timestamp / 1000, _FLOAT.unpack_from(data, 8)[0]
+
+        delta = 0
+        position = 16
+        for _ in range(self.count - 1):
+            dod, position = _read_varint(data, position)
+            delta += _unzigzag(dod)
+            timestamp += delta
+            xor, position = _read_xor(data, position)
+            bits ^= xor
+            yield timestamp / 1000, _FLOAT.unpack(_BITS.pack(bits))[0]
+
+
+class CompressedSeries:
+    """
+    Readings of one metric held as a list of compressed chunks.
+
+    Keeps at least capacity readings, dropping whole chunks once the rest still hold
+    that many. Range queries skip chunks outside the range and decode the others as
+    a stream. Timestamps must not go backwards and are kept to the millisecond.
+    """
+
+    def __init__(self, capacity, chunk_size=CHUNK_SIZE):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.__chunks = []
+        self.__firsts = []
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def get_encoded_size(self):
+        return sum(len(chunk.data) for chunk in self.__chunks)
+
+    def append(self, timestamp, value):
+        timestamp = round(timestamp * 1000)
+        chunk = self.__chunks[-1] if self.__chunks else None
+        if chunk is not None and timestamp < chunk.last:
+            raise ValueError('reading at {} is older than the latest one'.format(timestamp / 1000))
+
+        if chunk is None or chunk.count >= self.chunk_size:
+            self.__chunks.append(Chunk(timestamp, value))
+            self.__firsts.append(timestamp)
+        else:
+            chunk.append(timestamp, value)
+        self.__size += 1
+
+        while self.__size - self.__chunks[0].count >= self.capacity:
+            self.__size -= self.__chunks.pop(0).count
+            self.__firsts.pop(0)
+
+    def latest(self):
+        return self.__chunks[-1].latest if self.__chunks else None
+
+    def get_range(self, start=None, end=None):
+        return list(self.iter_range(start, end))
+
+    def iter_range(self, start=None, end=None):
+        """Yields readings with start <= timestamp <= end, oldest first, decoding only the chunks that overlap."""
+        first = 0 if start is None else max(0, bisect_right(self.__firsts, round(start * 1000)) - 1)
+        last = len(self.__chunks) if end is None else bisect_right(self.__firsts, round(end * 1000))
+
+        for chunk in self.__chunks[first:last]:
+            if start is not None and chunk.last < start * 1000:
+                continue
+            for timestamp, value in chunk:
+                if end is not None and timestamp > end:
+                    return
+                if start is None or timestamp >= start:
+                    yield timestamp, value
+
+
+def _zigzag(number):
+    return number * 2 if number >= 0 else -number * 2 - 1
+
+
+def _unzigzag(number):
+    return number // 2 if not number & 1 else -(number + 1) // 2
+
+
+def _write_varint(data, number):
+    while number >= 0x80:
+        data.append(number & 0x7f | 0x80)
+        number >>= 7
+    data.append(number)
+
+
+def _read_varint(data, position):
+    number = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def _write_xor(data, xor):
+    """
+    Writes 0 for an unchanged value, otherwise a byte with the number of leading zero
+    bytes in the high nibble and meaningful bytes in the low nibble, then those bytes.
+    """
+    if not xor:
+        data.append(0)
+        return
+    raw = xor.to_bytes(8, 'big')
+    leading = len(raw) - len(raw.lstrip(b'\0'))
+    meaningful = raw[leading:].rstrip(b'\0')
+    data.append(leading << 4 | len(meaningful))
+    data += meaningful
+
+
+def _read_xor(data, position):
+    header = data[position]
+    position += 1
+    if not header:
+        return 0, position
+    leading, length = header >> 4, header & 0x0f
+    meaningful = data[position:position + length]
+    return int.from_bytes(meaningful, 'big') << (8 * (8 - leading - length)), position + length
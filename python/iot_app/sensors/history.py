@@ -0,0 +1,139 @@
+import time
+from array import array
+from threading import Lock
+
+from .compression import CompressedSeries
+
+# 30 days of readings at the boards' 5 second posting interval, about 2MB per metric compressed
+DEFAULT_CAPACITY = 30 * 24 * 60 * 60 // 5
+
+# rollup resolution and retention in seconds, finest first
+ROLLUP_TIERS = [
+    (60, 2 * 24 * 60 * 60),
+    (60 * 60, 60 * 24 * 60 * 60),
+    (24 * 60 * 60, 3 * 365 * 24 * 60 * 60),
+]
+
+
+class RollupBuffer:
+    """
+    Fixed size ring of (start, mean, min, max, count) aggregates of readings in buckets of resolution seconds.
+
+    Readings update the newest bucket in place until one arrives for a later bucket,
+    which then replaces the oldest once the ring is full.
+    """
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.__starts = array('d', bytes(8 * capacity))
+        self.__totals = array('d', bytes(8 * capacity))
+        self.__minima = array('d', bytes(8 * capacity))
+        self.__maxima = array('d', bytes(8 * capacity))
+        self.__counts = array('L', bytes(array('L').itemsize * capacity))
+        self.__next = 0
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.resolution
+        last = (self.__next - 1) % self.capacity
+        if self.__size and self.__starts[last] >= start:
+            self.__totals[last] += value
+            self.__minima[last] = min(self.__minima[last], value)
+            self.__maxima[last] = max(self.__maxima[last], value)
+            self.__counts[last] += 1
+            return
+
+        index = self.__next
+        self.__starts[index] = start
+        self.__totals[index] = self.__minima[index] = self.__maxima[index] = value
+        self.__counts[index] = 1
+        self.__next = (self.__next + 1) % self.capacity
+        self.__size = min(self.__size + 1, self.capacity)
+
+    def get_range(self, start=None, end=None):
+        """Returns the buckets overlapping start to end, oldest first."""
+        first = 0 if start is None else self.__bisect(start - self.resolution, inclusive=True)
+        last = self.__size if end is None else self.__bisect(end, inclusive=True)
+        rows = []
+        for position in range(first, last):
+            i = self.__index(position)
+            rows.append((self.__starts[i], self.__totals[i] / self.__counts[i],
+                         self.__minima[i], self.__maxima[i], self.__counts[i]))
+        return rows
+
+    def __index(self, position):
+        return (self.__next - self.__size + position) % self.capacity
+
+    def __bisect(self, timestamp, inclusive=False):
+        low, high = 0, self.__size
+        while low < high:
+            middle = (low + high) // 2
+            found = self.__starts[self.__index(middle)]
+            if found < timestamp or (inclusive and found == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class SensorHistory:
+    """
+    One compressed series of raw readings per metric, plus a rollup buffer for every
+    tier in ROLLUP_TIERS, created on the first reading of that metric.
+
+    The last capacity raw readings are kept and each tier for its own retention
+    period, so memory stays bounded.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, tiers=ROLLUP_TIERS):
+        self.capacity = capacity
+        self.tiers = tiers
+        self.__buffers = {}
+        self.__rollups = {}
+        self.__lock = Lock()
+
+    def record(self, metric, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        value = float(value)
+        with self.__lock:
+            buffer = self.__buffers.get(metric)
+            if buffer is None:
+                buffer = self.__buffers[metric] = CompressedSeries(self.capacity)
+                self.__rollups[metric] = [RollupBuffer(resolution, retention // resolution)
+                                          for resolution, retention in self.tiers]
+            buffer.append(timestamp, value)
+            for rollup in self.__rollups[metric]:
+                rollup.add(timestamp, value)
+
+    def get_latest(self, metric):
+        buffer = self.__buffers.get(metric)
+        return buffer.latest() if buffer is not None else None
+
+    def get_metrics(self):
+        return list(self.__buffers)
+
+    def get_range(self, metric, start=None, end=None):
+        """
+        Returns raw (timestamp, value) readings. Raises KeyError for metrics that were never recorded.
+        """
+        with self.__lock:
+            return self.__buffers[metric].get_range(start, end)
+
+    def get_rollups(self, metric, resolution, start=None, end=None):
+        """
+        Returns the resolution of the coarsest tier no coarser than the one asked for, and its
+        (start, mean, min, max, count) buckets. A resolution finer than every tier returns raw
+        readings with resolution 0. Raises KeyError for metrics that were never recorded.
+        """
+        with self.__lock:
+            buffer = self.__buffers[metric]
+            candidates = [rollup for rollup in self.__rollups[metric] if rollup.resolution <= resolution]
+            if not candidates:
+                return 0, buffer.get_range(start, end)
+            rollup = max(candidates, key=lambda candidate: candidate.resolution)
+            return rollup.resolution, rollup.get_range(start, end)
+
@@ -0,0 +1,110 @@
+import logging
+import sqlite3
+import threading
+import time
+
+DEFAULT_FLUSH_INTERVAL = 1
+DEFAULT_RETENTION = 7 * 24 * 60 * 60
+DEFAULT_RESTORE_WINDOW = 24 * 60 * 60
+COMPACT_INTERVAL = 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (device TEXT, metric TEXT, timestamp REAL, value REAL);
+CREATE INDEX IF NOT EXISTS readings_timestamp ON readings (timestamp);
+CREATE TABLE IF NOT EXISTS latest (device TEXT, metric TEXT, timestamp REAL, value REAL, PRIMARY KEY (device, metric));
+"""
+
+
+class ReadingLog:
+    """
+    Append-only record of sensor readings in SQLite, so a restart does not lose them.
+
+    Appends only queue the readings; a background thread writes everything queued
+    in one transaction every flush interval, so ingest never waits on the disk.
+    The database runs in WAL mode and is memory-mapped for reads. A latest table
+    keeps the newest value of every device and metric so that startup restores
+    them, plus a recent window, without replaying the whole log. Readings older
+    than the retention period are deleted and the WAL checkpointed every hour.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL, retention=DEFAULT_RETENTION):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.__pending = []
+        self.__pending_lock = threading.Lock()
+        self.__db_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__last_compaction = time.time()
+
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('PRAGMA mmap_size={}'.format(64 * 1024 * 1024))
+        self.__db.executescript(_SCHEMA)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def close(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.flush()
+        with self.__db_lock:
+            self.__db.close()
+
+    def append(self, readings):
+        """Queues (device id, {metric: value}, timestamp) readings, usable as a ReadingStore subscriber."""
+        with self.__pending_lock:
+            self.__pending.extend(readings)
+
+    def flush(self):
+        with self.__pending_lock:
+            pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+
+        rows = [(device_id, metric, timestamp, value)
+                for device_id, values, timestamp in pending for metric, value in values.items()]
+        with self.__db_lock, self.__db:
+            self.__db.executemany('INSERT INTO readings VALUES (?, ?, ?, ?)', rows)
+            self.__db.executemany('INSERT OR REPLACE INTO latest SELECT ?, ?, ?, ? '
+                                  'WHERE ?3 >= COALESCE((SELECT timestamp FROM latest WHERE device = ?1 AND metric = ?2), ?3)',
+                                  rows)
+
+    def compact(self):
+        with self.__db_lock:
+            with self.__db:
+                self.__db.execute('DELETE FROM readings WHERE timestamp < ?', (time.time() - self.retention,))
+            self.__db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.__last_compaction = time.time()
+
+    def restore(self, store, window=DEFAULT_RESTORE_WINDOW):
+        """
+        Records the latest value of every device and metric, and all readings of the last window, into the store.
+
+        Returns the number of readings restored.
+        """
+        since = time.time() - window
+        with self.__db_lock:
+            rows = self.__db.execute('SELECT device, metric, timestamp, value FROM readings WHERE timestamp >= ?1 '
+                                     'UNION ALL SELECT device, metric, timestamp, value FROM latest WHERE NOT EXISTS '
+                                     '(SELECT 1 FROM readings WHERE timestamp = latest.timestamp AND timestamp >= ?1 '
+                                     'AND device = latest.device AND metric = latest.metric) '
+                                     'ORDER BY timestamp', (since,)).fetchall()
+
+        errors = store.record_many([(device_id, {metric: value}, timestamp) for device_id, metric, timestamp, value in rows])
+        return errors.count(None)
+
+    def __run(self):
+        while not self.__stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.time() - self.__last_compaction > COMPACT_INTERVAL:
+                    self.compact()
+            except sqlite3.Error as err:
+                logging.error('Could not write sensor readings to {0}: {1}'.format(self.path, err))
@@ -0,0 +1,176 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from .store import METRICS
+
+DEFAULT_CAPACITY = 65536
+SYNC_INTERVAL = 0.5
+# reads retried before suspecting a writer died mid-write
+MAX_READ_ATTEMPTS = 1000
+
+_MAGIC = 0x494f5452
+# magic, capacity, sequence, count
+_HEADER = struct.Struct('<IIQQ')
+# writer pid, device id, metric index, timestamp, value
+_ENTRY = struct.Struct('<I64sBdd')
+_SEQUENCE_OFFSET = 8
+_COUNT_OFFSET = 16
+
+
+class SharedReadings:
+    """
+    Ring of recently recorded readings in a memory-mapped file, shared by every worker process.
+
+    Each worker appends the readings its own store records, and follows the ring to
+    replay the readings of other workers into its store, so latest values, history,
+    statistics and streams agree whichever worker serves a request.
+
+    Writers take a file lock and bump a sequence number to odd before and back to
+    even after writing. Readers never lock: they copy the new entries and retry if
+    the sequence was odd or changed meanwhile (a seqlock). A worker falling more
+    than capacity readings behind skips the ones it missed.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.__cursor = 0
+        self.__cursor_lock = threading.Lock()
+        self.__write_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__following = None
+        self.__open()
+
+    def __open(self):
+        """
+        Maps the file, creating it if needed. Called again after a fork, because a file lock
+        held through a shared file description would not keep the processes apart.
+        """
+        size = _HEADER.size + self.capacity * _ENTRY.size
+        self.__file = open(self.path, 'a+b')
+        fcntl.flock(self.__file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.__file.fileno()).st_size < _HEADER.size:
+                self.__file.truncate(size)
+                self.__map = mmap.mmap(self.__file.fileno(), size)
+                _HEADER.pack_into(self.__map, 0, _MAGIC, self.capacity, 0, 0)
+            else:
+                self.__map = mmap.mmap(self.__file.fileno(), 0)
+        finally:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+        magic, self.capacity, _, _ = _HEADER.unpack_from(self.__map, 0)
+        if magic != _MAGIC:
+            raise ValueError('{} is not a shared readings file'.format(self.path))
+        self.__pid = os.getpid()
+
+    def __check_process(self):
+        if self.__pid != os.getpid():
+            self.__open()
+            if self.__following is not None:
+                self.follow(*self.__following)
+
+    def close(self):
+        self.__stop.set()
+        self.__map.close()
+        self.__file.close()
+
+    def append(self, readings):
+        """Writes (device id, {metric: value}, timestamp) readings, usable as a ReadingStore subscriber."""
+        self.__check_process()
+        entries = []
+        for device_id, values, timestamp in readings:
+            encoded = device_id.encode('utf8')
+            if len(encoded) > 64:
+                logging.warning('Not sharing readings of {}, the id is too long'.format(device_id))
+                continue
+            for metric, value in values.items():
+                if metric in METRICS:
+                    entries.append((self.__pid, encoded, METRICS.index(metric), timestamp, value))
+        if not entries:
+            return
+
+        with self.__write_lock:
+            fcntl.flock(self.__file, fcntl.LOCK_EX)
+            try:
+                sequence, count = self.__read_counters()
+                struct.pack_into('<Q', self.__map, _SEQUENCE_OFFSET, sequence + 1)
+                for entry in entries:
+                    _ENTRY.pack_into(self.__map, self.__offset(count), *entry)
+                    count += 1
+                struct.pack_into('<Q', self.__map, _COUNT_OFFSET, count)
+                struct.pack_into('<Q', self.__map, _SEQUENCE_OFFSET, sequence + 2)
+            finally:
+                fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+    def sync(self, store):
+        """
+        Records the readings other workers appended since the last sync into the store.
+        Costs two reads of shared memory when there are none. Returns the number recorded.
+        """
+        self.__check_process()
+        with self.__cursor_lock:
+            attempts = 0
+            while True:
+                sequence, count = self.__read_counters()
+                if count == self.__cursor:
+                    return 0
+                if not sequence & 1:
+                    first = max(self.__cursor, count - self.capacity)
+                    entries = [_ENTRY.unpack_from(self.__map, self.__offset(i)) for i in range(first, count)]
+                    if self.__read_counters()[0] == sequence:
+                        break
+                attempts += 1
+                if attempts % MAX_READ_ATTEMPTS == 0:
+                    self.__repair()
+
+            if first > self.__cursor:
+                logging.warning('Missed {} shared readings'.format(first - self.__cursor))
+            self.__cursor = count
+
+        readings = [(device_id.rstrip(b'\0').decode('utf8'), {METRICS[metric]: value}, timestamp)
+                    for pid, device_id, metric, timestamp, value in entries if pid != self.__pid]
+        store.record_many(readings, notify=False)
+        return len(readings)
+
+    def skip(self):
+        """Moves past the readings already in the ring, for stores restored from elsewhere."""
+        with self.__cursor_lock:
+            self.__cursor = self.__read_counters()[1]
+
+    def follow(self, store, interval=SYNC_INTERVAL):
+        """Keeps syncing the store in a daemon thread, so event streams see other workers' readings."""
+        self.__following = (store, interval)
+
+        def run():
+            while not self.__stop.wait(interval):
+                try:
+                    self.sync(store)
+                except ValueError:
+                    return
+
+        threading.Thread(target=run, daemon=True).start()
+        return self
+
+    def __repair(self):
+        """Evens out the sequence left odd by a writer that died, which released its lock."""
+        with self.__write_lock:
+            fcntl.flock(self.__file, fcntl.LOCK_EX)
+            try:
+                sequence, _ = self.__read_counters()
+                if sequence & 1:
+                    logging.warning('Repairing {} after an interrupted write'.format(self.path))
+                    struct.pack_into('<Q', self.__map, _SEQUENCE_OFFSET, sequence + 1)
+            finally:
+                fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+    def __read_counters(self):
+        _, _, sequence, count = _HEADER.unpack_from(self.__map, 0)
+        return sequence, count
+
+    def __offset(self, index):
+        return _HEADER.size + (index % self.capacity) * _ENTRY.size
@@ -0,0 +1,163 @@
+from collections import deque, namedtuple
+
+# window length and bucket size in seconds
+WINDOWS = {
+    'hour': (60 * 60, 60),
+    'day': (24 * 60 * 60, 5 * 60),
+    'week': (7 * 24 * 60 * 60, 60 * 60),
+}
+
+Summary = namedtuple('Summary', ['count', 'mean', 'minimum', 'maximum', 'trend'])
+
+
+class _Bucket:
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+
+
+class RollingWindow:
+    """
+    Min, max, mean and trend of the readings in a sliding time window, kept up to date in O(1) per reading.
+
+    Readings are grouped into fixed size buckets, so the window slides a bucket at a
+    time and its memory is bounded by the number of buckets, not readings. Running
+    sums of the closed buckets give the mean and least squares trend, and monotonic
+    queues of bucket minima and maxima give the extremes.
+    """
+
+    def __init__(self, length, resolution):
+        self.length = length
+        self.resolution = resolution
+        self.__buckets = deque()
+        self.__minima = deque()
+        self.__maxima = deque()
+        self.__current = None
+        self.__origin = None
+        self.__count = 0
+        self.__total = 0.0
+        self.__sum_t = 0.0
+        self.__sum_tt = 0.0
+        self.__sum_tv = 0.0
+
+    def add(self, timestamp, value):
+        if self.__origin is None:
+            self.__origin = timestamp
+        start = timestamp - timestamp % self.resolution
+        if self.__current is None or start > self.__current.start:
+            self.__close_current()
+            self.__current = _Bucket(start)
+
+        #  times relative to the first reading keep the squared sums precise
+        t = timestamp - self.__origin
+        bucket = self.__current
+        bucket.count += 1
+        bucket.total += value
+        bucket.minimum = min(bucket.minimum, value)
+        bucket.maximum = max(bucket.maximum, value)
+        bucket.sum_t += t
+        bucket.sum_tt += t * t
+        bucket.sum_tv += t * value
+        self.__expire(timestamp)
+
+    def get_summary(self, now):
+        """Returns the Summary of readings within the window ending now, None if there are none."""
+        self.__expire(now)
+        current = self.__current
+        if current is not None and current.start + self.resolution <= now - self.length:
+            current = None
+
+        count = self.__count + (current.count if current else 0)
+        if not count:
+            return None
+        total = self.__total + (current.total if current else 0)
+        sum_t = self.__sum_t + (current.sum_t if current else 0)
+        sum_tt = self.__sum_tt + (current.sum_tt if current else 0)
+        sum_tv = self.__sum_tv + (current.sum_tv if current else 0)
+
+        minima = [self.__minima[0][1]] if self.__minima else []
+        maxima = [self.__maxima[0][1]] if self.__maxima else []
+        if current is not None:
+            minima.append(current.minimum)
+            maxima.append(current.maximum)
+
+        denominator = count * sum_tt - sum_t * sum_t
+        trend = (count * sum_tv - sum_t * total) / denominator * 3600 if denominator > 1e-9 else 0.0
+        return Summary(count, total / count, min(minima), max(maxima), trend)
+
+    def __close_current(self):
+        bucket = self.__current
+        if bucket is None:
+            return
+        self.__buckets.append(bucket)
+        self.__count += bucket.count
+        self.__total += bucket.total
+        self.__sum_t += bucket.sum_t
+        self.__sum_tt += bucket.sum_tt
+        self.__sum_tv += bucket.sum_tv
+
+        while self.__minima and self.__minima[-1][1] >= bucket.minimum:
+            self.__minima.pop()
+        self.__minima.append((bucket.start, bucket.minimum))
+        while self.__maxima and self.__maxima[-1][1] <= bucket.maximum:
+            self.__maxima.pop()
+        self.__maxima.append((bucket.start, bucket.maximum))
+
+    def __expire(self, now):
+        while self.__buckets and self.__buckets[0].start + self.resolution <= now - self.length:
+            bucket = self.__buckets.popleft()
+            self.__count -= bucket.count
+            self.__total -= bucket.total
+            self.__sum_t -= bucket.sum_t
+            self.__sum_tt -= bucket.sum_tt
+            self.__sum_tv -= bucket.sum_tv
+            if self.__minima and self.__minima[0][0] == bucket.start:
+                self.__minima.popleft()
+            if self.__maxima and self.__maxima[0][0] == bucket.start:
+                self.__maxima.popleft()
+
+        if not self.__buckets:
+            #  nothing left to drift, start the sums again from zero
+            self.__count = 0
+            self.__total = self.__sum_t = self.__sum_tt = self.__sum_tv = 0.0
+
+
+class RollingStats:
+    """One rolling window per metric and period, see WINDOWS."""
+
+    def __init__(self):
+        self.__windows = {}
+
+    def add(self, metric, timestamp, value):
+        windows = self.__windows.get(metric)
+        if windows is None:
+            windows = self.__windows[metric] = {period: RollingWindow(*WINDOWS[period]) for period in WINDOWS}
+        for window in windows.values():
+            window.add(timestamp, value)
+
+    def get_summary(self, metric, period, now):
+        """Raises KeyError for unknown periods."""
+        if period not in WINDOWS:
+            raise KeyError(period)
+        windows = self.__windows.get(metric)
+        return windows[period].get_summary(now) if windows is not None else None
+
+
+def merge_summaries(summaries):
+    """Combines the summaries of several devices, weighting means and trends by reading count."""
+    summaries = [summary for summary in summaries if summary is not None]
+    if not summaries:
+        return None
+    count = sum(summary.count for summary in summaries)
+    return Summary(count,
+                   sum(summary.mean * summary.count for summary in summaries) / count,
+                   min(summary.minimum for summary in summaries),
+                   max(summary.maximum for summary in summaries),
+                   sum(summary.trend * summary.count for summary in summaries) / count)
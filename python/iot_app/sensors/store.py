@@ -0,0 +1,248 @@
+import math
+import time
+from threading import Condition, Lock
+
+from .history import DEFAULT_CAPACITY, SensorHistory
+from .stats import RollingStats, merge_summaries
+
+# readings posted without a client id, as the original firmware does
+DEFAULT_DEVICE = 'default'
+
+METRICS = ('temp', 'humidity')
+
+# readings stamped further ahead than this come from a clock that cannot be trusted,
+# or a timestamp in milliseconds, and would hold back every later reading of the device
+MAX_CLOCK_SKEW = 24 * 60 * 60  # seconds
+
+
+class Device:
+
+    def __init__(self, device_id, room, capacity):
+        self.id = device_id
+        self.room = room
+        self.latest = {}
+        self.history = SensorHistory(capacity)
+        self.stats = RollingStats()
+
+
+class ReadingStore:
+    """
+    Latest readings and history of every sensor board, keyed by client id.
+
+    Boards are indexed by room, and running totals of the latest value of each
+    metric are kept per room and overall, so averages are answered without
+    visiting every board.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.__devices = {}
+        self.__rooms = {}
+        self.__totals = {}
+        self.__subscribers = []
+        self.__version = 0
+        self.__lock = Lock()
+        self.__changed = Condition(self.__lock)
+
+    def register(self, device_id, room=None):
+        room = _normalise_room(room)
+        with self.__lock:
+            device = self.__devices.get(device_id)
+            if device is None:
+                device = self.__devices[device_id] = Device(device_id, room, self.capacity)
+            elif device.room != room:
+                for metric, value in device.latest.items():
+                    self.__remove_total(device.room, metric, value)
+                    self.__add_total(room, metric, value)
+                self.__rooms.get(device.room, set()).discard(device_id)
+                device.room = room
+                self.__bump_version()
+            if room is not None:
+                self.__rooms.setdefault(room, set()).add(device_id)
+            return device
+
+    def record(self, device_id, metric, value, timestamp=None):
+        """
+        Raises ValueError for values that are not numbers or readings older than the device's latest.
+        """
+        error = self.record_many([(device_id, {metric: value}, timestamp)])[0]
+        if error is not None:
+            raise ValueError(error)
+
+    def record_many(self, readings, notify=True):
+        """
+        Records (device id, {metric: value}, timestamp) readings under a single lock, oldest first.
+
+        A reading is recorded whole or not at all. Returns an error message, or None
+        for readings that were recorded, in the order they were given. Subscribers
+        are not told about readings replicated from another store (notify=False).
+        """
+        now = time.time()
+        errors = [None] * len(readings)
+        order = sorted(range(len(readings)), key=lambda i: now if readings[i][2] is None else readings[i][2])
+
+        recorded = []
+        with self.__lock:
+            for i in order:
+                device_id, values, timestamp = readings[i]
+                timestamp = now if timestamp is None else timestamp
+                try:
+                    values = {metric: float(value) for metric, value in values.items()}
+                except (TypeError, ValueError):
+                    errors[i] = 'invalid value'
+                    continue
+                #  one NaN would stay in the running totals for good
+                if not all(math.isfinite(value) for value in values.values()):
+                    errors[i] = 'invalid value'
+                    continue
+                #  the history packs timestamps as unsigned milliseconds
+                errors[i] = check_timestamp(timestamp, now)
+                if errors[i] is not None:
+                    continue
+                errors[i] = self.__record(device_id, values, timestamp)
+                if errors[i] is None:
+                    recorded.append((device_id, values, timestamp))
+            if recorded:
+                self.__bump_version()
+
+        if recorded and notify:
+            for callback in list(self.__subscribers):
+                callback(recorded)
+        return errors
+
+    @property
+    def version(self):
+        """
+        Increases whenever readings are recorded or a device changes room. Local to this store:
+        workers sharing readings count their batches differently, so do not compare across processes.
+        """
+        return self.__version
+
+    def wait_for_change(self, version, timeout=None):
+        """Blocks until the version is past the given one or the timeout expires, returns the current version."""
+        with self.__changed:
+            self.__changed.wait_for(lambda: self.__version != version, timeout)
+            return self.__version
+
+    def __bump_version(self):
+        self.__version += 1
+        self.__changed.notify_all()
+
+    def subscribe(self, callback):
+        """Calls back with the list of (device id, {metric: value}, timestamp) readings of every recorded batch."""
+        self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.__subscribers:
+            self.__subscribers.remove(callback)
+
+    def __record(self, device_id, values, timestamp):
+        device = self.__devices.get(device_id)
+        if device is None:
+            device = self.__devices[device_id] = Device(device_id, None, self.capacity)
+
+        for metric in values:
+            latest = device.history.get_latest(metric)
+            #  the history keeps timestamps to the millisecond
+            if latest is not None and round(timestamp * 1000) < round(latest[0] * 1000):
+                return 'older than the latest {} reading'.format(metric)
+
+        for metric, value in values.items():
+            device.history.record(metric, value, timestamp)
+            device.stats.add(metric, timestamp, value)
+            previous = device.latest.get(metric)
+            device.latest[metric] = value
+            if previous is not None:
+                self.__remove_total(device.room, metric, previous)
+            self.__add_total(device.room, metric, value)
+
+    def get_latest(self, metric, device_id=None, room=None):
+        """
+        Returns the device's latest reading, or the average over a room or all devices.
+        None if nothing has been reported yet. Raises KeyError for unknown devices.
+        """
+        if device_id is not None:
+            return self.__devices[device_id].latest.get(metric)
+
+        with self.__lock:
+            total = self.__totals.get((_normalise_room(room), metric))
+            if not total or not total[1]:
+                return None
+            return total[0] / total[1]
+
+    def get_summary(self, metric, period, device_id=None, room=None, now=None):
+        """
+        Returns the stats.Summary of a metric over the last hour, day or week for a device,
+        or merged over a room or all devices. None if nothing was reported in that period.
+        Raises KeyError for unknown devices or periods.
+        """
+        now = time.time() if now is None else now
+        with self.__lock:
+            devices = [self.__devices[device_id]] if device_id is not None else self.get_devices(room)
+            return merge_summaries([device.stats.get_summary(metric, period, now) for device in devices])
+
+    def get_history(self, device_id, metric, start=None, end=None):
+        """
+        Raises KeyError for unknown devices or metrics.
+        """
+        return self.__devices[device_id].history.get_range(metric, start, end)
+
+    def get_rollups(self, device_id, metric, resolution, start=None, end=None):
+        """
+        Returns (resolution, buckets) from the device's coarsest rollup tier no coarser than resolution,
+        see SensorHistory.get_rollups. Raises KeyError for unknown devices or metrics.
+        """
+        return self.__devices[device_id].history.get_rollups(metric, resolution, start, end)
+
+    def get_device(self, device_id):
+        return self.__devices.get(device_id)
+
+    def get_devices(self, room=None):
+        if room is None:
+            return list(self.__devices.values())
+        return [self.__devices[device_id] for device_id in self.__rooms.get(_normalise_room(room), ())]
+
+    def get_rooms(self):
+        return [room for room, devices in self.__rooms.items() if devices]
+
+    def __add_total(self, room, metric, value):
+        for scope in {None, room}:
+            total = self.__totals.setdefault((scope, metric), [0.0, 0])
+            total[0] += value
+            total[1] += 1
+
+    def __remove_total(self, room, metric, value):
+        for scope in {None, room}:
+            total = self.__totals[(scope, metric)]
+            total[0] -= value
+            total[1] -= 1
+
+
+def check_timestamp(timestamp, now=None):
+    """Returns why an epoch timestamp in seconds cannot be recorded, or None if it can."""
+    now = time.time() if now is None else now
+    if not math.isfinite(timestamp):
+        return 'timestamp is not a number'
+    if timestamp < 0:
+        return 'timestamp is before 1970'
+    if timestamp > now + MAX_CLOCK_SKEW:
+        return 'timestamp is in the future'
+    return None
+
+
+def _normalise_room(room):
+    return room.upper() if room is not None else None
+
+
+_reading_store = None
+_reading_store_lock = Lock()
+
+
+def get_reading_store(capacity=None):
+    """Returns the store shared by the endpoints and intents, created with the given history capacity on first use."""
+    global _reading_store
+
+    with _reading_store_lock:
+        if _reading_store is None:
+            _reading_store = ReadingStore(capacity or DEFAULT_CAPACITY)
+        return _reading_store
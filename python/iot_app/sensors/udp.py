@@ -0,0 +1,95 @@
+import logging
+import socket
+import threading
+
+from .store import METRICS, check_timestamp
+
+MAX_DATAGRAM_SIZE = 65507
+
+
+class UdpIngest:
+    """
+    Records sensor readings sent as UDP datagrams, bypassing the HTTP workers.
+
+    Each datagram holds one or more newline separated readings in line protocol:
+
+        <token> <device id> temp=21,humidity=40 [epoch timestamp]
+
+    All readings of a datagram are recorded in one batch. Datagrams with a wrong
+    token, a malformed line or an unusable timestamp are dropped whole without a reply.
+    """
+
+    def __init__(self, store, token, host='0.0.0.0', port=5001):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.received = 0
+        self.dropped = 0
+        self.__token = token.encode('utf8')
+        self.__socket = None
+
+    def start(self):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            #  lets every worker process listen, the kernel spreads datagrams between them
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__socket.bind((self.host, self.port))
+        self.port = self.__socket.getsockname()[1]
+        threading.Thread(target=self.__serve, args=(self.__socket,), daemon=True).start()
+        logging.info('Listening for sensor readings on udp://{0}:{1}'.format(self.host, self.port))
+        return self
+
+    def stop(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __serve(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except OSError:
+                return
+
+            self.received += 1
+            try:
+                readings = parse_datagram(data, self.__token)
+                if readings is None:
+                    self.dropped += 1
+                    continue
+
+                for error in self.store.record_many(readings):
+                    if error is not None:
+                        logging.debug('Rejected reading from {0}: {1}'.format(address, error))
+            except Exception as err:
+                #  a datagram that trips a bug must not stop the listener
+                logging.error('Could not record datagram from {0}: {1}'.format(address, err))
+                self.dropped += 1
+
+
+def parse_datagram(data, token):
+    """
+    Returns the (device id, {metric: value}, timestamp) readings of a datagram, None if any line is invalid.
+    """
+    readings = []
+    for line in data.splitlines():
+        if not line:
+            continue
+        parts = line.split()
+        if len(parts) not in (3, 4) or parts[0] != token:
+            return None
+        try:
+            values = {}
+            for field in parts[2].split(b','):
+                metric, value = field.split(b'=')
+                metric = metric.decode('ascii')
+                if metric not in METRICS:
+                    return None
+                values[metric] = float(value)
+            timestamp = float(parts[3]) if len(parts) == 4 else None
+            if timestamp is not None and check_timestamp(timestamp) is not None:
+                return None
+            readings.append((parts[1].decode('utf8'), values, timestamp))
+        except (ValueError, UnicodeDecodeError):
+            return None
+    return readings or None
@@ -0,0 +1,11 @@
+"""
+Local Yeelight bulb simulator for tests and benchmarks.
+
+Runs fake bulbs which answer SSDP discovery and the JSON-over-TCP command
+protocol, enforce the per-minute command quota, push props notifications and
+can be slowed down or disconnected on demand.
+"""
+
+from .bulb import SimulatedBulb
+from .ssdp import DiscoveryResponder
+from .network import BulbSimulator
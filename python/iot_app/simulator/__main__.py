@@ -0,0 +1,25 @@
+import argparse
+import time
+
+from .network import BulbSimulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run simulated Yeelight bulbs on the loopback interface.')
+    parser.add_argument('--bulbs', type=int, default=3, help='number of bulbs to run')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every reply')
+    parser.add_argument('--requests-per-minute', type=int, default=60, help='command quota per bulb')
+    args = parser.parse_args()
+
+    with BulbSimulator(args.bulbs, latency=args.latency, requests_per_minute=args.requests_per_minute) as simulator:
+        for bulb in simulator.bulbs:
+            print('{0} listening on {1}:{2}'.format(bulb.state['name'], bulb.host, bulb.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
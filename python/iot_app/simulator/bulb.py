@@ -0,0 +1,243 @@
+import json
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from itertools import count
+
+_bulb_ids = count(1)
+
+_MODELS = {
+    'color': 'get_prop set_default set_power toggle set_bright start_cf stop_cf cron_add cron_get cron_del '
+             'set_ct_abx set_rgb set_hsv set_adjust set_music set_name',
+    'mono': 'get_prop set_default set_power toggle set_bright start_cf stop_cf cron_add cron_get cron_del '
+            'set_adjust set_name',
+}
+
+
+class SimulatedBulb:
+    """
+    A fake Yeelight bulb speaking the JSON-over-TCP command protocol.
+
+    Like a real bulb it pushes props notifications to every open connection when
+    its state changes, rejects commands over requests_per_minute and closes the
+    connection that exceeded it, and connects back to the client in music mode.
+    Replies can be delayed by latency seconds to imitate a slow network.
+    """
+
+    def __init__(self, name, host='127.0.0.1', port=0, model='color', requests_per_minute=60, latency=0):
+        self.id = '0x{:016x}'.format(next(_bulb_ids))
+        self.host = host
+        self.port = port
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.latency = latency
+        self.state = {
+            'power': 'on', 'bright': 50, 'ct': 4000, 'rgb': 16777215, 'hue': 0, 'sat': 0,
+            'color_mode': 2, 'flowing': 0, 'delayoff': 0, 'music_on': 0, 'name': name,
+        }
+        self.flow = None
+        self.rpc_count = 0
+        self.__requests = deque()
+        self.__connections = []
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def start(self):
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind((self.host, self.port))
+        self.__server.listen(8)
+        self.port = self.__server.getsockname()[1]
+        threading.Thread(target=self.__accept, args=(self.__server,), daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stops answering, as if the bulb was unplugged."""
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+        self.drop_connections()
+
+    def drop_connections(self):
+        with self.__lock:
+            connections, self.__connections = self.__connections, []
+        for connection in connections:
+            _close(connection)
+
+    def get_discovery_headers(self):
+        return {
+            'Location': 'yeelight://{0}:{1}'.format(self.host, self.port),
+            'id': self.id,
+            'model': self.model,
+            'fw_ver': '18',
+            'support': _MODELS[self.model],
+            'power': self.state['power'],
+            'bright': self.state['bright'],
+            'color_mode': self.state['color_mode'],
+            'ct': self.state['ct'],
+            'rgb': self.state['rgb'],
+            'hue': self.state['hue'],
+            'sat': self.state['sat'],
+            'name': self.state['name'],
+        }
+
+    def update(self, **props):
+        """Changes the bulb state as if from another client and notifies connections."""
+        with self.__lock:
+            self.state.update(props)
+        self.__notify(props)
+
+    def __accept(self, server):
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            with self.__lock:
+                self.__connections.append(connection)
+            threading.Thread(target=self.__serve, args=(connection,), daemon=True).start()
+
+    def __serve(self, connection, music=False):
+        for command in _read_commands(connection):
+            with self.__lock:
+                self.rpc_count += 1
+
+            if not music and not self.__take_request():
+                logging.info('Bulb {} quota exceeded, closing connection'.format(self.state['name']))
+                self.__reply(connection, command, error={'code': -1, 'message': 'client quota exceeded'})
+                self.__disconnect(connection)
+                return
+
+            if self.latency:
+                time.sleep(self.latency)
+
+            try:
+                result = self.__execute(command, connection)
+            except (KeyError, IndexError, TypeError, ValueError):
+                self.__reply(connection, command, error={'code': -1, 'message': 'invalid params'})
+                continue
+
+            if not music:
+                if result is None:
+                    self.__reply(connection, command, error={'code': -1, 'message': 'method not supported'})
+                else:
+                    self.__reply(connection, command, result=result)
+
+        self.__disconnect(connection)
+
+    def __take_request(self):
+        now = time.monotonic()
+        with self.__lock:
+            while self.__requests and now - self.__requests[0] >= 60:
+                self.__requests.popleft()
+            if len(self.__requests) >= self.requests_per_minute:
+                return False
+            self.__requests.append(now)
+            return True
+
+    def __execute(self, command, connection):
+        method = command.get('method')
+        params = command.get('params') or []
+
+        if method not in _MODELS[self.model].split():
+            return None
+        if method == 'get_prop':
+            with self.__lock:
+                return [str(self.state.get(key, '')) for key in params]
+        if method == 'set_power':
+            self.__set(power=params[0])
+        elif method == 'toggle':
+            self.__set(power='off' if self.state['power'] == 'on' else 'on')
+        elif method == 'set_bright':
+            self.__set(bright=max(1, min(100, int(params[0]))))
+        elif method == 'set_ct_abx':
+            self.__set(ct=int(params[0]), color_mode=2)
+        elif method == 'set_rgb':
+            self.__set(rgb=int(params[0]), color_mode=1)
+        elif method == 'set_hsv':
+            self.__set(hue=int(params[0]), sat=int(params[1]), color_mode=3)
+        elif method == 'set_name':
+            self.__set(name=params[0])
+        elif method == 'start_cf':
+            self.flow = params
+            self.__set(flowing=1)
+        elif method == 'stop_cf':
+            self.flow = None
+            self.__set(flowing=0)
+        elif method == 'set_music':
+            self.__set_music(params, connection)
+        return ['ok']
+
+    def __set(self, **props):
+        with self.__lock:
+            changed = {key: value for key, value in props.items() if self.state.get(key) != value}
+            self.state.update(changed)
+        if changed:
+            self.__notify(changed)
+
+    def __set_music(self, params, connection):
+        if params[0] == 1:
+            music_connection = socket.create_connection((params[1], int(params[2])), timeout=5)
+            music_connection.settimeout(None)
+            threading.Thread(target=self.__serve, args=(music_connection, True), daemon=True).start()
+            self.__set(music_on=1)
+        else:
+            self.__set(music_on=0)
+
+    def __notify(self, props):
+        message = (json.dumps({'method': 'props', 'params': props}) + '\r\n').encode('utf8')
+        with self.__lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            try:
+                connection.sendall(message)
+            except OSError:
+                self.__disconnect(connection)
+
+    def __reply(self, connection, command, result=None, error=None):
+        message = {'id': command.get('id')}
+        if error is not None:
+            message['error'] = error
+        else:
+            message['result'] = result
+        try:
+            connection.sendall((json.dumps(message) + '\r\n').encode('utf8'))
+        except OSError:
+            self.__disconnect(connection)
+
+    def __disconnect(self, connection):
+        with self.__lock:
+            if connection in self.__connections:
+                self.__connections.remove(connection)
+        _close(connection)
+
+
+def _read_commands(connection):
+    buffer = b''
+    while True:
+        try:
+            data = connection.recv(16 * 1024)
+        except OSError:
+            return
+        if not data:
+            return
+
+        *lines, buffer = (buffer + data).split(b'\r\n')
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line.decode('utf8'))
+            except ValueError:
+                continue
+
+
+def _close(connection):
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    connection.close()
@@ -0,0 +1,72 @@
+import logging
+import socket
+import struct
+import threading
+
+MULTICAST_ADDRESS = '239.255.255.250'
+DISCOVERY_PORT = 1982
+
+
+class DiscoveryResponder:
+    """
+    Answers Yeelight SSDP discovery (M-SEARCH) on behalf of simulated bulbs, and
+    multicasts their NOTIFY advertisements when asked to, as bulbs do when they
+    come online and every so often after that.
+    """
+
+    def __init__(self, bulbs, interface='0.0.0.0'):
+        self.bulbs = bulbs
+        self.interface = interface
+        self.__socket = None
+
+    def start(self):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__socket.bind(('', DISCOVERY_PORT))
+
+        membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_ADDRESS), socket.inet_aton(self.interface))
+        self.__socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        threading.Thread(target=self.__serve, args=(self.__socket,), daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def advertise(self, bulbs=None, max_age=3600):
+        """Sends a NOTIFY advertisement for each of the bulbs, by default all of them."""
+        for bulb in list(self.bulbs if bulbs is None else bulbs):
+            self.__socket.sendto(get_notify_message(bulb, max_age), (MULTICAST_ADDRESS, DISCOVERY_PORT))
+
+    def __serve(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(65507)
+            except OSError:
+                return
+
+            if not data.startswith(b'M-SEARCH') or b'wifi_bulb' not in data:
+                continue
+
+            for bulb in list(self.bulbs):
+                try:
+                    sock.sendto(get_search_response(bulb), address)
+                except OSError as err:
+                    logging.warning('Could not answer discovery from {0}: {1}'.format(address, err))
+
+
+def get_search_response(bulb):
+    lines = ['HTTP/1.1 200 OK', 'Cache-Control: max-age=3600', 'Date: ', 'Ext: ', 'Server: POSIX UPnP/1.0 YGLC/1']
+    lines += ['{0}: {1}'.format(key, value) for key, value in bulb.get_discovery_headers().items()]
+    return ('\r\n'.join(lines) + '\r\n').encode('utf8')
+
+
+def get_notify_message(bulb, max_age=3600):
+    lines = ['NOTIFY * HTTP/1.1', 'Host: {0}:{1}'.format(MULTICAST_ADDRESS, DISCOVERY_PORT),
+             'Cache-Control: max-age={}'.format(max_age), 'NTS: ssdp:alive', 'Server: POSIX, UPnP/1.0 YGLC/1']
+    lines += ['{0}: {1}'.format(key, value) for key, value in bulb.get_discovery_headers().items()]
+    return ('\r\n'.join(lines) + '\r\n').encode('utf8')
@@ -0,0 +1,9 @@
+import time
+
+
+def wait_for(condition, timeout=2):
+    """Polls condition until it holds or timeout seconds pass, and returns its last value."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
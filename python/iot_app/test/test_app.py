@@ -0,0 +1,87 @@
+import sys, tempfile
+from os import environ
+from os.path import abspath, dirname, join
+from unittest import main, mock, TestCase
+
+#  app.py imports its neighbours as top-level modules, as it does when run
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+CONFIG = """
+POST_TOKEN = 'token'
+CLIENTS = ['board']
+ASK_VERIFY_REQUESTS = False
+SENSOR_LOG_PATH = None
+LIGHTS_SNAPSHOT_PATH = None
+"""
+
+with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as config:
+    config.write(CONFIG)
+environ['IOT_APP_CONFIG'] = config.name
+
+with mock.patch('lights.get_registry'):
+    import app as app_module
+
+
+class AppTest(TestCase):
+
+    def setUp(self):
+        self.client = app_module.app.test_client()
+
+    def test_batch_results_per_item(self):
+        # Setup
+        body = {'token': 'token', 'readings': [
+            {'id': 'batch1', 'temp': 19, 'timestamp': 1500000000},
+            {'id': 'batch1', 'temp': 19, 'timestamp': True},
+            {'id': None, 'humidity': 40},
+            {'id': 'batch1'},
+        ]}
+
+        # Exercise
+        response = self.client.post('/iot/batch', json=body)
+
+        # Verify
+        assert response.get_json()['accepted'] == 2
+        assert [result['status'] for result in response.get_json()['results']] == ['ok', 'error', 'ok', 'error']
+        assert app_module.store.get_history('batch1', 'temp') == [(1500000000, 19)]
+        assert app_module.store.get_device('None') is None
+        assert app_module.store.get_latest('humidity', app_module.DEFAULT_DEVICE) == 40
+
+    def test_unchanged_readings_not_modified(self):
+        # Setup
+        self.client.post('/iot', data={'token': 'token', 'id': 'board', 'temp': '21'})
+        etag = self.client.get('/read?device=board').headers['ETag']
+
+        # Exercise
+        response = self.client.get('/read?device=board', headers={'If-None-Match': etag})
+
+        # Verify
+        assert response.status_code == 304
+
+    def test_stream_sends_recorded_reading(self):
+        # Setup
+        self.client.post('/iot', data={'token': 'token', 'id': 'board', 'temp': '21'})
+        response = self.client.get('/read/stream?device=board&key=temp', buffered=False)
+        events = iter(response.response)
+        first = next(events)
+
+        # Exercise
+        self.client.post('/iot', data={'token': 'token', 'id': 'board', 'temp': '22.5'})
+        second = next(events)
+        response.close()
+
+        # Verify
+        first, second = (event.decode('utf8') if isinstance(event, bytes) else event for event in (first, second))
+        assert '"temp": 21' in first
+        assert second.startswith('id: ')
+        assert '"temp": 22.5' in second
+
+    def test_unknown_stats_key(self):
+        # Exercise
+        response = self.client.get('/stats?key=bogus')
+
+        # Verify
+        assert response.data == b'invalid_key'
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,17 @@
 from unittest import main, mock, TestCase
-import sys, time
+import json, os, socket, sys, tempfile, threading, time
 
 win32api_module = mock.MagicMock()
 sys.modules['win32api'] = win32api_module
 import iot_app.lights as lights
+from iot_app.test import wait_for
 from yeelight.transitions import RGBTransition
 
 
 class MockBulb:
 
     def __init__(self, ip, name):
+        self.ip = ip
         self.props = {'ip': ip, 'name': name, 'bright': 50, 'ct': 6500, 'rgb': 256, 'power': 'on'}
         self.start_flow_count = 0
         self.stop_flow_count = 0
@@ -259,5 +261,1196 @@ class LightsTest(TestCase):
         assert self.default_bulb.get_properties(['power'])['power'] == 'on'
         assert self.default_bulb.get_properties(['bright'])['bright'] == 60
 
+    def test_stop_fade(self):
+        # Setup
+        self.default_bulb.set_brightness(100)
+
+        # Exercise
+        self.light_manager.fade(duration=4, turn_off=True)
+        time.sleep(1.1)
+        self.light_manager.stop_fade()
+        time.sleep(1)
+
+        # Verify
+        assert self.default_bulb not in [fade.bulb for fade in self.light_manager.get_active_fades()]
+        assert self.default_bulb.get_properties(['power'])['power'] == 'on'
+        assert self.default_bulb.get_properties(['bright'])['bright'] == 50
+
     if __name__ == '__main__':
         main()
+
+
+class BulbRegistryTest(TestCase):
+
+    def test_refresh_keeps_known_handles(self):
+        # Setup
+        bulb = MockBulb('192.168.0.55', 'bedroom')
+        rediscovered = MockBulb('192.168.0.55', 'bedroom')
+        registry = lights.BulbRegistry(refresh_interval=None)
+
+        # Exercise
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[bulb]):
+            registry.start()
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[rediscovered]):
+            registry.refresh()
+
+        # Verify
+        assert registry.get_all_lights() == [bulb]
+
+    def test_refresh_in_background(self):
+        # Setup
+        registry = lights.BulbRegistry(refresh_interval=0.1)
+        discovery = mock.Mock(side_effect=[[], [MockBulb('192.168.0.58', 'lounge')]] + [[]] * 100)
+
+        # Exercise
+        with mock.patch('iot_app.lights._initialize_lights', discovery):
+            registry.start()
+            assert registry.get_all_lights() == []
+            time.sleep(0.15)
+            registry.stop()
+
+        # Verify
+        assert len(registry.get_all_lights()) == 1
+
+    def test_update_replaces_handle_on_new_port(self):
+        # Setup
+        registry = lights.BulbRegistry(refresh_interval=None)
+        old = lights.DiscoveredBulb('127.0.0.31', 1, {'id': '0x1', 'name': 'study', 'support': 'get_prop'})
+        new = lights.DiscoveredBulb('127.0.0.31', 2, {'id': '0x1', 'name': 'study', 'support': 'get_prop'})
+        registry.update(old)
+
+        # Exercise
+        handle = registry.update(new)
+
+        # Verify
+        assert handle is new
+        assert registry.get_all_lights() == [new]
+        assert registry.get_light_by_name('study') is new
+
+    def test_snapshot_saved_only_on_changes(self):
+        # Setup
+        path = os.path.join(tempfile.mkdtemp(), 'lights.json')
+        registry = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+        data = {'id': '0x1', 'model': 'color', 'name': 'study', 'support': 'get_prop'}
+        registry.update(lights.DiscoveredBulb('127.0.0.32', 1, dict(data)))
+
+        # Exercise
+        with mock.patch('iot_app.lights._write_snapshot') as write:
+            registry.update(lights.DiscoveredBulb('127.0.0.32', 1, dict(data)))
+            unchanged = write.call_count
+            registry.update(lights.DiscoveredBulb('127.0.0.32', 1, dict(data, name='office')))
+            renamed = write.call_count
+            registry.update(lights.DiscoveredBulb('127.0.0.32', 1, dict(data, name='office', model='stripe')))
+
+        # Verify
+        assert unchanged == 0
+        assert renamed == 1
+        assert write.call_count == 2
+
+    def test_managers_share_registry(self):
+        # Setup
+        registry = lights.BulbRegistry(refresh_interval=None)
+        discovery = mock.Mock(side_effect=_initialize_lights)
+
+        # Exercise
+        with mock.patch('iot_app.lights._initialize_lights', discovery):
+            registry.start()
+            first = lights.LightManager(registry=registry)
+            second = lights.LightManager(registry=registry)
+
+        # Verify
+        assert discovery.call_count == 1
+        assert first.get_all_lights() == second.get_all_lights()
+
+    def test_snapshot_loaded_before_scan(self):
+        # Setup
+        path = os.path.join(tempfile.mkdtemp(), 'lights.json')
+        study = lights.DiscoveredBulb('127.0.0.30', 1, {'id': '0x1', 'model': 'color', 'name': 'study',
+                                                         'support': 'get_prop start_cf'})
+        registry = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[study]):
+            registry.start()
+        scanning = threading.Event()
+        discovery = mock.Mock(side_effect=lambda: scanning.wait(2) and [])
+
+        # Exercise
+        restarted = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+        with mock.patch('iot_app.lights._initialize_lights', discovery):
+            restarted.start()
+            light = restarted.get_light_by_name('Study')
+            scanning.set()
+
+            # Verify
+            assert light.ip == '127.0.0.30'
+            assert light.discovery_data['id'] == '0x1'
+            assert lights._supports_flow(light)
+        assert discovery.call_count == 1
+        registry.get_state_cache().unwatch(study)
+        restarted.get_state_cache().unwatch(light)
+
+    def test_empty_scan_keeps_snapshot(self):
+        # Setup
+        path = os.path.join(tempfile.mkdtemp(), 'lights.json')
+        study = lights.DiscoveredBulb('127.0.0.33', 1, {'id': '0x1', 'name': 'study', 'support': 'get_prop'})
+        registry = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[study]):
+            registry.start()
+        scanned = threading.Event()
+
+        def scan():
+            scanned.set()
+            return []
+
+        # Exercise
+        restarted = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+        with mock.patch('iot_app.lights._initialize_lights', side_effect=scan):
+            restarted.start()
+            assert scanned.wait(2)
+            time.sleep(0.1)
+
+        # Verify
+        assert [bulb.ip for bulb in restarted.get_all_lights()] == ['127.0.0.33']
+        with open(path) as snapshot:
+            assert [entry['ip'] for entry in json.load(snapshot)['lights']] == ['127.0.0.33']
+        registry.get_state_cache().unwatch(study)
+        restarted.get_state_cache().unwatch(restarted.get_light_by_name('study'))
+
+    def test_unreadable_snapshot_ignored(self):
+        # Setup
+        path = os.path.join(tempfile.mkdtemp(), 'lights.json')
+        with open(path, 'w') as snapshot:
+            snapshot.write('{"lights": [')
+        registry = lights.BulbRegistry(refresh_interval=None, snapshot_path=path)
+
+        # Exercise
+        with mock.patch('iot_app.lights._initialize_lights', _initialize_lights):
+            registry.start()
+
+        # Verify
+        assert registry.get_light_by_name('bedroom') is not None
+
+
+class LightNameIndexTest(TestCase):
+
+    def setUp(self):
+        self.bedroom = MockBulb('192.168.0.55', 'bedroom')
+        self.lounge = MockBulb('192.168.0.58', 'lounge')
+        self.registry = lights.BulbRegistry(refresh_interval=None)
+
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[self.bedroom, self.lounge]):
+            self.registry.start()
+
+    def test_lookup_is_case_insensitive(self):
+        # Exercise / Verify
+        assert self.registry.get_light_by_name('Bedroom') is self.bedroom
+        assert self.registry.get_light_by_name('LOUNGE') is self.lounge
+        assert self.registry.get_light_by_name('porch') is None
+
+    def test_lookup_costs_no_bulb_calls(self):
+        # Setup
+        with mock.patch.object(MockBulb, 'get_properties') as get_properties:
+
+            # Exercise
+            for _ in range(10):
+                self.registry.get_light_by_name('bedroom')
+
+            # Verify
+            get_properties.assert_not_called()
+
+    def test_name_from_discovery_data(self):
+        # Setup
+        kitchen = MockBulb('192.168.0.15', 'porch')
+        kitchen.discovery_data = {'name': 'kitchen'}
+
+        # Exercise
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[kitchen]):
+            self.registry.refresh()
+
+        # Verify
+        assert self.registry.get_light_by_name('kitchen') is kitchen
+        assert self.registry.get_light_by_name('bedroom') is None
+
+    def test_renamed_bulb_is_reindexed(self):
+        # Setup
+        self.bedroom.last_properties = {'name': 'bedroom'}
+        self.registry.update_name(self.bedroom, 'bedroom')
+
+        # Exercise
+        self.bedroom.last_properties['name'] = 'study'
+
+        # Verify
+        assert self.registry.get_light_by_name('bedroom') is None
+        assert self.registry.get_light_by_name('study') is self.bedroom
+
+
+class FadeSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.scheduler = lights.FadeScheduler()
+        self.scheduler.start()
+
+    def create_fade(self, bulb, interval=0.1, step=10):
+        props = bulb.get_properties(lights._get_required_props())
+        return lights.Fade(bulb, interval, step, int(props['bright']), props, turn_off=False, retries=0)
+
+    def test_fades_share_one_thread(self):
+        # Setup
+        bulbs = [MockBulb('192.168.0.{}'.format(i), 'bulb{}'.format(i)) for i in range(50)]
+        threads_before = threading.active_count()
+
+        # Exercise
+        for bulb in bulbs:
+            self.scheduler.add(self.create_fade(bulb))
+        time.sleep(0.25)
+
+        # Verify
+        assert threading.active_count() == threads_before
+        assert len(self.scheduler.get_fades()) == 50
+        for bulb in bulbs:
+            assert bulb.get_properties(['bright'])['bright'] == 20
+
+    def test_finished_fades_are_removed(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'kitchen')
+
+        # Exercise
+        self.scheduler.add(self.create_fade(bulb, interval=0.01, step=25))
+        time.sleep(0.2)
+
+        # Verify
+        assert self.scheduler.get_fades() == []
+        assert bulb.get_properties(['bright'])['bright'] == 1
+
+    def test_cancel(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'kitchen')
+        fade_id = self.scheduler.add(self.create_fade(bulb))
+        time.sleep(0.05)
+
+        # Exercise
+        cancelled = self.scheduler.cancel(fade_id)
+        time.sleep(0.2)
+
+        # Verify
+        assert cancelled
+        assert self.scheduler.get_fades() == []
+        assert bulb.get_properties(['bright'])['bright'] == 40
+
+    def test_cancel_stops_fade(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'kitchen')
+        transport = mock.Mock()
+        props = bulb.get_properties(lights._get_required_props())
+        fade = lights.Fade(bulb, 0.1, 10, int(props['bright']), props, turn_off=False, retries=0, transport=transport)
+        native_fade = lights.NativeFade(bulb, 120, False)
+        self.scheduler.add(fade, delay=10)
+        self.scheduler.add(native_fade, delay=10)
+
+        # Exercise
+        self.scheduler.cancel(fade.id)
+        self.scheduler.cancel(native_fade.id)
+
+        # Verify
+        transport.release.assert_called_once_with(bulb)
+        assert fade.transport is None
+        assert bulb.stop_flow_count == 1
+        assert self.scheduler.get_fades() == []
+
+    def test_cancel_bulb(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'kitchen')
+        other_bulb = MockBulb('192.168.0.16', 'porch')
+        self.scheduler.add(self.create_fade(bulb))
+        other_fade = self.create_fade(other_bulb)
+        self.scheduler.add(other_fade)
+
+        # Exercise
+        cancelled = self.scheduler.cancel_bulb(bulb)
+
+        # Verify
+        assert [fade.bulb for fade in cancelled] == [bulb]
+        assert self.scheduler.get_fades() == [other_fade]
+
+    def test_reschedule(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'kitchen')
+        fade_id = self.scheduler.add(self.create_fade(bulb), delay=10)
+
+        # Exercise
+        rescheduled = self.scheduler.reschedule(fade_id, 0)
+        time.sleep(0.05)
+
+        # Verify
+        assert rescheduled
+        assert bulb.get_properties(['bright'])['bright'] == 40
+        assert not self.scheduler.reschedule(-1, 0)
+
+
+class RateGovernorTest(TestCase):
+
+    def test_bucket_starts_full(self):
+        # Setup
+        bucket = lights.TokenBucket(capacity=3, rate=1)
+
+        # Exercise
+        acquired = [bucket.try_acquire() for _ in range(4)]
+
+        # Verify
+        assert acquired == [True, True, True, False]
+        assert bucket.remaining() == 0
+
+    def test_bucket_refills(self):
+        # Setup
+        bucket = lights.TokenBucket(capacity=2, rate=20)
+        bucket.try_acquire(2)
+
+        # Exercise
+        time.sleep(0.06)
+
+        # Verify
+        assert bucket.remaining() == 1
+
+    def test_acquire_waits_for_tokens(self):
+        # Setup
+        bucket = lights.TokenBucket(capacity=1, rate=10)
+        bucket.try_acquire()
+        start = time.monotonic()
+
+        # Exercise
+        acquired = bucket.acquire(timeout=1)
+
+        # Verify
+        assert acquired
+        assert time.monotonic() - start >= 0.09
+
+    def test_acquire_rejects_when_wait_exceeds_timeout(self):
+        # Setup
+        bucket = lights.TokenBucket(capacity=1, rate=0.1)
+        bucket.try_acquire()
+        start = time.monotonic()
+
+        # Exercise
+        acquired = bucket.acquire(timeout=1)
+
+        # Verify
+        assert not acquired
+        assert time.monotonic() - start < 0.1
+
+    def test_governor_keeps_budget_per_bulb(self):
+        # Setup
+        governor = lights.RateGovernor(requests_per_minute=60, burst=2, wait_timeout=0)
+
+        # Exercise
+        governor.acquire('192.168.0.55')
+        governor.acquire('192.168.0.55')
+
+        # Verify
+        assert governor.remaining('192.168.0.55') == 0
+        assert governor.remaining('192.168.0.58') == 2
+        with self.assertRaises(lights.RateLimitExceeded):
+            governor.acquire('192.168.0.55')
+
+    @mock.patch('yeelight.Bulb.send_command')
+    def test_bulb_commands_go_through_governor(self, send_command):
+        # Setup
+        governor = lights.RateGovernor(requests_per_minute=60, burst=3, wait_timeout=0)
+        bulb = lights.DiscoveredBulb('192.168.0.55', governor=governor)
+        send_command.return_value = {'result': ['ok']}
+
+        # Exercise
+        bulb.stop_flow()
+        bulb.set_name('bedroom')
+
+        # Verify
+        assert send_command.call_count == 2
+        assert governor.remaining('192.168.0.55') == 1
+
+    def test_fade_step_postponed_without_budget(self):
+        # Setup
+        bulb = MockBulb('192.168.0.55', 'bedroom')
+        bulb.governor = lights.RateGovernor(requests_per_minute=60, burst=1, wait_timeout=0)
+        props = bulb.get_properties(lights._get_required_props())
+        fade = lights.Fade(bulb, 1, 10, 50, props, turn_off=False, retries=0)
+
+        # Exercise
+        delay = fade.run_step()
+
+        # Verify
+        assert delay == 1
+        assert bulb.get_properties(['bright'])['bright'] == 50
+
+
+class SlowBulb(MockBulb):
+
+    def __init__(self, ip, name, delay):
+        super().__init__(ip, name)
+        self.delay = delay
+
+    def start_flow(self, flow):
+        time.sleep(self.delay)
+        super().start_flow(flow)
+
+    def stop_flow(self):
+        raise lights.BulbException('Bulb closed the connection.')
+
+
+class FanOutTest(TestCase):
+
+    def setUp(self):
+        with mock.patch('iot_app.lights._initialize_lights', _initialize_lights):
+            self.light_manager = lights.LightManager()
+
+    def test_bulbs_called_concurrently(self):
+        # Setup
+        bulbs = [SlowBulb('192.168.0.{}'.format(i), 'bulb{}'.format(i), 0.2) for i in range(5)]
+        start = time.monotonic()
+
+        # Exercise
+        results = self.light_manager.start_disco(*bulbs)
+
+        # Verify
+        assert time.monotonic() - start < 0.5
+        assert [result.bulb for result in results] == bulbs
+        assert all(result.error is None for result in results)
+        assert all(bulb.start_flow_count == 1 for bulb in bulbs)
+
+    def test_unresponsive_bulb_times_out(self):
+        # Setup
+        slow_bulb = SlowBulb('192.168.0.15', 'kitchen', 0.5)
+        bulb = MockBulb('192.168.0.16', 'porch')
+
+        # Exercise
+        results = lights._fan_out(lambda b: b.start_flow(None), [slow_bulb, bulb], timeout=0.1)
+
+        # Verify
+        assert isinstance(results[0].error, TimeoutError)
+        assert results[1].error is None
+        assert bulb.start_flow_count == 1
+
+    def test_timeout_starts_with_call(self):
+        # Setup
+        slow_bulbs = [SlowBulb('192.168.0.{}'.format(i), 'slow{}'.format(i), 0.3)
+                      for i in range(lights.MAX_BULB_WORKERS)]
+        bulbs = [MockBulb('192.168.1.{}'.format(i), 'bulb{}'.format(i)) for i in range(4)]
+
+        # Exercise
+        results = lights._fan_out(lambda b: b.start_flow(None), slow_bulbs + bulbs, timeout=0.15)
+
+        # Verify
+        assert all(isinstance(result.error, TimeoutError) for result in results[:len(slow_bulbs)])
+        assert all(result.error is None for result in results[len(slow_bulbs):])
+        assert all(bulb.start_flow_count == 1 for bulb in bulbs)
+
+    def test_bulb_errors_reported_per_bulb(self):
+        # Setup
+        failing_bulb = SlowBulb('192.168.0.15', 'kitchen', 0)
+        bulb = MockBulb('192.168.0.16', 'porch')
+
+        # Exercise
+        results = self.light_manager.stop_flow(failing_bulb, bulb)
+
+        # Verify
+        assert isinstance(results[0].error, lights.BulbException)
+        assert results[1].error is None
+        assert bulb.stop_flow_count == 1
+
+    def test_fade_returns_started_fades(self):
+        # Setup
+        bulb = MockBulb('192.168.0.16', 'porch')
+
+        # Exercise
+        results = self.light_manager.fade(60, False, 5, bulb)
+        self.light_manager.stop_fade(bulb)
+
+        # Verify
+        assert isinstance(results[0].value, lights.Fade)
+        assert results[0].value.bulb is bulb
+
+    def test_deadline_leaves_slow_bulb_running(self):
+        # Setup
+        slow_bulb = SlowBulb('192.168.0.15', 'kitchen', 0.3)
+        bulb = MockBulb('192.168.0.16', 'porch')
+        start = time.monotonic()
+
+        # Exercise
+        results = self.light_manager.start_disco(slow_bulb, bulb, deadline=lights.Deadline(0.1))
+
+        # Verify
+        assert time.monotonic() - start < 0.25
+        assert isinstance(results[0].error, lights.DeadlineExceeded)
+        assert results[1].error is None
+        assert wait_for(lambda: slow_bulb.start_flow_count == 1)
+
+    def test_expired_deadline(self):
+        # Setup
+        deadline = lights.Deadline(0)
+
+        # Exercise
+        remaining = deadline.remaining()
+
+        # Verify
+        assert deadline.expired()
+        assert remaining == 0
+
+
+class JobQueueTest(TestCase):
+
+    def setUp(self):
+        with mock.patch('iot_app.lights._initialize_lights', _initialize_lights):
+            self.light_manager = lights.LightManager()
+        self.failed = []
+        self.jobs = lights.JobQueue(history=3, on_failure=self.failed.append)
+
+    def test_submit_returns_before_bulbs_answer(self):
+        # Setup
+        bulb = SlowBulb('192.168.0.15', 'kitchen', 0.3)
+        start = time.monotonic()
+
+        # Exercise
+        job = self.jobs.submit('start_disco', self.light_manager.start_disco, bulb)
+
+        # Verify
+        assert time.monotonic() - start < 0.1
+        assert job.status in (lights.JobStatus.PENDING, lights.JobStatus.RUNNING)
+        assert wait_for(lambda: job.status == lights.JobStatus.DONE)
+        assert bulb.start_flow_count == 1
+        assert self.jobs.get(job.id) is job
+        assert self.failed == []
+
+    def test_failed_bulbs_reported(self):
+        # Setup
+        failing_bulb = SlowBulb('192.168.0.15', 'kitchen', 0)
+        bulb = MockBulb('192.168.0.16', 'porch')
+
+        # Exercise
+        job = self.jobs.submit('stop_flow', self.light_manager.stop_flow, failing_bulb, bulb)
+
+        # Verify
+        assert wait_for(lambda: job.status == lights.JobStatus.FAILED)
+        assert wait_for(lambda: self.failed == [job])
+        assert [result.bulb for result in job.get_failures()] == [failing_bulb]
+        assert job.to_dict()['results'][1] == {'bulb': '192.168.0.16', 'error': None}
+
+    def test_unexpected_error_fails_job(self):
+        # Exercise
+        job = self.jobs.submit('broken', lambda: 1 / 0)
+
+        # Verify
+        assert wait_for(lambda: job.status == lights.JobStatus.FAILED)
+        assert 'division' in job.error
+
+    def test_wait_for_job(self):
+        # Setup
+        slow_bulb = SlowBulb('192.168.0.15', 'kitchen', 0.3)
+        bulb = MockBulb('192.168.0.16', 'porch')
+
+        # Exercise
+        job = self.jobs.submit('start_disco', self.light_manager.start_disco, slow_bulb, bulb,
+                               deadline=lights.Deadline(0.1))
+
+        # Verify
+        assert job.wait(1)
+        assert job.status == lights.JobStatus.DONE
+        assert isinstance(job.results[0].error, lights.DeadlineExceeded)
+        assert job.get_failures() == []
+        assert self.failed == []
+
+    def test_failure_flashed_only_after_stop(self):
+        # Setup
+        failing_bulb = SlowBulb('192.168.0.15', 'kitchen', 0)
+        bulb = MockBulb('192.168.0.16', 'porch')
+        disco = self.jobs.submit('start_disco', self.light_manager.start_disco, failing_bulb, bulb)
+        stop = self.jobs.submit('stop_flow', self.light_manager.stop_flow, failing_bulb, bulb)
+        assert stop.wait(2)
+
+        # Exercise
+        with mock.patch('iot_app.lights.LightManager') as light_manager, \
+                mock.patch('iot_app.lights.get_registry'):
+            lights._flash_failure(disco)
+            flashed_after_start = light_manager.return_value.notify.called
+            lights._flash_failure(stop)
+
+        # Verify
+        assert not flashed_after_start
+        light_manager.return_value.notify.assert_called_once_with(lights.NotificationLevel.WARNING, bulb)
+
+    def test_jobs_ordered_per_bulb(self):
+        # Setup
+        stuck_bulb = SlowBulb('192.168.0.15', 'kitchen', 0.5)
+        bulb = MockBulb('192.168.0.16', 'porch')
+        calls = []
+
+        # Exercise
+        stuck = self.jobs.submit('start_disco', self.light_manager.start_disco, stuck_bulb)
+        queued = self.jobs.submit('record', lambda light: calls.append(light.ip), stuck_bulb)
+        other = self.jobs.submit('start_disco', self.light_manager.start_disco, bulb)
+
+        # Verify
+        assert other.wait(0.3)
+        assert stuck.status == lights.JobStatus.RUNNING
+        assert queued.status == lights.JobStatus.PENDING
+        assert queued.wait(1)
+        assert calls == ['192.168.0.15']
+
+    def test_jobs_run_in_order_and_history_is_bounded(self):
+        # Setup
+        calls = []
+
+        # Exercise
+        jobs = [self.jobs.submit('record', calls.append, i) for i in range(5)]
+
+        # Verify
+        assert wait_for(lambda: jobs[-1].status == lights.JobStatus.DONE)
+        assert calls == list(range(5))
+        assert [job.id for job in self.jobs.get_jobs()] == [job.id for job in jobs[2:]]
+        assert self.jobs.get(jobs[0].id) is None
+
+
+class UnpluggedBulb(MockBulb):
+
+    def __init__(self, ip, name):
+        super().__init__(ip, name)
+        self.plugged_in = False
+        self.calls = 0
+
+    def get_properties(self, keys):
+        self.calls += 1
+        if not self.plugged_in:
+            raise lights.BulbException('A socket error occurred when sending the command.')
+        return super().get_properties(keys)
+
+    def start_flow(self, flow):
+        self.get_properties([])
+        super().start_flow(flow)
+
+    def set_brightness(self, brightness):
+        self.get_properties([])
+        super().set_brightness(brightness)
+
+
+class BulbHealthTest(TestCase):
+
+    def setUp(self):
+        self.health = lights.BulbHealth(failure_threshold=2, base_backoff=0.1, max_backoff=0.4)
+        self.bulb = UnpluggedBulb('192.168.0.15', 'kitchen')
+
+    def test_circuit_opens_after_repeated_failures(self):
+        # Setup
+        error = lights.BulbException('Bulb closed the connection.')
+
+        # Exercise
+        self.health.record(self.bulb, error)
+        available_after_one = self.health.is_available(self.bulb)
+        self.health.record(self.bulb, error)
+
+        # Verify
+        assert available_after_one
+        assert not self.health.is_available(self.bulb)
+        assert self.health.get_unavailable() == [self.bulb]
+        assert 0 < self.health.get_retry_delay(self.bulb) <= 0.1
+
+    def test_error_responses_do_not_count(self):
+        # Setup
+        error = lights.BulbException({'code': -1, 'message': 'method not supported'})
+
+        # Exercise
+        for _ in range(3):
+            self.health.record(self.bulb, error)
+            self.health.record(self.bulb, lights.DeadlineExceeded())
+
+        # Verify
+        assert self.health.is_available(self.bulb)
+
+    def test_fan_out_skips_unavailable_bulbs(self):
+        # Setup
+        bulb = MockBulb('192.168.0.16', 'porch')
+        lights._fan_out(lambda b: b.start_flow(None), [self.bulb], health=self.health)
+        lights._fan_out(lambda b: b.start_flow(None), [self.bulb], health=self.health)
+        calls = self.bulb.calls
+
+        # Exercise
+        results = lights._fan_out(lambda b: b.start_flow(None), [self.bulb, bulb], health=self.health)
+
+        # Verify
+        assert isinstance(results[0].error, lights.BulbUnavailable)
+        assert results[1].error is None
+        assert self.bulb.calls == calls
+
+    def test_probe_closes_circuit(self):
+        # Setup
+        error = lights.BulbException('Bulb closed the connection.')
+        self.health.record(self.bulb, error)
+        self.health.record(self.bulb, error)
+
+        # Exercise
+        assert wait_for(lambda: self.bulb.calls >= 2)
+        unavailable_while_unplugged = not self.health.is_available(self.bulb)
+        self.bulb.plugged_in = True
+
+        # Verify
+        assert unavailable_while_unplugged
+        assert wait_for(lambda: self.health.is_available(self.bulb))
+
+    def test_probe_survives_unexpected_errors(self):
+        # Setup
+        error = lights.BulbException('Bulb closed the connection.')
+        self.health.record(self.bulb, error)
+        self.health.record(self.bulb, error)
+
+        # Exercise
+        with mock.patch.object(self.bulb, 'get_properties', side_effect=[ValueError('garbled reply'), {}]):
+            assert wait_for(lambda: self.health.is_available(self.bulb))
+
+        # Verify
+        assert self.health.get_unavailable() == []
+
+    def test_fan_out_records_only_sent_calls(self):
+        # Setup
+        health = mock.Mock()
+        health.is_available.return_value = True
+        slow_bulbs = [SlowBulb('192.168.0.{}'.format(i), 'slow{}'.format(i), 0.2)
+                      for i in range(lights.MAX_BULB_WORKERS)]
+        bulb = MockBulb('192.168.1.1', 'porch')
+
+        # Exercise
+        results = lights._fan_out(lambda b: b.start_flow(None), slow_bulbs + [bulb], deadline=lights.Deadline(0.05),
+                                  health=health)
+        recorded = health.record.call_count
+
+        # Verify
+        assert isinstance(results[-1].error, lights.DeadlineExceeded)
+        assert recorded == 0
+        assert wait_for(lambda: bulb.start_flow_count == 1)
+        assert wait_for(lambda: [args[0] for args, _ in health.record.call_args_list].count(bulb) == 1)
+
+    def test_stop_fade_cancels_fade_on_unavailable_bulb(self):
+        # Setup
+        registry = lights.BulbRegistry(refresh_interval=None)
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[self.bulb]):
+            registry.start()
+        scheduler = lights.FadeScheduler()
+        light_manager = lights.LightManager(default_room='kitchen', registry=registry, scheduler=scheduler)
+        props = {'bright': 50, 'ct': 6500, 'rgb': 256, 'power': 'on'}
+        scheduler.add(lights.Fade(self.bulb, 1, 10, 50, props, turn_off=False, retries=5))
+        error = lights.BulbException('Bulb closed the connection.')
+        registry.get_health().record(self.bulb, error)
+        registry.get_health().record(self.bulb, error)
+
+        # Exercise
+        results = light_manager.stop_fade(self.bulb)
+
+        # Verify
+        assert scheduler.get_fades() == []
+        assert results[0].error is None
+
+    def test_fade_waits_for_probe(self):
+        # Setup
+        props = {'bright': 50, 'ct': 6500, 'rgb': 256, 'power': 'on'}
+        fade = lights.Fade(self.bulb, 1, 10, 50, props, turn_off=False, retries=5, health=self.health)
+        error = lights.BulbException('Bulb closed the connection.')
+        self.health.record(self.bulb, error)
+        self.health.record(self.bulb, error)
+        calls = self.bulb.calls
+
+        # Exercise
+        delay = fade.run_step()
+
+        # Verify
+        assert delay == 1
+        assert fade.retries == 4
+        assert self.bulb.calls == calls
+
+
+class NativeFadeTest(TestCase):
+
+    def setUp(self):
+        with mock.patch('iot_app.lights._initialize_lights', _initialize_lights):
+            self.light_manager = lights.LightManager()
+
+        self.bulb = MockBulb('192.168.0.15', 'kitchen')
+        self.bulb.discovery_data = {'support': 'get_prop set_bright start_cf stop_cf'}
+        self.bulb.props.update({'color_mode': 2, 'hue': 0, 'sat': 0, 'bright': 80, 'ct': 2700})
+
+    def tearDown(self):
+        self.light_manager.stop_fade(self.bulb)
+
+    def test_fade_runs_on_bulb(self):
+        # Exercise
+        results = self.light_manager.fade(120, False, 5, self.bulb)
+
+        # Verify
+        flow = self.bulb.flow_called_with
+        assert isinstance(results[0].value, lights.NativeFade)
+        assert self.bulb.start_flow_count == 1
+        assert flow.count == 1
+        assert flow.action == lights.Flow.actions.stay
+        assert len(flow.transitions) == 1
+        assert flow.transitions[0].duration == 120000
+        assert flow.transitions[0].brightness == 1
+        assert flow.transitions[0].degrees == 2700
+
+    def test_new_flow_cancels_fade(self):
+        # Setup
+        self.light_manager.fade(600, False, 5, self.bulb)
+
+        # Exercise
+        self.light_manager.start_disco(self.bulb)
+        self.light_manager.stop_fade(self.bulb)
+
+        # Verify
+        assert [fade for fade in self.light_manager.get_active_fades() if fade.bulb is self.bulb] == []
+        assert self.bulb.stop_flow_count == 0
+
+    def test_long_fade_split_into_transitions(self):
+        # Exercise
+        self.light_manager.fade(90 * 60, True, 5, self.bulb)
+
+        # Verify
+        flow = self.bulb.flow_called_with
+        assert flow.action == lights.Flow.actions.off
+        assert [t.duration for t in flow.transitions] == [30 * 60 * 1000] * 3
+        assert [t.brightness for t in flow.transitions] == [54, 27, 1]
+
+    def test_fade_keeps_colour(self):
+        # Setup
+        self.bulb.props.update({'color_mode': 1, 'rgb': 0xFF8000})
+
+        # Exercise
+        self.light_manager.fade(60, False, 5, self.bulb)
+
+        # Verify
+        transition = self.bulb.flow_called_with.transitions[0]
+        assert (transition.red, transition.green, transition.blue) == (255, 128, 0)
+
+    def test_fade_steps_when_flow_unsupported(self):
+        # Setup
+        self.bulb.discovery_data = {'support': 'get_prop set_bright'}
+
+        # Exercise
+        results = self.light_manager.fade(60, False, 5, self.bulb)
+
+        # Verify
+        assert isinstance(results[0].value, lights.Fade)
+        assert self.bulb.start_flow_count == 0
+
+    def test_stop_fade_stops_flow(self):
+        # Setup
+        self.light_manager.fade(120, False, 5, self.bulb)
+
+        # Exercise
+        self.light_manager.stop_fade(self.bulb)
+
+        # Verify
+        assert self.bulb.stop_flow_count == 1
+        assert self.bulb not in [fade.bulb for fade in self.light_manager.get_active_fades()]
+
+
+class NotifyingBulbServer:
+    """Accepts state connections and pushes props notifications to them."""
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(4)
+        self.port = self.server.getsockname()[1]
+        self.connections = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+
+    def push(self, props):
+        message = json.dumps({'method': 'props', 'params': props}) + '\r\n'
+        for connection in self.connections:
+            connection.sendall(message.encode('utf8'))
+
+    def close(self):
+        self.server.close()
+        for connection in self.connections:
+            connection.close()
+
+
+class BulbStateCacheTest(TestCase):
+
+    def setUp(self):
+        self.server = NotifyingBulbServer()
+        self.bulb = MockBulb('127.0.0.1', 'bedroom')
+        self.bulb.port = self.server.port
+        self.bulb.props.update({'hue': 0, 'sat': 0, 'color_mode': 2})
+        self.cache = lights.BulbStateCache()
+        self.cache.watch(self.bulb)
+        assert wait_for(lambda: self.cache.is_live(self.bulb) and self.server.connections)
+
+    def tearDown(self):
+        self.cache.unwatch(self.bulb)
+        self.server.close()
+
+    def test_state_read_from_snapshot(self):
+        # Exercise
+        props = self.cache.get_properties(self.bulb, ['power', 'bright'])
+
+        # Verify
+        assert props == {'power': 'on', 'bright': '50'}
+
+    def test_notifications_update_state(self):
+        # Setup
+        changes = []
+        self.cache.subscribe(self.bulb, lambda bulb, props: changes.append(props))
+
+        # Exercise
+        self.server.push({'bright': 20, 'power': 'off'})
+
+        # Verify
+        assert wait_for(lambda: changes == [{'bright': 20, 'power': 'off'}])
+        assert self.cache.get_properties(self.bulb, ['power', 'bright']) == {'power': 'off', 'bright': '20'}
+
+    def test_not_live_after_disconnect(self):
+        # Exercise
+        self.server.close()
+
+        # Verify
+        assert wait_for(lambda: not self.cache.is_live(self.bulb))
+        assert self.cache.get_properties(self.bulb, ['bright']) is None
+
+    def test_fade_steps_read_cache(self):
+        # Setup
+        scheduler = lights.FadeScheduler()
+        props = self.cache.get_properties(self.bulb, lights._get_required_props())
+        fade = lights.Fade(self.bulb, 0.05, 10, 50, props, False, 0, state_cache=self.cache)
+        fade.attach(scheduler)
+
+        # Exercise
+        with mock.patch.object(self.bulb, 'get_properties') as get_properties:
+            scheduler.start()
+            scheduler.add(fade)
+            time.sleep(0.02)
+            self.server.push({'bright': 40})
+            time.sleep(0.05)
+
+            fade.stop()
+
+        # Verify
+        get_properties.assert_not_called()
+        assert self.bulb.get_properties(['bright'])['bright'] == 30
+
+    def test_fractional_step_not_taken_for_foreign_change(self):
+        # Setup
+        scheduler = lights.FadeScheduler()
+        props = self.cache.get_properties(self.bulb, lights._get_required_props())
+        fade = lights.Fade(self.bulb, 0.1, 50 / 6, 50, props, False, 0, state_cache=self.cache)
+        fade.attach(scheduler)
+        sent = []
+
+        def set_brightness(brightness):
+            #  yeelight truncates to a whole level, and the bulb reports back the level it set
+            sent.append(brightness)
+            self.bulb.props['bright'] = int(brightness)
+            self.server.push({'bright': int(brightness)})
+
+        # Exercise
+        with mock.patch.object(self.bulb, 'set_brightness', side_effect=set_brightness):
+            scheduler.start()
+            scheduler.add(fade)
+            assert wait_for(lambda: scheduler.get_fades() == [], timeout=3)
+
+        # Verify
+        assert sent == [42, 34, 26, 18, 10, 2, 1]
+
+    def test_foreign_change_cancels_fade(self):
+        # Setup
+        scheduler = lights.FadeScheduler()
+        props = self.cache.get_properties(self.bulb, lights._get_required_props())
+        fade = lights.Fade(self.bulb, 10, 10, 50, props, False, 0, state_cache=self.cache)
+        fade.attach(scheduler)
+        scheduler.add(fade, delay=10)
+
+        # Exercise
+        self.server.push({'rgb': 255})
+
+        # Verify
+        assert wait_for(lambda: scheduler.get_fades() == [])
+
+    def test_ended_flow_cancels_native_fade(self):
+        # Setup
+        scheduler = lights.FadeScheduler()
+        fade = lights.NativeFade(self.bulb, 600, False, state_cache=self.cache)
+        fade.attach(scheduler)
+        scheduler.add(fade, delay=600)
+
+        # Exercise
+        self.server.push({'flowing': 0})
+
+        # Verify
+        assert wait_for(lambda: scheduler.get_fades() == [])
+        assert self.bulb.stop_flow_count == 0
+
+    def test_registry_follows_renames(self):
+        # Setup
+        registry = lights.BulbRegistry(refresh_interval=None)
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[self.bulb]):
+            registry.start()
+        assert wait_for(lambda: registry.get_state_cache().is_live(self.bulb) and len(self.server.connections) == 2)
+
+        # Exercise
+        self.server.push({'name': 'study'})
+
+        # Verify
+        assert wait_for(lambda: registry.get_light_by_name('study') is self.bulb)
+        assert registry.get_light_by_name('bedroom') is None
+        registry.get_state_cache().unwatch(self.bulb)
+
+
+class FakeMusicBulb:
+    """Answers commands like a bulb and connects back to the caller on set_music."""
+
+    def __init__(self):
+        self.props = {'power': 'on', 'bright': '50', 'ct': '4000', 'rgb': '0', 'name': 'kitchen'}
+        self.commands = []
+        self.music_commands = []
+        self.connections = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(4)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(connection, self.commands), daemon=True).start()
+
+    def serve(self, connection, log, reply=True):
+        self.connections.append(connection)
+        for command in self.read_commands(connection):
+            log.append(command)
+            if command['method'] == 'get_prop':
+                result = [self.props.get(key, '') for key in command['params']]
+            else:
+                result = ['ok']
+            if reply:
+                connection.sendall((json.dumps({'id': command['id'], 'result': result}) + '\r\n').encode('utf8'))
+            if command['method'] == 'set_music' and command['params'][0] == 1:
+                music_connection = socket.create_connection(tuple(command['params'][1:]))
+                threading.Thread(
+                    target=self.serve, args=(music_connection, self.music_commands, False), daemon=True).start()
+
+    @staticmethod
+    def read_commands(connection):
+        buffer = b''
+        while True:
+            try:
+                data = connection.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            *lines, buffer = (buffer + data).split(b'\r\n')
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf8'))
+
+    def close(self):
+        self.server.close()
+        for connection in self.connections:
+            connection.close()
+
+
+class MusicModeTransportTest(TestCase):
+
+    def setUp(self):
+        self.fake_bulb = FakeMusicBulb()
+        self.governor = lights.RateGovernor(requests_per_minute=60, burst=5, wait_timeout=0)
+        self.bulb = lights.DiscoveredBulb('127.0.0.1', self.fake_bulb.port, governor=self.governor,
+                                          discovery_data={'support': 'get_prop set_bright set_music start_cf'})
+        self.transport = lights.MusicModeTransport(idle_timeout=0.2)
+
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[]):
+            self.light_manager = lights.LightManager(transport=self.transport, scheduler=lights.FadeScheduler())
+
+    def tearDown(self):
+        self.transport.close(self.bulb)
+        self.fake_bulb.close()
+
+    def test_notify_through_music_mode(self):
+        # Exercise
+        results = self.light_manager.notify(lights.NotificationLevel.OK, self.bulb, music=True)
+
+        # Verify
+        assert results[0].error is None
+        assert self.bulb.music_mode
+        assert wait_for(lambda: [c['method'] for c in self.fake_bulb.music_commands] == ['start_cf'])
+
+    def test_music_mode_left_when_idle(self):
+        # Setup
+        self.light_manager.start_disco(self.bulb, music=True)
+
+        # Exercise
+        time.sleep(0.3)
+
+        # Verify
+        assert not self.bulb.music_mode
+        assert self.fake_bulb.commands[-1]['params'] == [0]
+
+    def test_fade_not_limited_in_music_mode(self):
+        # Setup
+        scheduler = lights.FadeScheduler()
+        scheduler.start()
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[]):
+            light_manager = lights.LightManager(transport=self.transport, scheduler=scheduler)
+
+        # Exercise
+        light_manager.fade(1, True, 0, self.bulb, native=False, music=True)
+        time.sleep(1.5)
+
+        # Verify
+        methods = [c['method'] for c in self.fake_bulb.music_commands]
+        assert methods.count('set_bright') == 10
+        assert methods[-1] == 'set_power'
+        assert light_manager.get_active_fades() == []
+
+    def test_switching_does_not_block_other_bulbs(self):
+        # Setup
+        switching = threading.Event()
+        other_bulb = mock.Mock(ip='127.0.0.2', music_mode=True, discovery_data={'support': 'set_music'})
+        self.transport.acquire(other_bulb)
+
+        def start_music(port=0, **kwargs):
+            switching.wait(2)
+            raise lights.BulbException('Bulb did not connect back.')
+
+        # Exercise
+        with mock.patch.object(self.bulb, 'start_music', side_effect=start_music):
+            acquiring = threading.Thread(target=self.transport.acquire, args=(self.bulb,))
+            acquiring.start()
+            time.sleep(0.05)
+            start = time.monotonic()
+            self.transport.release(other_bulb)
+            acquired = self.transport.acquire(other_bulb)
+            elapsed = time.monotonic() - start
+            switching.set()
+            acquiring.join()
+
+        # Verify
+        assert acquired
+        assert elapsed < 0.1
+        self.transport.close(other_bulb)
+
+    def test_unsupported_bulb_uses_normal_connection(self):
+        # Setup
+        bulb = MockBulb('192.168.0.15', 'porch')
+
+        # Exercise
+        self.light_manager.notify(lights.NotificationLevel.OK, bulb, music=True)
+
+        # Verify
+        assert bulb.start_flow_count == 1
+        assert not self.transport.acquire(bulb)
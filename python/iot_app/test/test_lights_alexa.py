@@ -6,7 +6,7 @@ import yaml
 lights_module = mock.MagicMock()
 lights_module.LightManager = mock.MagicMock()
 sys.modules['iot_app.lights'] = lights_module
-from iot_app.alexa import LightAction
+from iot_app.alexa import LightAction, BulbException, BulbResult, BulbUnavailable, DeadlineExceeded
 
 
 class LightsAlexaTest(TestCase):
@@ -385,6 +385,115 @@ class LightsAlexaTest(TestCase):
         assert 'PlainText' == text_type
         assert 'I\'m afraid the light called porch is not available' == card_text
 
+    @mock.patch('iot_app.alexa.render_template')
+    def test_stop_fade_light_not_responding(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.is_available.return_value = False
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager,
+                               card_title='Card title', card_img='Card image').stop_fade(room='kitchen')
+        # Verify
+        r = response._response
+        output_speech = r['outputSpeech']['text']
+
+        self.light_manager.stop_fade.assert_called_once_with('kitchen')
+        assert 'OK' in output_speech
+
+    @mock.patch('iot_app.alexa.render_template')
+    def test_start_disco_partly_failed(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.get_light_name.side_effect = lambda bulb: bulb
+        self.light_manager.start_disco.return_value = [
+            BulbResult('bedroom', None, None),
+            BulbResult('kitchen', None, BulbException('Bulb closed the connection.')),
+            BulbResult('lounge', None, BulbUnavailable('Not responding, skipped')),
+        ]
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager,
+                               card_title='Card title', card_img='Card image').start_disco(room='everywhere')
+        # Verify
+        r = response._response
+        output_speech = r['outputSpeech']['text']
+        card_text = r['card']['text']
+
+        expected = 'Done, but kitchen did not respond. I skipped lounge as it has stopped responding.'
+        assert expected == output_speech
+        assert expected == card_text
+
+    @mock.patch('iot_app.alexa.render_template')
+    def test_start_disco_all_failed(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.start_disco.return_value = [
+            BulbResult('kitchen', None, BulbException('Bulb closed the connection.')),
+            BulbResult('lounge', None, BulbUnavailable('Not responding, skipped')),
+        ]
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager,
+                               card_title='Card title', card_img='Card image').start_disco(room='everywhere')
+        # Verify
+        output_speech = response._response['outputSpeech']['text']
+
+        assert 'Sorry. None of the lights responded.' == output_speech
+
+    @mock.patch('iot_app.alexa.render_template')
+    def test_start_disco_not_confirmed_by_deadline(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.start_disco.return_value = [
+            BulbResult('lounge', None, DeadlineExceeded('Still running at the deadline')),
+        ]
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager,
+                               card_title='Card title', card_img='Card image').start_disco(room='lounge')
+        # Verify
+        output_speech = response._response['outputSpeech']['text']
+
+        assert 'The lights have not answered yet. They will catch up in the background.' == output_speech
+
+    @mock.patch('iot_app.alexa.render_template')
+    def test_start_disco_light_not_responding(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.is_available.return_value = False
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager,
+                               card_title='Card title', card_img='Card image').start_disco(room='lounge')
+        # Verify
+        r = response._response
+        output_speech = r['outputSpeech']['text']
+        card_text = r['card']['text']
+
+        self.light_manager.start_disco.assert_not_called()
+        assert 'Sorry. The lounge light has stopped responding.' == output_speech
+        assert 'Sorry. The lounge light has stopped responding.' == card_text
+
+    @mock.patch('iot_app.alexa.render_template')
+    def test_queued_job_not_given_deadline(self, mock_render):
+        # Setup
+        mock_render.side_effect = self.render_effect
+        self.light_manager.start_disco.__name__ = 'start_disco'
+        jobs = mock.MagicMock()
+        jobs.submit.return_value.wait.return_value = False
+        deadline = mock.MagicMock()
+        deadline.remaining.return_value = 0
+
+        # Exercise
+        response = LightAction(light_manager=self.light_manager, card_title='Card title', card_img='Card image',
+                               jobs=jobs, deadline=deadline).start_disco(room='lounge')
+        # Verify
+        output_speech = response._response['outputSpeech']['text']
+
+        jobs.submit.assert_called_once_with('start_disco', self.light_manager.start_disco, 'lounge')
+        assert 'The lights have not answered yet. They will catch up in the background.' == output_speech
+
     if __name__ == '__main__':
         main()
 
@@ -0,0 +1,572 @@
+from unittest import main, mock, TestCase
+import multiprocessing, os, socket, tempfile, threading, time
+
+from iot_app.sensors import CompressedSeries, ReadingLog, ReadingStore, RollingWindow, RollupBuffer, SensorHistory,\
+    SharedReadings, UdpIngest, parse_datagram
+from iot_app.test import wait_for
+
+
+class SensorHistoryTest(TestCase):
+
+    def test_record_per_metric(self):
+        # Setup
+        history = SensorHistory(capacity=5)
+
+        # Exercise
+        history.record('temp', '21', timestamp=1)
+        history.record('humidity', '40', timestamp=1)
+        history.record('temp', '22', timestamp=2)
+
+        # Verify
+        assert history.get_range('temp') == [(1, 21.0), (2, 22.0)]
+        assert history.get_range('humidity', 0, 1) == [(1, 40.0)]
+        assert sorted(history.get_metrics()) == ['humidity', 'temp']
+
+    def test_unknown_metric(self):
+        # Setup
+        history = SensorHistory()
+
+        # Exercise & Verify
+        with self.assertRaises(KeyError):
+            history.get_range('pressure')
+
+
+class CompressedSeriesTest(TestCase):
+
+    def test_round_trip(self):
+        # Setup
+        series = CompressedSeries(1000, chunk_size=50)
+        readings = [(1500000000 + i * 5 + (i % 3) * 0.125, float(20 + (i // 7) % 3) + (0.5 if i % 11 == 0 else 0))
+                    for i in range(200)]
+
+        # Exercise
+        for timestamp, value in readings:
+            series.append(timestamp, value)
+
+        # Verify
+        assert series.get_range() == readings
+        assert series.latest() == readings[-1]
+        assert series.get_encoded_size() < 16 * len(readings) / 3
+
+    def test_range_across_chunks(self):
+        # Setup
+        series = CompressedSeries(1000, chunk_size=10)
+        for i in range(100):
+            series.append(i, i % 4)
+
+        # Exercise
+        readings = series.get_range(8, 22)
+
+        # Verify
+        assert [timestamp for timestamp, _ in readings] == list(range(8, 23))
+        assert series.get_range(200, 300) == []
+
+    def test_drops_oldest_chunks(self):
+        # Setup
+        series = CompressedSeries(25, chunk_size=10)
+
+        # Exercise
+        for i in range(100):
+            series.append(i, 1)
+
+        # Verify
+        assert 25 <= len(series) < 35
+        assert series.get_range()[-1] == (99, 1)
+
+    def test_negative_and_large_changes(self):
+        # Setup
+        series = CompressedSeries(100)
+        readings = [(10, -5.5), (12, 1e6), (12, 1e6), (100, 0.0), (100.001, -0.0)]
+
+        # Exercise
+        for timestamp, value in readings:
+            series.append(timestamp, value)
+
+        # Verify
+        assert series.get_range() == readings
+        with self.assertRaises(ValueError):
+            series.append(99, 1)
+
+
+class RollupBufferTest(TestCase):
+
+    def test_aggregates_per_bucket(self):
+        # Setup
+        rollup = RollupBuffer(60, 10)
+
+        # Exercise
+        for timestamp, value in [(0, 20), (30, 22), (59, 24), (60, 10), (150, 30)]:
+            rollup.add(timestamp, value)
+
+        # Verify
+        assert rollup.get_range() == [(0, 22, 20, 24, 3), (60, 10, 10, 10, 1), (120, 30, 30, 30, 1)]
+        assert rollup.get_range(70, 100) == [(60, 10, 10, 10, 1)]
+        assert rollup.get_range(start=120) == [(120, 30, 30, 30, 1)]
+
+    def test_retention(self):
+        # Setup
+        rollup = RollupBuffer(60, 3)
+
+        # Exercise
+        for i in range(10):
+            rollup.add(i * 60, i)
+
+        # Verify
+        assert [row[0] for row in rollup.get_range()] == [420, 480, 540]
+
+
+class SensorHistoryRollupTest(TestCase):
+
+    def setUp(self):
+        self.history = SensorHistory(capacity=100, tiers=[(60, 600), (3600, 36000)])
+        for i in range(720):
+            self.history.record('temp', 20 + i % 2, timestamp=i * 5)
+
+    def test_picks_coarsest_tier(self):
+        # Exercise
+        resolution, rollups = self.history.get_rollups('temp', 1800, 0, 3600)
+
+        # Verify
+        assert resolution == 60
+        assert len(rollups) == 10
+
+    def test_coarse_resolution(self):
+        # Exercise
+        resolution, rollups = self.history.get_rollups('temp', 86400)
+
+        # Verify
+        assert resolution == 3600
+        assert rollups == [(0, 20.5, 20, 21, 720)]
+
+    def test_fine_resolution_returns_raw(self):
+        # Exercise
+        resolution, readings = self.history.get_rollups('temp', 5, 3590)
+
+        # Verify
+        assert resolution == 0
+        assert readings == [(3590, 20), (3595, 21)]
+
+
+class ReadingStoreTest(TestCase):
+
+    def setUp(self):
+        self.store = ReadingStore(capacity=10)
+        self.store.register('board1', 'bedroom')
+        self.store.register('board2', 'bedroom')
+        self.store.register('board3', 'lounge')
+
+    def test_latest_per_device(self):
+        # Exercise
+        self.store.record('board1', 'temp', '20', timestamp=1)
+        self.store.record('board1', 'temp', '21', timestamp=2)
+
+        # Verify
+        assert self.store.get_latest('temp', device_id='board1') == 21
+        assert self.store.get_latest('temp', device_id='board2') is None
+        assert self.store.get_history('board1', 'temp') == [(1, 20), (2, 21)]
+
+    def test_average_per_room_and_overall(self):
+        # Exercise
+        self.store.record('board1', 'temp', 20)
+        self.store.record('board2', 'temp', 22)
+        self.store.record('board3', 'temp', 27)
+        self.store.record('board1', 'temp', 18)
+
+        # Verify
+        assert self.store.get_latest('temp', room='bedroom') == 20
+        assert self.store.get_latest('temp', room='LOUNGE') == 27
+        assert self.store.get_latest('temp') == 67 / 3
+        assert self.store.get_latest('humidity') is None
+        assert self.store.get_latest('temp', room='kitchen') is None
+
+    def test_move_device_to_other_room(self):
+        # Setup
+        self.store.record('board1', 'temp', 20)
+        self.store.record('board3', 'temp', 26)
+
+        # Exercise
+        self.store.register('board1', 'lounge')
+
+        # Verify
+        assert self.store.get_latest('temp', room='bedroom') is None
+        assert self.store.get_latest('temp', room='lounge') == 23
+        assert sorted(device.id for device in self.store.get_devices('lounge')) == ['board1', 'board3']
+
+    def test_unregistered_device_counts_overall(self):
+        # Exercise
+        self.store.record('unknown', 'humidity', 40)
+
+        # Verify
+        assert self.store.get_latest('humidity') == 40
+        assert self.store.get_device('unknown').room is None
+
+    def test_invalid_reading_not_counted(self):
+        # Setup
+        self.store.record('board1', 'temp', 20, timestamp=5)
+
+        # Exercise & Verify
+        with self.assertRaises(ValueError):
+            self.store.record('board1', 'temp', 'nan?')
+        with self.assertRaises(ValueError):
+            self.store.record('board1', 'temp', 30, timestamp=4)
+        assert self.store.get_latest('temp') == 20
+
+    def test_record_many(self):
+        # Setup
+        readings = [
+            ('board1', {'temp': 21, 'humidity': 40}, 20),
+            ('board1', {'temp': 20}, 10),
+            ('board3', {'temp': 'warm'}, 10),
+            ('board2', {'humidity': 50}, None),
+        ]
+
+        # Exercise
+        errors = self.store.record_many(readings)
+
+        # Verify
+        assert errors == [None, None, 'invalid value', None]
+        assert self.store.get_history('board1', 'temp') == [(10, 20), (20, 21)]
+        assert self.store.get_latest('humidity', room='bedroom') == 45
+        assert self.store.get_device('board3').latest == {}
+
+    def test_record_many_rejects_whole_reading(self):
+        # Setup
+        self.store.record('board1', 'temp', 20, timestamp=30)
+
+        # Exercise
+        errors = self.store.record_many([('board1', {'humidity': 40, 'temp': 19}, 25)])
+
+        # Verify
+        assert errors[0] is not None
+        assert self.store.get_latest('humidity') is None
+
+    def test_non_finite_values_rejected(self):
+        # Exercise
+        errors = self.store.record_many([('board1', {'temp': 'nan'}, 1), ('board1', {'temp': float('inf')}, 2)])
+        self.store.record('board1', 'temp', 21, timestamp=3)
+
+        # Verify
+        assert errors == ['invalid value', 'invalid value']
+        assert self.store.get_latest('temp', room='bedroom') == 21
+
+    def test_record_many_rejects_unusable_timestamps(self):
+        # Setup
+        readings = [
+            ('board1', {'temp': 21}, -5),
+            ('board1', {'temp': 22}, float('inf')),
+            ('board1', {'temp': 23}, time.time() * 1000),
+            ('board2', {'temp': 24}, 10),
+        ]
+
+        # Exercise
+        errors = self.store.record_many(readings)
+
+        # Verify
+        assert [error is None for error in errors] == [False, False, False, True]
+        assert self.store.get_device('board1').latest == {}
+        assert self.store.get_latest('temp', device_id='board2') == 24
+
+    def test_version_changes_on_record(self):
+        # Setup
+        version = self.store.version
+
+        # Exercise
+        self.store.record('board1', 'temp', 20)
+        errors = self.store.record_many([('board1', {'temp': 'hot'}, None)])
+
+        # Verify
+        assert errors == ['invalid value']
+        assert self.store.version == version + 1
+
+    def test_wait_for_change(self):
+        # Setup
+        version = self.store.version
+        threading.Timer(0.05, self.store.record, args=('board1', 'temp', 20)).start()
+
+        # Exercise
+        changed = self.store.wait_for_change(version, timeout=2)
+
+        # Verify
+        assert changed == version + 1
+        assert self.store.wait_for_change(changed, timeout=0.01) == changed
+
+    def test_unknown_device(self):
+        # Exercise & Verify
+        with self.assertRaises(KeyError):
+            self.store.get_latest('temp', device_id='missing')
+
+
+class RollingWindowTest(TestCase):
+
+    def test_summary(self):
+        # Setup
+        window = RollingWindow(3600, 60)
+
+        # Exercise
+        for i, value in enumerate([20, 18, 25, 21]):
+            window.add(1000 + i * 600, value)
+        summary = window.get_summary(3000)
+
+        # Verify
+        assert summary.count == 4
+        assert summary.mean == 21
+        assert summary.minimum == 18
+        assert summary.maximum == 25
+
+    def test_trend_per_hour(self):
+        # Setup
+        window = RollingWindow(3600, 60)
+
+        # Exercise
+        for i in range(60):
+            window.add(i * 30, 20 + i * 30 / 3600 * 2)
+
+        # Verify
+        assert abs(window.get_summary(1800).trend - 2) < 1e-6
+
+    def test_old_readings_expire(self):
+        # Setup
+        window = RollingWindow(3600, 60)
+        window.add(0, 5)
+        window.add(300, 30)
+        window.add(3000, 20)
+        window.add(3700, 22)
+
+        # Exercise
+        summary = window.get_summary(3800)
+
+        # Verify
+        assert summary.count == 3
+        assert summary.minimum == 20
+        assert summary.maximum == 30
+        assert window.get_summary(3800 + 7200) is None
+
+    def test_extremes_over_many_readings(self):
+        # Setup
+        window = RollingWindow(3600, 60)
+
+        # Exercise
+        for i in range(10000):
+            window.add(i * 5, i % 7)
+
+        # Verify
+        summary = window.get_summary(10000 * 5)
+        assert summary.minimum == 0
+        assert summary.maximum == 6
+        assert 3600 // 5 <= summary.count <= (3600 + 60) // 5
+
+
+class RollingStatsStoreTest(TestCase):
+
+    def test_summary_per_device_and_room(self):
+        # Setup
+        store = ReadingStore(capacity=10)
+        store.register('board1', 'bedroom')
+        store.register('board2', 'lounge')
+        store.record_many([('board1', {'temp': 20}, 1000), ('board1', {'temp': 22}, 1300),
+                           ('board2', {'temp': 26}, 1200)])
+
+        # Exercise
+        device = store.get_summary('temp', 'hour', device_id='board1', now=1400)
+        room = store.get_summary('temp', 'day', room='lounge', now=1400)
+        overall = store.get_summary('temp', 'week', now=1400)
+
+        # Verify
+        assert device.mean == 21 and device.minimum == 20 and device.maximum == 22
+        assert room.mean == 26
+        assert overall.count == 3 and overall.maximum == 26
+        assert store.get_summary('humidity', 'day', now=1400) is None
+
+
+class UdpIngestTest(TestCase):
+
+    def setUp(self):
+        self.store = ReadingStore(capacity=10)
+        self.ingest = UdpIngest(self.store, 'secret', host='127.0.0.1', port=0).start()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.socket.close()
+        self.ingest.stop()
+
+    def test_parse_datagram(self):
+        # Exercise
+        readings = parse_datagram(b'secret board1 temp=21,humidity=40 1500000000\nsecret board2 temp=19.5\n', b'secret')
+
+        # Verify
+        assert readings == [('board1', {'temp': 21, 'humidity': 40}, 1500000000), ('board2', {'temp': 19.5}, None)]
+
+    def test_parse_datagram_malformed(self):
+        # Verify
+        assert parse_datagram(b'wrong board1 temp=21', b'secret') is None
+        assert parse_datagram(b'secret board1 temp=hot', b'secret') is None
+        assert parse_datagram(b'secret board1 pressure=1000', b'secret') is None
+        assert parse_datagram(b'secret board1 temp=21\nsecret', b'secret') is None
+        assert parse_datagram(b'\xff\xfe', b'secret') is None
+        assert parse_datagram(b'secret board1 temp=21 -5', b'secret') is None
+        assert parse_datagram(b'secret board1 temp=21 inf', b'secret') is None
+        assert parse_datagram(b'secret board1 temp=21 1500000000000', b'secret') is None
+
+    def test_records_datagrams(self):
+        # Exercise
+        self.socket.sendto(b'secret board1 temp=21,humidity=40', ('127.0.0.1', self.ingest.port))
+        self.socket.sendto(b'secret board1 temp=oops', ('127.0.0.1', self.ingest.port))
+
+        # Verify
+        assert wait_for(lambda: self.ingest.dropped == 1)
+        assert self.ingest.received == 2
+        assert self.store.get_latest('temp', device_id='board1') == 21
+        assert self.store.get_latest('humidity', device_id='board1') == 40
+
+    def test_listener_survives_failing_datagram(self):
+        # Setup
+        with mock.patch.object(self.store, 'record_many', side_effect=[OverflowError('bad'), [None]]):
+
+            # Exercise
+            self.socket.sendto(b'secret board1 temp=21', ('127.0.0.1', self.ingest.port))
+            assert wait_for(lambda: self.ingest.dropped == 1)
+            self.socket.sendto(b'secret board1 temp=22', ('127.0.0.1', self.ingest.port))
+
+            # Verify
+            assert wait_for(lambda: self.ingest.received == 2)
+            assert self.ingest.dropped == 1
+
+
+class ReadingLogTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'readings.db')
+        self.log = ReadingLog(self.path, flush_interval=0.05)
+        self.store = ReadingStore(capacity=10)
+        self.store.subscribe(self.log.append)
+
+    def tearDown(self):
+        self.log.close()
+        self.directory.cleanup()
+
+    def test_restore_after_restart(self):
+        # Setup
+        now = time.time()
+        self.store.record_many([('board1', {'temp': 18, 'humidity': 45}, now - 7200),
+                                ('board1', {'temp': 20}, now - 60),
+                                ('board2', {'temp': 22}, now - 30)])
+        self.log.close()
+
+        # Exercise
+        restored_log = ReadingLog(self.path)
+        restored = ReadingStore(capacity=10)
+        count = restored_log.restore(restored, window=3600)
+        restored_log.close()
+
+        # Verify
+        assert count == 3
+        assert restored.get_latest('temp', device_id='board1') == 20
+        assert restored.get_latest('humidity', device_id='board1') == 45
+        assert restored.get_latest('temp', device_id='board2') == 22
+        assert [value for _, value in restored.get_history('board1', 'temp')] == [20]
+
+    def test_flushes_in_background(self):
+        # Setup
+        self.log.start()
+
+        # Exercise
+        self.store.record('board1', 'temp', 21)
+
+        # Verify
+        reader = ReadingLog(self.path)
+        try:
+            assert wait_for(lambda: reader.restore(ReadingStore(capacity=10)) == 1)
+        finally:
+            reader.close()
+
+    def test_compact_drops_expired_readings(self):
+        # Setup
+        self.log.retention = 60
+        self.store.record('board1', 'temp', 18, timestamp=time.time() - 120)
+        self.store.record('board1', 'temp', 19, timestamp=time.time() - 90)
+        self.log.flush()
+
+        # Exercise
+        self.log.compact()
+
+        # Verify
+        restored = ReadingStore(capacity=10)
+        assert self.log.restore(restored, window=3600) == 1
+        assert restored.get_latest('temp', device_id='board1') == 19
+
+
+def _append_shared(path, readings):
+    SharedReadings(path, capacity=8).append(readings)
+
+
+class SharedReadingsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'readings')
+        self.shared = SharedReadings(self.path, capacity=8)
+        self.store = ReadingStore(capacity=10)
+
+    def tearDown(self):
+        self.shared.close()
+        self.directory.cleanup()
+
+    def _append_from_other_process(self, readings):
+        process = multiprocessing.get_context('fork').Process(target=_append_shared, args=(self.path, readings))
+        process.start()
+        process.join()
+
+    def test_sync_readings_of_other_process(self):
+        # Setup
+        self._append_from_other_process([('board1', {'temp': 21, 'humidity': 40}, 100), ('board2', {'temp': 19}, 101)])
+
+        # Exercise
+        count = self.shared.sync(self.store)
+
+        # Verify
+        assert count == 3
+        assert self.store.get_latest('temp', device_id='board1') == 21
+        assert self.store.get_latest('humidity', device_id='board1') == 40
+        assert self.store.get_latest('temp', device_id='board2') == 19
+        assert self.shared.sync(self.store) == 0
+
+    def test_own_readings_not_replayed(self):
+        # Setup
+        self.store.subscribe(self.shared.append)
+        self.store.record('board1', 'temp', 21, timestamp=100)
+
+        # Exercise
+        count = self.shared.sync(self.store)
+
+        # Verify
+        assert count == 0
+        assert self.store.get_history('board1', 'temp') == [(100, 21)]
+
+    def test_skips_readings_overwritten_in_ring(self):
+        # Setup
+        self._append_from_other_process([('board1', {'temp': i}, i) for i in range(12)])
+
+        # Exercise
+        count = self.shared.sync(self.store)
+
+        # Verify
+        assert count == 8
+        assert [value for _, value in self.store.get_history('board1', 'temp')] == list(range(4, 12))
+
+    def test_replayed_readings_not_shared_again(self):
+        # Setup
+        notified = []
+        self.store.subscribe(notified.extend)
+        self._append_from_other_process([('board1', {'temp': 21}, 100)])
+
+        # Exercise
+        self.shared.sync(self.store)
+
+        # Verify
+        assert self.store.get_latest('temp', device_id='board1') == 21
+        assert notified == []
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+from unittest import main, mock, TestCase
+import sys, time
+
+win32api_module = mock.MagicMock()
+sys.modules['win32api'] = win32api_module
+import iot_app.lights as lights
+from iot_app.simulator import BulbSimulator, SimulatedBulb
+from iot_app.test import wait_for
+from yeelight import Bulb, BulbException, discover_bulbs
+
+
+class SimulatedBulbTest(TestCase):
+
+    def setUp(self):
+        self.simulated = SimulatedBulb('bedroom', requests_per_minute=5).start()
+        self.bulb = Bulb(self.simulated.host, self.simulated.port)
+
+    def tearDown(self):
+        self.simulated.stop()
+
+    def test_commands_change_state(self):
+        # Exercise
+        self.bulb.set_brightness(20)
+        self.bulb.turn_off()
+
+        # Verify
+        props = self.bulb.get_properties(['bright', 'power'])
+        assert (props['bright'], props['power']) == ('20', 'off')
+        assert self.simulated.rpc_count == 3
+
+    def test_quota_enforced(self):
+        # Setup
+        for _ in range(5):
+            self.bulb.get_properties(['bright'])
+
+        # Exercise / Verify
+        with self.assertRaises(BulbException):
+            self.bulb.get_properties(['bright'])
+
+    def test_latency(self):
+        # Setup
+        self.simulated.latency = 0.2
+        start = time.monotonic()
+
+        # Exercise
+        self.bulb.get_properties(['bright'])
+
+        # Verify
+        assert time.monotonic() - start >= 0.2
+
+    def test_dropped_connection(self):
+        # Setup
+        self.bulb.get_properties(['bright'])
+
+        # Exercise
+        self.simulated.drop_connections()
+
+        # Verify
+        with self.assertRaises(BulbException):
+            self.bulb.get_properties(['bright'])
+        assert self.bulb.get_properties(['bright'])['bright'] == '50'
+
+    def test_unsupported_method(self):
+        # Setup
+        simulated = SimulatedBulb('porch', model='mono').start()
+
+        # Exercise / Verify
+        with self.assertRaises(BulbException):
+            Bulb(simulated.host, simulated.port).set_rgb(255, 0, 0)
+        simulated.stop()
+
+
+class CachedFadeStepTest(TestCase):
+
+    def setUp(self):
+        self.simulated = SimulatedBulb('study').start()
+        self.bulb = lights.DiscoveredBulb(self.simulated.host, self.simulated.port)
+        self.cache = lights.BulbStateCache()
+
+    def tearDown(self):
+        self.cache.unwatch(self.bulb)
+        self.simulated.stop()
+
+    def test_step_from_cache_after_start_from_bulb(self):
+        # Setup
+        props = lights._read_properties(self.bulb, lights._get_required_props(), self.cache)
+        fade = lights.Fade(self.bulb, 1, 10, int(props['bright']), props, False, 0, state_cache=self.cache)
+        self.cache.watch(self.bulb)
+        assert wait_for(lambda: self.cache.is_live(self.bulb))
+
+        # Exercise
+        delay = fade.run_step()
+
+        # Verify
+        assert delay == 1
+        assert self.simulated.state['bright'] == 40
+
+
+class SimulatedNetworkTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.simulator = BulbSimulator(3, names=['bedroom', 'lounge', 'kitchen']).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.simulator.stop()
+
+    def setUp(self):
+        self.registry = lights.BulbRegistry(refresh_interval=None)
+        self.registry.start()
+        self.light_manager = lights.LightManager(registry=self.registry)
+
+    def tearDown(self):
+        for bulb in self.registry.get_all_lights():
+            self.registry.get_state_cache().unwatch(bulb)
+
+    def test_discovery(self):
+        # Exercise
+        found = discover_bulbs(timeout=0.5)
+
+        # Verify
+        names = sorted(bulb['capabilities']['name'] for bulb in found)
+        assert names == ['bedroom', 'kitchen', 'lounge']
+
+    def test_lookup_by_name(self):
+        # Exercise
+        light = self.light_manager.get_light_by_name('Kitchen')
+
+        # Verify
+        assert light.ip == self.simulator.get_bulb('kitchen').host
+
+    def test_disco_everywhere(self):
+        # Exercise
+        results = self.light_manager.start_disco(*self.light_manager.get_all_lights())
+
+        # Verify
+        assert all(result.error is None for result in results)
+        assert all(bulb.flow is not None for bulb in self.simulator.bulbs)
+        self.light_manager.stop_flow(*self.light_manager.get_all_lights())
+
+    def test_notifications_reach_state_cache(self):
+        # Setup
+        light = self.light_manager.get_light_by_name('lounge')
+        state_cache = self.registry.get_state_cache()
+        assert wait_for(lambda: state_cache.is_live(light))
+
+        # Exercise
+        self.simulator.get_bulb('lounge').update(bright=10)
+
+        # Verify
+        assert wait_for(lambda: state_cache.get_properties(light, ['bright']) == {'bright': '10'})
+        self.simulator.get_bulb('lounge').update(bright=50)
+
+    def test_stepped_fade(self):
+        # Setup
+        light = self.light_manager.get_light_by_name('bedroom')
+        simulated = self.simulator.get_bulb('bedroom')
+        simulated.update(bright=30)
+        assert wait_for(lambda: self.registry.get_state_cache().get_properties(light, ['bright']) == {'bright': '30'})
+
+        # Exercise
+        self.light_manager.fade(2, True, 0, light, native=False)
+
+        # Verify
+        assert wait_for(lambda: simulated.state['power'] == 'off', timeout=4)
+        assert simulated.state['bright'] == 1
+        simulated.update(power='on', bright=50)
+
+
+class AdvertisementTest(TestCase):
+
+    def setUp(self):
+        self.simulator = BulbSimulator(2, names=['study', 'hallway']).start()
+        self.registry = lights.BulbRegistry(refresh_interval=None, listen=True)
+        with mock.patch('iot_app.lights._initialize_lights', return_value=[]):
+            self.registry.start()
+
+    def tearDown(self):
+        self.registry.stop()
+        for bulb in self.registry.get_all_lights():
+            self.registry.get_state_cache().unwatch(bulb)
+        self.simulator.stop()
+
+    def test_advertised_bulb_added(self):
+        # Setup
+        simulated = self.simulator.get_bulb('study')
+
+        # Exercise
+        self.simulator.advertise(simulated)
+
+        # Verify
+        assert wait_for(lambda: self.registry.get_light_by_name('study') is not None)
+        assert self.registry.get_light_by_name('study').ip == simulated.host
+        assert self.registry.get_light_by_name('hallway') is None
+
+    def test_new_address_replaces_old(self):
+        # Setup
+        simulated = self.simulator.get_bulb('study')
+        self.simulator.advertise(simulated)
+        assert wait_for(lambda: self.registry.get_light_by_name('study') is not None)
+
+        # Exercise
+        simulated.stop()
+        simulated.host = '127.0.0.20'
+        simulated.start()
+        self.simulator.advertise(simulated)
+
+        # Verify
+        assert wait_for(lambda: self.registry.get_light_by_name('study').ip == '127.0.0.20')
+        assert len(self.registry.get_all_lights()) == 1
+
+    def test_silent_bulb_expires(self):
+        # Setup
+        simulated = self.simulator.get_bulb('hallway')
+        self.simulator.advertise(simulated, max_age=0)
+        assert wait_for(lambda: self.registry.get_light_by_name('hallway') is not None)
+
+        # Exercise
+        simulated.stop()
+        light = self.registry.get_light_by_name('hallway')
+        assert wait_for(lambda: not self.registry.get_state_cache().is_live(light))
+        self.registry.expire()
+
+        # Verify
+        assert self.registry.get_all_lights() == []
+
+
+if __name__ == '__main__':
+    main()